@@ -2,21 +2,125 @@
 const int PIN_MOTOR_STEP = 3;
 const int PIN_MOTOR_REV = 4;
 
-// command tracking fields
-String cmd = "";
+// command tracking fields: the line being read, its length, and whether it did not fit
+// the line is read in place, nothing is allocated
+const int CMD_SIZE = 64;
+char cmd[CMD_SIZE];
+int cmdLength = 0;
+bool cmdOverflow = false;
 bool hasCmd = false;
+// tag of the command being handled (tagged protocol), -1 for untagged commands
+int cmdTag = -1;
+// the command being handled: its index in the command table, and its integer arguments
+const int MAX_ARGUMENTS = 3;
+int cmdIndex = 0;
+long arguments[MAX_ARGUMENTS];
+
+// message buffer, to compose messages with numbers without allocating
+const int MESSAGE_SIZE = 48;
+char message[MESSAGE_SIZE];
+int messageLength = 0;
+
+// capability flags, sent in reply to the "tagged" probe
+//  - 1: tagged protocol
+//  - 2: binary protocol
+//  - 4: baud rate switching
+//  - 8: step count telemetry
+//  - 16: ramped moves
+//  - 32: move queue
+//  - 64: flow control credits
+const int CAPABILITIES = 127;
+
+// baud rate fields
+// after switching, the previous rate is restored if no valid command arrives within the check time
+const long DEFAULT_BAUD_RATE = 9600;
+const long BAUD_RATES[] = {115200, 250000, 500000};
+const int BAUD_RATE_COUNT = 3;
+const unsigned long BAUD_RATE_CHECK_TIME = 500;
+long baudRate = DEFAULT_BAUD_RATE;
+long previousBaudRate = DEFAULT_BAUD_RATE;
+bool baudRateCheck = false;
+unsigned long baudRateSwitchTime = 0;
+
+// binary protocol fields
+// frames: opcode or reply type (high bit set if tagged), tag (if tagged), zigzag varint payload, CRC-8
+// frames are COBS encoded and terminated by a 0 byte
+const int FRAME_SIZE = 32;
+const byte FRAME_TAGGED = 0x80;
+const byte REPLY_MESSAGE = 0x01;
+const byte REPLY_VALUE = 0x02;
+const byte REPLY_CONFIRMATION = 0x03;
+const byte REPLY_TELEMETRY = 0x04;
+const byte REPLY_MOVE = 0x05;
+const byte REPLY_CREDIT = 0x06;
+// number of opcodes, the commands in the command table from here on are only available in text
+const byte OPCODE_COUNT = 22;
+bool binaryMode = false;
+byte frame[FRAME_SIZE];
+int frameLength = 0;
+
+// flow control fields: once enabled, the bytes read from the serial buffer are reported to the host as credits, so
+// that it never sends more than the serial buffer can hold
+// reports of fewer bytes than the batch are held back, to save replies
+const int CREDIT_BATCH = 16;
+bool creditMode = false;
+int creditBytes = 0;
 
 // status field
 //  - 0: standby
 //  - 1: running
 int mode = 0;
 
-// stepping parameters
-int stepCounter = 0;
-int stepTarget = 0;
+// stepping parameters, the step count and target are longs, an int would overflow after 32767 steps
+long stepCounter = 0;
+long stepTarget = 0;
 int stepDelay = 5;
 bool forward = true;
 
+// telemetry fields: the step count is pushed while stepping, every interval (ms) and/or every number of steps
+// 0 disables either
+unsigned long telemetryInterval = 0;
+long telemetrySteps = 0;
+unsigned long telemetryTime = 0;
+
+// ramp fields: segments of (steps, first interval, last interval) with intervals in microseconds, the intervals
+// within a segment are interpolated linearly
+// segments are added with "ramp", and committed to the step target with "move"
+const int RAMP_SIZE = 16;
+const unsigned long MIN_RAMP_INTERVAL = 100;
+const unsigned int STEP_PULSE_WIDTH = 5;
+long rampSteps[RAMP_SIZE];
+unsigned long rampStart[RAMP_SIZE];
+unsigned long rampEnd[RAMP_SIZE];
+int rampCount = 0;
+// the ramp being stepped: current segment, steps left in it, and current interval
+bool rampActive = false;
+int rampIndex = 0;
+long rampLeft = 0;
+unsigned long rampInterval = 0;
+// linear interpolation of the intervals in whole microseconds: increment per step, remainder, accumulated error
+long rampDelta = 0;
+long rampRemainder = 0;
+long rampDivisor = 1;
+long rampError = 0;
+
+// step scheduler fields: the step pin is toggled once the wait (us) since the last toggle has passed, nothing blocks
+// in between, so that commands are handled while stepping
+// a step at the step delay is high for one delay and low for another, and is counted when the pin goes low
+bool stepHigh = false;
+unsigned long stepWait = 0;
+unsigned long lastStepTime = 0;
+
+// move queue fields: moves of a signed number of steps, which are stepped one after the other at the step delay
+// every queued move is completed with a move reply holding the number of steps taken, 0 if it has been stopped before
+// it started, moves discarded by "flush" are not completed
+const int MOVE_QUEUE_SIZE = 8;
+long moveQueue[MOVE_QUEUE_SIZE];
+int moveQueueStart = 0;
+int moveQueueLength = 0;
+// whether the steps being taken are those of a queued move
+bool queuedMove = false;
+
 
 // method is ran once to initialize the script
 void setup() {
@@ -24,181 +128,509 @@ void setup() {
   pinMode(PIN_MOTOR_STEP, OUTPUT);
   pinMode(PIN_MOTOR_REV, OUTPUT);
   // open serial
-  Serial.begin(9600);
-  // reserve 200 bytes for the command string:
-  cmd.reserve(200);
+  Serial.begin(baudRate);
 }
 
 
 // method is called continuously
 void loop() {
+  // revert a baud rate switch which was not followed by a valid command
+  if (baudRateCheck && millis() - baudRateSwitchTime > BAUD_RATE_CHECK_TIME) {
+    setBaudRate(previousBaudRate);
+    baudRateCheck = false;
+  }
   // check for a command
   if (hasCmd) {
       // parse the command
       handleCommand();
-  } else {
-    // perform the logic
-    switch(mode) {
-      case 0:
-        // idle
-        break;
-      case 1:
-        // run logic
-        run();
-        break;
-    }
+  }
+  // perform the logic, this returns right away if no step is due, so the next command is read in the meantime
+  switch(mode) {
+    case 0:
+      // idle, unless there are queued moves, which wait for steps which have been added but not started
+      if (moveQueueLength > 0 && stepTarget == 0) {
+        startQueuedMove();
+      }
+      break;
+    case 1:
+      // run logic
+      run();
+      // push the step count if the telemetry interval has passed
+      if (mode == 1 && telemetryInterval > 0 && millis() - telemetryTime >= telemetryInterval) {
+        telemetryTime = millis();
+        sendTelemetry(stepCounter);
+      }
+      break;
   }
 }
 
 
 // method is called when serial input is arriving
 void serialEvent() {
-  // only read serial when it is available
-  while(Serial.available()) {
+  // only read serial when it is available, and stop at the end of a command,
+  // the next commands stay in the serial buffer until the current one has been handled
+  while(!hasCmd && Serial.available()) {
     // read the serial
     char inputChar = (char) Serial.read();
+    if (creditMode) {
+      creditBytes++;
+    }
+    if (binaryMode) {
+      // binary frames end with a 0 byte
+      if (inputChar == 0) {
+        hasCmd = true;
+      } else {
+        if (frameLength < FRAME_SIZE) {
+          frame[frameLength] = inputChar;
+        }
+        // overflowing frames are rejected when decoding
+        frameLength = frameLength + 1;
+      }
+      continue;
+    }
     // check if it is an end of line
     if (inputChar == '\n') {
       // command is complete
+      cmd[cmdLength] = 0;
       hasCmd = true;
-    } else {
+    } else if (cmdLength < CMD_SIZE - 1) {
       // append it to the commmand
-      cmd = cmd + inputChar;
+      cmd[cmdLength++] = inputChar;
+    } else {
+      // overflowing lines are rejected when parsing
+      cmdOverflow = true;
     }
   }
 }
 
+// command table: name, number of integer arguments and handler of each command, the index is the opcode of the
+// command in the binary protocol
+struct Command {
+  const char* name;
+  byte argumentCount;
+  void (*handler)();
+};
+
+// command handlers, see the command table
+void handleStepperControl();
+void handleStart();
+void handleStop();
+void handleReset();
+void handleForwards();
+void handleBackwards();
+void handleGetStepCount();
+void handleGetStepTarget();
+void handleIsForward();
+void handleIsBackward();
+void handleGetDelay();
+void handleStep();
+void handleDelay();
+void handleTagged();
+void handleBinary();
+void handleTelemetry();
+void handleTelemetrySteps();
+void handleRamp();
+void handleMove();
+void handleQueue();
+void handleFlush();
+void handleBaud();
+void handleCredits();
+
+const Command COMMANDS[] = {
+  {"", 0, NULL},
+  {"stepper_control", 0, handleStepperControl},
+  {"start", 0, handleStart},
+  {"stop", 0, handleStop},
+  {"reset", 0, handleReset},
+  {"forwards", 0, handleForwards},
+  {"backwards", 0, handleBackwards},
+  {"getStepCount", 0, handleGetStepCount},
+  {"getStepTarget", 0, handleGetStepTarget},
+  {"isForward", 0, handleIsForward},
+  {"isBackward", 0, handleIsBackward},
+  {"getDelay", 0, handleGetDelay},
+  {"step", 1, handleStep},
+  {"delay", 1, handleDelay},
+  {"tagged", 0, handleTagged},
+  {"binary", 0, handleBinary},
+  {"telemetry", 1, handleTelemetry},
+  {"telemetrySteps", 1, handleTelemetrySteps},
+  {"ramp", 3, handleRamp},
+  {"move", 0, handleMove},
+  {"queue", 1, handleQueue},
+  {"flush", 0, handleFlush},
+  // text only
+  {"baud", 1, handleBaud},
+  {"credits", 0, handleCredits},
+};
+const byte COMMAND_COUNT = 24;
+
+
 // method to handle the commands
 void handleCommand() {
-  if (!parseCommand()) {
-    sendMessage("Invalid command.");
-  }  
+  if (binaryMode) {
+    // decode the frame to the command, its tag and its arguments
+    if (!decodeFrame()) {
+      sendMessage("Invalid frame.");
+    } else {
+      // a valid command confirms the baud rate
+      baudRateCheck = false;
+      COMMANDS[cmdIndex].handler();
+    }
+    frameLength = 0;
+  } else {
+    // parse the line to the command, its tag and its arguments
+    if (!parseCommand()) {
+      sendMessage("Invalid command.");
+    } else {
+      // a valid command confirms the baud rate
+      baudRateCheck = false;
+      COMMANDS[cmdIndex].handler();
+    }
+  }
   // reset the command
-  cmd = "";
+  cmdLength = 0;
+  cmdOverflow = false;
+  cmdTag = -1;
   hasCmd = false;
+  // report the bytes read, now that the host may send the next ones
+  if (creditMode && creditBytes >= CREDIT_BATCH) {
+    sendCredits(creditBytes);
+    creditBytes = 0;
+  }
+}
+
+
+// method to decode a binary frame to the command, its tag and its arguments, returns false if the frame is invalid
+bool decodeFrame() {
+  if (frameLength > FRAME_SIZE) {
+    return false;
+  }
+  int length = cobsDecode(frame, frameLength);
+  if (length < 2 || crc8(frame, length - 1) != frame[length - 1]) {
+    return false;
+  }
+  int index = 0;
+  byte opcode = frame[index++];
+  if (opcode & FRAME_TAGGED) {
+    opcode = opcode & ~FRAME_TAGGED;
+    cmdTag = frame[index++];
+  }
+  if (opcode == 0 || opcode >= OPCODE_COUNT) {
+    return false;
+  }
+  cmdIndex = opcode;
+  // decode the arguments
+  for (int i = 0; i < COMMANDS[opcode].argumentCount; i++) {
+    if (!decodeVarint(frame, length - 1, &index, &arguments[i])) {
+      return false;
+    }
+  }
+  return true;
 }
 
 
-// method to parse commands
+// method to parse a text command ("<name> <arguments>#<tag>") to the command, its tag and its arguments, returns false
+// if the command is invalid
 bool parseCommand() {
-  // Polling command to confirm the presence of the controller
-  if (cmd.equals("stepper_control")) {
-    sendConfirmation(1);
-    return true;
-  }
-  // Command to start stepping
-  if (cmd.equals("start")) {
-    if (mode != 1) {
-      // toggle mode to running
-      mode = 1;
-      // log a message
-      String msg = "Stepping ";
-      msg = msg + stepTarget + " steps";
-      sendMessage(msg);
-    } else {
-      sendMessage("Already running.");
+  if (cmdOverflow) {
+    return false;
+  }
+  // split off the tag of tagged commands
+  char* separator = strchr(cmd, '#');
+  if (separator != NULL) {
+    cmdTag = atoi(separator + 1);
+    *separator = 0;
+  }
+  // look up the name, which ends at the first space
+  char* end = strchr(cmd, ' ');
+  int nameLength = end == NULL ? strlen(cmd) : end - cmd;
+  cmdIndex = 0;
+  for (byte i = 1; i < COMMAND_COUNT; i++) {
+    if (strncmp(cmd, COMMANDS[i].name, nameLength) == 0 && COMMANDS[i].name[nameLength] == 0) {
+      cmdIndex = i;
+      break;
     }
-    return true;
   }
-  // Command to stop stepping
-  if (cmd.equals("stop")) {
-    if (mode == 0) {
-      sendMessage("Already in standby.");
-    } else {
-      // toggle mode to standby    
-      sendMessage("Stopping");
-      stop();
+  if (cmdIndex == 0) {
+    return false;
+  }
+  // parse the arguments
+  for (int i = 0; i < COMMANDS[cmdIndex].argumentCount; i++) {
+    char* start = end;
+    if (start == NULL) {
+      return false;
+    }
+    arguments[i] = strtol(start, &end, 10);
+    if (end == start) {
+      return false;
     }
-    return true;
   }
-  // Command to reset the step target
-  if (cmd.equals("reset")) {
-    if (mode == 1) {
-      sendMessage("Cannot reset while running.");
-    } else {
-      sendMessage("Reset state.");
-      reset();
+  return true;
+}
+
+
+// Polling command to confirm the presence of the controller
+void handleStepperControl() {
+  sendConfirmation(1);
+}
+
+
+// Polling command to confirm support for the tagged protocol, replies to tagged commands echo their tag
+// the confirmation holds the capability flags
+void handleTagged() {
+  sendConfirmation(CAPABILITIES);
+}
+
+
+// Command to switch the baud rate, the rate is confirmed at the current rate before switching, or 0 is sent
+// if the rate is not supported
+void handleBaud() {
+  long rate = arguments[0];
+  for (int i = 0; i < BAUD_RATE_COUNT; i++) {
+    if (BAUD_RATES[i] == rate) {
+      sendConfirmation(rate);
+      previousBaudRate = baudRate;
+      setBaudRate(rate);
+      baudRateCheck = true;
+      baudRateSwitchTime = millis();
+      return;
     }
-    return true;
   }
-  // Command to run the motor forwards
-  if (cmd.equals("forwards")) {
-    // set motor to forwards
-    forwards();
-    sendMessage("Motor set forward");
-    return true;
+  sendConfirmation(0);
+}
+
+
+// Command to enable flow control, the bytes read from the next command on are reported as credits
+// nothing is sent back, as the host starts counting the bytes it sends right after this command
+void handleCredits() {
+  creditMode = true;
+  creditBytes = 0;
+}
+
+
+// Command to switch to the binary protocol, the confirmation is the last reply in text
+void handleBinary() {
+  sendConfirmation(1);
+  binaryMode = true;
+}
+
+
+// Command to start stepping
+void handleStart() {
+  if (mode != 1) {
+    // toggle mode to running
+    mode = 1;
+    // steps and ramps are timed from here
+    startSteps();
+    // log a message
+    composeMessage("Stepping ");
+    appendNumber(stepTarget);
+    appendText(" steps");
+    sendMessage(message);
+  } else {
+    sendMessage("Already running.");
   }
-  // Command to run the motor backwards
-  if (cmd.equals("backwards")) {
-    // set motor to backwards
-    backwards();
-    sendMessage("Motor set backward");
-    return true;
-  }
-  // command to get the current step counter
-  if (cmd.equals("getStepCount")) {
-    sendValue(stepCounter);
-    return true;
-  }
-  // command to get the current step target
-  if (cmd.equals("getStepTarget")) {
-    sendValue(stepTarget);
-    return true;
-  }
-  // command to check if the motor is currently set to forwards
-  if (cmd.equals("isForward")) {
-    sendValue(forward);
-    return true;
-  }
-  // command to check if the motor is currently set to backwards
-  if (cmd.equals("isBackward")) {
-    sendValue(!forward);
-    return true;
-  }
-  // command to get the current step delay
-  if (cmd.equals("getDelay")) {
-    sendValue(stepDelay);
-    return true;
-  }
-  // Command to add a number of steps to the step target
-  if (cmd.indexOf("step ") == 0) {
-    // parse steps
-    String stepString = cmd.substring(5, cmd.length());
-    int steps = stepString.toInt();
-    if (steps > 0) {
-      // add the steps to the target
-      stepTarget = stepTarget + steps;
-      // send a confirmation the current step target
-      sendConfirmation(stepTarget);
-    }
-    return true;
-  }
-  // Command to set the delay between the steps
-  if (cmd.indexOf("delay " == 0)) {
-    sendMessage(cmd);
-    // parse delay
-    String delayString = cmd.substring(6, cmd.length());
-    int delay = delayString.toInt();
-    if (delay > 1) {
-      // set the delay
-      stepDelay = delay;
-    } else {
-      // send a message in case of invalid delay
-      sendMessage("Delay must be larger than 1 (minimum 2)");
+}
+
+
+// Command to stop stepping, the queued moves are discarded as well, also when they wait for steps to be started
+void handleStop() {
+  if (mode == 0 && moveQueueLength > 0) {
+    sendMessage("Stopping");
+    discardQueuedMoves();
+  } else if (mode == 0) {
+    sendMessage("Already in standby.");
+  } else {
+    // toggle mode to standby
+    sendMessage("Stopping");
+    stop();
+  }
+}
+
+
+// Command to reset the step target
+void handleReset() {
+  if (mode == 1) {
+    sendMessage("Cannot reset while running.");
+  } else {
+    sendMessage("Reset state.");
+    reset();
+  }
+}
+
+
+// Command to run the motor forwards
+void handleForwards() {
+  // set motor to forwards
+  forwards();
+  sendMessage("Motor set forward");
+}
+
+
+// Command to run the motor backwards
+void handleBackwards() {
+  // set motor to backwards
+  backwards();
+  sendMessage("Motor set backward");
+}
+
+
+// command to get the current step counter
+void handleGetStepCount() {
+  sendValue(stepCounter);
+}
+
+
+// command to get the current step target
+void handleGetStepTarget() {
+  sendValue(stepTarget);
+}
+
+
+// command to check if the motor is currently set to forwards
+void handleIsForward() {
+  sendValue(forward);
+}
+
+
+// command to check if the motor is currently set to backwards
+void handleIsBackward() {
+  sendValue(!forward);
+}
+
+
+// command to get the current step delay
+void handleGetDelay() {
+  sendValue(stepDelay);
+}
+
+
+// Command to push the step count every <interval> ms while stepping, 0 to stop
+void handleTelemetry() {
+  telemetryInterval = arguments[0] > 0 ? arguments[0] : 0;
+  telemetryTime = millis();
+  composeMessage("Telemetry interval ");
+  appendNumber(telemetryInterval);
+  appendText(" ms");
+  sendMessage(message);
+}
+
+
+// Command to push the step count every <steps> steps while stepping, 0 to stop
+void handleTelemetrySteps() {
+  telemetrySteps = arguments[0] > 0 ? arguments[0] : 0;
+  composeMessage("Telemetry every ");
+  appendNumber(telemetrySteps);
+  appendText(" steps");
+  sendMessage(message);
+}
+
+
+// Command to add a ramp segment of <steps> steps, of which the intervals go from <first> to <last> microseconds
+// the segment is stepped once committed with "move", nothing is sent unless the segment is rejected
+void handleRamp() {
+  long steps = arguments[0];
+  long start = arguments[1];
+  long end = arguments[2];
+  if (steps <= 0 || start < (long) MIN_RAMP_INTERVAL || end < (long) MIN_RAMP_INTERVAL) {
+    sendMessage("Invalid ramp segment.");
+  } else if (rampCount >= RAMP_SIZE || rampActive) {
+    sendMessage("Cannot add ramp segment.");
+  } else {
+    rampSteps[rampCount] = steps;
+    rampStart[rampCount] = start;
+    rampEnd[rampCount] = end;
+    rampCount = rampCount + 1;
+  }
+}
+
+
+// Command to add the steps of the ramp segments to the step target, they are stepped before any other steps
+// sends a confirmation of the current step target
+void handleMove() {
+  if (mode == 1 || rampActive) {
+    sendMessage("Cannot move while running.");
+  } else if (rampCount == 0) {
+    sendMessage("No ramp segments.");
+  } else {
+    for (int i = 0; i < rampCount; i++) {
+      stepTarget = stepTarget + rampSteps[i];
     }
-    return true;
+    rampActive = true;
+    startRampSegment(0);
+    sendConfirmation(stepTarget);
+  }
+}
+
+
+// Command to queue a move of <steps> steps, negative to step backwards, nothing is sent until the move completes
+// a move which does not fit in the queue is completed with 0 steps right away
+void handleQueue() {
+  long steps = arguments[0];
+  if (steps == 0 || moveQueueLength >= MOVE_QUEUE_SIZE) {
+    sendMoveCompletion(0);
+  } else {
+    moveQueue[(moveQueueStart + moveQueueLength) % MOVE_QUEUE_SIZE] = steps;
+    moveQueueLength = moveQueueLength + 1;
+  }
+}
+
+
+// Command to discard the queued moves which have not been started, the move being stepped is completed
+// sends the number of discarded moves, these are the most recently queued ones
+void handleFlush() {
+  sendValue(moveQueueLength);
+  moveQueueStart = 0;
+  moveQueueLength = 0;
+}
+
+
+// Command to add a number of steps to the step target
+void handleStep() {
+  long steps = arguments[0];
+  if (steps > 0) {
+    // add the steps to the target
+    stepTarget = stepTarget + steps;
+    // send a confirmation the current step target
+    sendConfirmation(stepTarget);
+  }
+}
+
+
+// Command to set the delay between the steps
+void handleDelay() {
+  composeMessage("delay ");
+  appendNumber(arguments[0]);
+  sendMessage(message);
+  if (arguments[0] > 1) {
+    // set the delay
+    stepDelay = arguments[0];
+  } else {
+    // send a message in case of invalid delay
+    sendMessage("Delay must be larger than 1 (minimum 2)");
   }
-  return false;
 }
 
 
 // method to stop stepping
 void stop() {
-      // Send a confirmation of the number of steps
-      sendConfirmation(stepCounter);
+      if (queuedMove) {
+        // complete the queued move
+        sendMoveCompletion(stepCounter);
+      } else {
+        // Send a confirmation of the number of steps
+        sendConfirmation(stepCounter);
+      }
+      // discard the queued moves
+      discardQueuedMoves();
       // Log a message
-      String msg = "Stopped after ";
-      sendMessage(msg + stepCounter + "/" + stepTarget + " steps.");
+      composeMessage("Stopped after ");
+      appendNumber(stepCounter);
+      appendText("/");
+      appendNumber(stepTarget);
+      appendText(" steps.");
+      sendMessage(message);
       // Reset the state
       reset();
 }
@@ -207,17 +639,31 @@ void stop() {
 // method to run main logic
 void run() {
   if (stepTarget > 0) {
-    // step
-    step();
+    // step, following the ramp if there is one
+    bool stepped = rampActive ? rampStep() : step();
+    if (!stepped) {
+      // not yet time for the next step
+      return;
+    }
     // increment the step counter
     stepCounter = stepCounter + 1;
+    // push the step count every number of steps
+    if (telemetrySteps > 0 && stepCounter % telemetrySteps == 0) {
+      sendTelemetry(stepCounter);
+    }
     // check if step target is reached
-    if (stepCounter >= stepTarget) {
+    if (stepCounter >= stepTarget && queuedMove) {
+      // complete the queued move, the next one is started by the loop
+      sendMoveCompletion(stepCounter);
+      reset();
+    } else if (stepCounter >= stepTarget) {
       // Send a confirmation of the number of steps
       sendConfirmation(stepCounter);
       // Log a message
-      String msg = "Completed ";
-      sendMessage(msg + stepCounter + " steps.");
+      composeMessage("Completed ");
+      appendNumber(stepCounter);
+      appendText(" steps.");
+      sendMessage(message);
       // Reset the state
       reset();
     }
@@ -228,20 +674,142 @@ void run() {
 }
 
 
+// method to change the baud rate, discarding any partial command
+void setBaudRate(long rate) {
+  // wait until all replies have been sent
+  Serial.flush();
+  Serial.end();
+  baudRate = rate;
+  Serial.begin(baudRate);
+  cmdLength = 0;
+  cmdOverflow = false;
+  frameLength = 0;
+}
+
+
 // method to reset the state
 void reset() {
     mode = 0;
     stepTarget = 0;
     stepCounter = 0;
+    rampCount = 0;
+    rampActive = false;
+    queuedMove = false;
+    // end a step pulse which is in progress
+    if (stepHigh) {
+      stepHigh = false;
+      digitalWrite(PIN_MOTOR_STEP, LOW);
+    }
+}
+
+
+// method to start stepping the oldest queued move, setting the direction to that of the move
+void startQueuedMove() {
+  long steps = moveQueue[moveQueueStart];
+  moveQueueStart = (moveQueueStart + 1) % MOVE_QUEUE_SIZE;
+  moveQueueLength = moveQueueLength - 1;
+  if (steps > 0) {
+    forwards();
+  } else {
+    backwards();
+  }
+  stepTarget = abs(steps);
+  stepCounter = 0;
+  queuedMove = true;
+  mode = 1;
+  startSteps();
+}
+
+
+// method to discard the queued moves, completing each with 0 steps
+void discardQueuedMoves() {
+  while (moveQueueLength > 0) {
+    moveQueueStart = (moveQueueStart + 1) % MOVE_QUEUE_SIZE;
+    moveQueueLength = moveQueueLength - 1;
+    sendMoveCompletion(0);
+  }
 }
 
 
-// method to run one step
-void step() {
+// method to time the first step of a move, which is taken right away, unless the last step was less than a step
+// delay ago
+// a ramp is always timed from its start, so that axes started together step together, its first interval keeps its
+// first step clear of the last one
+void startSteps() {
+  unsigned long wait = (unsigned long) stepDelay * 1000;
+  if (rampActive || micros() - lastStepTime >= wait) {
+    lastStepTime = micros();
+    stepWait = 0;
+  } else {
+    stepWait = wait;
+  }
+}
+
+
+// method to toggle the step pin once its wait has passed, returns true when a step has been completed
+bool step() {
+  unsigned long now = micros();
+  if (now - lastStepTime < stepWait) {
+    return false;
+  }
+  // the next toggle is timed from when this one was due, so that late toggles do not delay the ones after them,
+  // unless this one is more than a wait late, then the lost time is not caught up in a burst of short pulses
+  if (now - lastStepTime < 2 * stepWait) {
+    lastStepTime = lastStepTime + stepWait;
+  } else {
+    lastStepTime = now;
+  }
+  stepWait = (unsigned long) stepDelay * 1000;
+  stepHigh = !stepHigh;
+  digitalWrite(PIN_MOTOR_STEP, stepHigh ? HIGH : LOW);
+  return !stepHigh;
+}
+
+
+// method to take the next step of the ramp once its interval has passed, returns false if it is not time yet
+bool rampStep() {
+  if (micros() - lastStepTime < rampInterval) {
+    return false;
+  }
+  // the next interval is timed from when this step was due, so that late steps do not delay the ones after them
+  lastStepTime = lastStepTime + rampInterval;
   digitalWrite(PIN_MOTOR_STEP, HIGH);
-  delay(stepDelay);
+  delayMicroseconds(STEP_PULSE_WIDTH);
   digitalWrite(PIN_MOTOR_STEP, LOW);
-  delay(stepDelay);
+  // interpolate the next interval
+  rampLeft = rampLeft - 1;
+  if (rampLeft > 0) {
+    rampInterval = rampInterval + rampDelta;
+    rampError = rampError + rampRemainder;
+    if (rampError >= rampDivisor) {
+      rampInterval = rampInterval + 1;
+      rampError = rampError - rampDivisor;
+    } else if (rampError <= -rampDivisor) {
+      rampInterval = rampInterval - 1;
+      rampError = rampError + rampDivisor;
+    }
+  } else if (rampIndex + 1 < rampCount) {
+    startRampSegment(rampIndex + 1);
+  } else {
+    // ramp completed, any further steps are taken at the step delay
+    rampActive = false;
+    rampCount = 0;
+    stepWait = (unsigned long) stepDelay * 1000;
+  }
+  return true;
+}
+
+
+// method to start stepping a segment of the ramp
+void startRampSegment(int index) {
+  rampIndex = index;
+  rampLeft = rampSteps[index];
+  rampInterval = rampStart[index];
+  rampDivisor = rampLeft > 1 ? rampLeft - 1 : 1;
+  long difference = (long) rampEnd[index] - (long) rampStart[index];
+  rampDelta = difference / rampDivisor;
+  rampRemainder = difference % rampDivisor;
+  rampError = 0;
 }
 
 
@@ -260,20 +828,195 @@ void backwards() {
 
 
 // method to send a message
-void sendMessage(String msg) {
-  Serial.println("[m]" + msg);
+void sendMessage(const char* msg) {
+  if (binaryMode) {
+    sendFrame(REPLY_MESSAGE, -1, 0, msg);
+    return;
+  }
+  Serial.print("[m]");
+  Serial.println(msg);
 }
 
 
 // method to send a value
-void sendValue(int value) {
-  String msg = "[v]";
-  Serial.println(msg + value);
+void sendValue(long value) {
+  sendReply("[v]", REPLY_VALUE, cmdTag, value);
 }
 
 
 // method to send a confirmation
-void sendConfirmation(int value) {
-  String msg = "[c]";
-  Serial.println(msg + value);
+void sendConfirmation(long value) {
+  sendReply("[c]", REPLY_CONFIRMATION, cmdTag, value);
+}
+
+
+// method to send a telemetry sample of the step count, telemetry is not tagged
+void sendTelemetry(long value) {
+  sendReply("[t]", REPLY_TELEMETRY, -1, value);
+}
+
+
+// method to send the completion of a queued move, with the number of steps taken, these are never tagged
+void sendMoveCompletion(long value) {
+  sendReply("[q]", REPLY_MOVE, -1, value);
+}
+
+
+// method to report the number of bytes read from the serial buffer, these are never tagged
+void sendCredits(long value) {
+  sendReply("[k]", REPLY_CREDIT, -1, value);
+}
+
+
+// method to send a reply holding a value, as "<prefix><tag>:<value>" for tagged replies, "<prefix><value>" otherwise
+void sendReply(const char* prefix, byte type, int tag, long value) {
+  if (binaryMode) {
+    sendFrame(type, tag, value, "");
+    return;
+  }
+  Serial.print(prefix);
+  if (tag >= 0) {
+    Serial.print(tag);
+    Serial.print(':');
+  }
+  Serial.println(value);
+}
+
+
+// method to start composing a message in the message buffer
+void composeMessage(const char* text) {
+  messageLength = 0;
+  appendText(text);
+}
+
+
+// method to append text to the message buffer, the message is truncated if it does not fit
+void appendText(const char* text) {
+  while (*text != 0 && messageLength < MESSAGE_SIZE - 1) {
+    message[messageLength++] = *text++;
+  }
+  message[messageLength] = 0;
+}
+
+
+// method to append a number to the message buffer
+void appendNumber(long value) {
+  char digits[12];
+  ltoa(value, digits, 10);
+  appendText(digits);
+}
+
+
+// method to send a binary frame, messages send their text, values and confirmations their value
+void sendFrame(byte type, int tag, long value, const char* msg) {
+  byte raw[FRAME_SIZE];
+  byte encoded[FRAME_SIZE + 2];
+  int length = 0;
+  raw[length++] = tag < 0 ? type : type | FRAME_TAGGED;
+  if (tag >= 0) {
+    raw[length++] = tag;
+  }
+  if (type == REPLY_MESSAGE) {
+    // messages are truncated to fit the frame
+    for (int i = 0; msg[i] != 0 && length < FRAME_SIZE - 1; i++) {
+      raw[length++] = msg[i];
+    }
+  } else {
+    length = encodeVarint(value, raw, length);
+  }
+  raw[length] = crc8(raw, length);
+  length = cobsEncode(raw, length + 1, encoded);
+  encoded[length++] = 0;
+  Serial.write(encoded, length);
+}
+
+
+// method to compute the CRC-8 (polynomial 0x07) of the given bytes
+byte crc8(const byte* data, int length) {
+  byte crc = 0;
+  for (int i = 0; i < length; i++) {
+    crc = crc ^ data[i];
+    for (byte bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+
+// method to COBS encode the given bytes, returns the encoded length
+int cobsEncode(const byte* data, int length, byte* out) {
+  int codeIndex = 0;
+  int write = 1;
+  byte code = 1;
+  for (int read = 0; read < length; read++) {
+    if (data[read] == 0) {
+      out[codeIndex] = code;
+      code = 1;
+      codeIndex = write++;
+    } else {
+      out[write++] = data[read];
+      code++;
+      if (code == 0xFF) {
+        out[codeIndex] = code;
+        code = 1;
+        codeIndex = write++;
+      }
+    }
+  }
+  out[codeIndex] = code;
+  return write;
+}
+
+
+// method to COBS decode the given bytes in place, returns the decoded length, or -1 if invalid
+int cobsDecode(byte* data, int length) {
+  int read = 0;
+  int write = 0;
+  while (read < length) {
+    byte code = data[read];
+    if (code == 0 || read + code > length) {
+      return -1;
+    }
+    read++;
+    for (byte i = 1; i < code; i++) {
+      data[write++] = data[read++];
+    }
+    if (code < 0xFF && read < length) {
+      data[write++] = 0;
+    }
+  }
+  return write;
+}
+
+
+// method to append a zigzag varint to the given bytes, returns the new length
+int encodeVarint(long value, byte* data, int length) {
+  unsigned long zigzag = ((unsigned long) value << 1) ^ (unsigned long) (value >> 31);
+  while (zigzag > 0x7F) {
+    data[length++] = (zigzag & 0x7F) | 0x80;
+    zigzag = zigzag >> 7;
+  }
+  data[length++] = zigzag;
+  return length;
+}
+
+
+// method to read a zigzag varint from the given bytes, returns false if the data ends too soon
+bool decodeVarint(const byte* data, int length, int* index, long* value) {
+  unsigned long zigzag = 0;
+  byte shift = 0;
+  while (true) {
+    if (*index >= length || shift > 28) {
+      return false;
+    }
+    byte b = data[(*index)++];
+    zigzag = zigzag | ((unsigned long) (b & 0x7F) << shift);
+    shift = shift + 7;
+    if (!(b & 0x80)) {
+      break;
+    }
+  }
+  *value = (long) (zigzag >> 1) ^ -((long) (zigzag & 1));
+  return true;
 }
@@ -0,0 +1,390 @@
+import asyncio
+import os
+import traceback
+from collections import deque
+
+import serial
+from serial.serialutil import SerialException
+
+from .motor_control import HANDSHAKE_INTERVAL, BOOT_TIME
+from .motor_interface import MotorInterface
+
+
+# Class to interface with the stepper motor using String commands, driven by an asyncio event loop
+# The serial port is read and written without blocking from the event loop itself, no threads are used, the replies are
+# parsed as by MotorInterface
+# Note: this relies on loop.add_reader() and therefore requires a POSIX system
+class AsyncMotorInterface(MotorInterface):
+    def __init__(self, port, value_func, confirm_func, message_func, baudrate=9600):
+        # call super constructor (its threads are never started), the callbacks are called directly from the event loop
+        MotorInterface.__init__(self, port, value_func, confirm_func, message_func, baudrate)
+        self.loop = None
+        # Buffers for incoming and outgoing bytes
+        self.read_buffer = bytearray()
+        self.write_buffer = bytearray()
+        # Optional callback for the loss of the port, called from the event loop once the connection has been stopped
+        self.lost_func = None
+
+    # method to stop the connection when the port fails, internal use only, do not call
+    def __lose_port(self, message):
+        self.message_func(message + str(self.get_port()))
+        self.message_func(traceback.format_exc())
+        self.stop_connection()
+        if self.lost_func is not None:
+            self.lost_func()
+
+    # method called by the event loop when the port has data to read, internal use only, do not call
+    def __on_readable(self):
+        try:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+        except (SerialException, OSError):
+            self.__lose_port('Error while reading serial port ')
+            return
+        self.read_buffer.extend(data)
+        # handle all complete lines in place, and pass on their replies right away
+        self.handle_buffer(self.read_buffer)
+        self.update_tick()
+
+    # method to write as much of the write buffer as the port accepts, internal use only, do not call
+    def __flush(self):
+        if not self.running:
+            return
+        try:
+            written = os.write(self.ser.fileno(), self.write_buffer)
+        except (BlockingIOError, InterruptedError):
+            written = 0
+        except OSError:
+            self.__lose_port('Error sending commands over port ')
+            return
+        del self.write_buffer[0:written]
+        # if not everything could be written, continue when the port is writable again
+        if len(self.write_buffer) > 0:
+            self.loop.add_writer(self.ser.fileno(), self.__flush)
+        else:
+            self.loop.remove_writer(self.ser.fileno())
+
+    # logs a command to be sent, the command is written right away if the port allows it
+    def send_command(self, cmd):
+        if not self.running:
+            return
+        pending = len(self.write_buffer) > 0
+        self.write_buffer.extend((cmd + '\n').encode('ascii'))
+        if not pending:
+            self.__flush()
+
+    # method to start the connection, must be called from the event loop
+    def start_connection(self):
+        if self.ser is None:
+            try:
+                self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=0)
+            except SerialException:
+                print(traceback.format_exc())
+                self.ser = None
+                return False
+            # register the port with the event loop
+            self.loop = asyncio.get_event_loop()
+            self.running = True
+            self.loop.add_reader(self.ser.fileno(), self.__on_readable)
+            return True
+        return self.running
+
+    # method to stop the connection
+    def stop_connection(self):
+        if self.running:
+            self.running = False
+            self.loop.remove_reader(self.ser.fileno())
+            self.loop.remove_writer(self.ser.fileno())
+        if self.ser is not None:
+            self.ser.close()
+
+
+# Class to control the stepper motor using Python coroutines
+# This is the asyncio counterpart of MotorControl, queries are awaited instead of halting program execution
+class AsyncMotorControl:
+    def __init__(self, port, time_out, message_func=None, debug=False, baudrate=9600):
+        # message callback function (optional, messages can also be iterated with messages())
+        self.message_func = message_func
+        # motor interface
+        self.mi = AsyncMotorInterface(port, self.__value_func, self.__confirm_func, self.__message_func, baudrate)
+        self.mi.lost_func = self.__lost_func
+        # state flag, see MotorControl
+        self.state = -1
+        # futures awaiting a value reply, in the order the commands were sent
+        self.command_futures = deque()
+        # future awaiting the validation or the end of the stepping
+        self.state_future = None
+        # queues of active message iterators
+        self.message_queues = []
+        # direction flag
+        self.forwards = True
+        # step and target flag
+        self.last_step_command = 0
+        self.last_step_count = -1
+        self.step_target = 0
+        # timer for the confirmation reply time out
+        self.time_out_handle = None
+        # number of handshakes sent, and whether the replies to the other handshakes are being awaited, see MotorControl
+        self.handshake_count = 0
+        self.handshake_fence = False
+        # time out limit
+        self.time_out = time_out
+        # debug mode
+        self.debug = debug
+
+    # method to handle messages, internal use only, do not call
+    def __message_func(self, message):
+        if self.message_func is not None:
+            self.message_func(message)
+        for message_queue in self.message_queues:
+            message_queue.put_nowait(message)
+
+    # method to handle the loss of the port, internal use only, do not call
+    def __lost_func(self):
+        self.__message_func('Connection lost')
+        self.stop_connection()
+
+    # method to handle value responses, internal use only, do not call
+    def __value_func(self, value):
+        if self.debug:
+            self.__message_func('[DEBUG] Received value: \"' + str(value) + '\"')
+        if len(self.command_futures) > 0:
+            # command reply
+            future = self.command_futures.popleft()
+            if not future.done():
+                future.set_result(value)
+        else:
+            self.__message_func('Error: received a value without commands')
+
+    # method to handle confirmation responses, internal use only, do not call
+    def __confirm_func(self, value):
+        if self.state == 0:
+            # validating, late replies to other handshakes are ignored
+            if value == 1 and not self.handshake_fence:
+                if self.handshake_count > 1:
+                    # the controller is up, the replies to the later handshakes come before the reply to a query sent
+                    # now, so validation passes on that reply
+                    self.handshake_fence = True
+                    self.__start_time_out()
+                    future = asyncio.get_event_loop().create_future()
+                    future.add_done_callback(self.__fence_handshakes)
+                    self.command_futures.append(future)
+                    self.__send_string_command('getStepCount')
+                else:
+                    self.__validated()
+        elif self.state == 2:
+            # update the step target
+            self.step_target = value
+            # start stepping
+            self.state = 3
+            self.__stop_time_out()
+        elif self.state == 3:
+            # finished stepping
+            self.last_step_count = value
+            self.state = 1
+            self.__resolve_state(value)
+
+    # passes validation once the replies to all handshakes are in, internal use only, do not call
+    def __fence_handshakes(self, future):
+        if self.state == 0 and future.result() is not None:
+            self.__validated()
+
+    # passes validation, internal use only, do not call
+    def __validated(self):
+        self.handshake_fence = False
+        self.state = 1
+        self.__stop_time_out()
+        self.__resolve_state(True)
+
+    # method to resolve the future awaiting a state change, internal use only, do not call
+    def __resolve_state(self, value):
+        if self.state_future is not None and not self.state_future.done():
+            self.state_future.set_result(value)
+
+    # starts the timer for a confirmation reply, internal use only, do not call
+    # - extra: time in seconds added to the time out
+    def __start_time_out(self, extra=0):
+        self.__stop_time_out()
+        self.time_out_handle = asyncio.get_event_loop().call_later(self.time_out + extra, self.__on_time_out)
+
+    # stops the timer for a confirmation reply, internal use only, do not call
+    def __stop_time_out(self):
+        if self.time_out_handle is not None:
+            self.time_out_handle.cancel()
+            self.time_out_handle = None
+
+    # called when no confirmation reply has been received in time, internal use only, do not call
+    def __on_time_out(self):
+        self.time_out_handle = None
+        self.__message_func('Connection timed out')
+        self.stop_connection()
+
+    # sends a String command to the motor for interpretation, internal use only, do not call
+    def __send_string_command(self, cmd):
+        if self.debug:
+            self.__message_func('[DEBUG] Sending command: \"' + cmd + '\"')
+        self.mi.send_command(cmd)
+
+    # sends a String command and awaits the value reply, internal use only, do not call
+    async def __query(self, command_string):
+        if not self.is_valid():
+            return None
+        future = asyncio.get_event_loop().create_future()
+        self.command_futures.append(future)
+        self.__send_string_command(command_string)
+        try:
+            return await asyncio.wait_for(future, self.time_out)
+        except asyncio.TimeoutError:
+            # drop the command, in line with MotorControl
+            if future in self.command_futures:
+                self.command_futures.remove(future)
+            return None
+
+    # get the port used for communicating
+    def get_port(self):
+        return self.mi.get_port()
+
+    # starts up the connection with the motor and awaits its validation
+    # - boot_time: the time in seconds the controller is given to boot before the time out starts
+    # returns True if the connection has been validated
+    async def start_connection(self, boot_time=BOOT_TIME):
+        if not self.mi.start_connection():
+            return False
+        # perform validation test
+        self.state = 0
+        self.state_future = asyncio.get_event_loop().create_future()
+        self.handshake_count = 0
+        self.handshake_fence = False
+        self.__start_time_out(boot_time)
+        # the controller resets when the port is opened and ignores its input while it boots, so repeat the handshake
+        # until it answers
+        while not self.state_future.done() and not self.handshake_fence:
+            self.handshake_count += 1
+            self.__send_string_command('stepper_control')
+            await asyncio.wait([self.state_future], timeout=HANDSHAKE_INTERVAL)
+        await asyncio.wait([self.state_future])
+        return self.state_future.result()
+
+    # stops the motor connection
+    def stop_connection(self):
+        self.state = -1
+        self.__stop_time_out()
+        self.mi.stop_connection()
+        # clear all commands
+        for future in self.command_futures:
+            if not future.done():
+                future.set_result(None)
+        self.command_futures.clear()
+        self.__resolve_state(False)
+        # end the message iterators
+        for message_queue in self.message_queues:
+            message_queue.put_nowait(None)
+
+    # sends a command to the motor to execute a number of steps, see MotorControl.do_steps()
+    def do_steps(self, steps):
+        if self.is_valid():
+            if self.is_stepping():
+                # motor is already stepping
+                if (self.forwards and steps > 0) or ((not self.forwards) and steps < 0):
+                    # same direction: add the steps
+                    self.state = 2
+                    self.last_step_command += abs(steps)
+                    self.__start_time_out()
+                    self.__send_string_command('step ' + str(abs(steps)))
+                else:
+                    self.__message_func('Motor is currently stepping in the opposite direction, ignoring command')
+            else:
+                # check direction
+                if steps < 0:
+                    self.forwards = False
+                    self.__send_string_command('backwards')
+                elif steps > 0:
+                    self.forwards = True
+                    self.__send_string_command('forwards')
+                else:
+                    # we just ignore zero steps
+                    return
+                # send the number of steps
+                self.last_step_count = -1
+                self.last_step_command = abs(steps)
+                self.__send_string_command('step ' + str(abs(steps)))
+                # start stepping
+                self.state = 2
+                self.state_future = asyncio.get_event_loop().create_future()
+                self.__start_time_out()
+                self.__send_string_command('start')
+
+    # same as 'do_steps()', but also awaits until the motor has finished stepping
+    # returns the number of completed steps
+    async def do_steps_and_wait_finish(self, steps):
+        self.do_steps(steps)
+        if self.is_stepping():
+            await asyncio.shield(self.state_future)
+        return self.last_step_count
+
+    # sends a command to the motor to stop stepping
+    def stop_stepping(self):
+        if self.is_stepping():
+            self.state = 3
+            self.__stop_time_out()
+            self.__send_string_command('stop')
+
+    # sets the stepping delay, minimum value is 2
+    def set_step_delay(self, delay):
+        self.__send_string_command('delay ' + str(delay))
+
+    # queries the motor's current step count, returns None if the connection has been lost or is timed out
+    async def get_step_count(self):
+        return await self.__query('getStepCount')
+
+    # queries the motor's current step target, returns None if the connection has been lost or is timed out
+    async def get_step_target(self):
+        return await self.__query('getStepTarget')
+
+    # queries if the motor is running clockwise, returns None if the connection has been lost or is timed out
+    async def is_forwards(self):
+        return await self.__query('isForward')
+
+    # queries if the motor is running anti-clockwise, returns None if the connection has been lost or is timed out
+    async def is_backwards(self):
+        return await self.__query('isBackward')
+
+    # queries the motor's current step delay, returns None if the connection has been lost or is timed out
+    async def get_delay(self):
+        return await self.__query('getDelay')
+
+    # gets the latest amount of steps that were completed
+    def get_last_step_count(self):
+        return self.last_step_count
+
+    # gets the latest amount of steps that were sent to the motor as a command
+    def get_last_step_command(self):
+        return self.last_step_command
+
+    # asynchronous iterator over the messages sent by the motor, ends when the connection is stopped
+    async def messages(self):
+        message_queue = asyncio.Queue()
+        self.message_queues.append(message_queue)
+        try:
+            while self.mi.is_running() or not message_queue.empty():
+                message = await message_queue.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.message_queues.remove(message_queue)
+
+    # checks if the motor control is in a valid state, meaning it is connected to the controller with an open connection
+    def is_valid(self):
+        return self.state > 0
+
+    # checks if the motor control is currently validating, meaning it is not yet in a valid state, but might be soon
+    def is_validating(self):
+        return self.state == 0
+
+    # checks if the motor control is currently valid, or still validating
+    def is_valid_or_validating(self):
+        return self.state >= 0
+
+    # checks if the motor is currently stepping
+    def is_stepping(self):
+        return self.state >= 2
@@ -0,0 +1,220 @@
+# Codec for the binary protocol of the stepper controller
+#
+# Each frame consists of:
+#  - an opcode (commands) or a reply type (replies), with the high bit set if the frame is tagged
+#  - the tag, only if the frame is tagged
+#  - the payload: a zigzag varint per integer, ASCII text for messages, nothing for commands without arguments
+#  - a CRC-8 (polynomial 0x07) of all preceding bytes
+# Frames are COBS encoded and terminated by a 0 byte.
+
+# command opcodes
+COMMANDS = {
+    'stepper_control': 0x01,
+    'start': 0x02,
+    'stop': 0x03,
+    'reset': 0x04,
+    'forwards': 0x05,
+    'backwards': 0x06,
+    'getStepCount': 0x07,
+    'getStepTarget': 0x08,
+    'isForward': 0x09,
+    'isBackward': 0x0A,
+    'getDelay': 0x0B,
+    'step': 0x0C,
+    'delay': 0x0D,
+    'tagged': 0x0E,
+    'binary': 0x0F,
+    'telemetry': 0x10,
+    'telemetrySteps': 0x11,
+    'ramp': 0x12,
+    'move': 0x13,
+    'queue': 0x14,
+    'flush': 0x15,
+}
+# command names, by opcode
+COMMAND_NAMES = dict((opcode, name) for name, opcode in COMMANDS.items())
+# number of integer arguments of the commands which carry arguments
+ARGUMENT_COUNTS = {'step': 1, 'delay': 1, 'telemetry': 1, 'telemetrySteps': 1, 'ramp': 3, 'queue': 1}
+
+# reply types
+REPLY_MESSAGE = 0x01
+REPLY_VALUE = 0x02
+REPLY_CONFIRMATION = 0x03
+REPLY_TELEMETRY = 0x04
+REPLY_MOVE = 0x05
+REPLY_CREDIT = 0x06
+
+# flag for tagged frames
+TAGGED = 0x80
+
+# frame delimiter
+DELIMITER = b'\0'
+
+
+# builds the lookup table for the CRC-8, internal use only, do not call
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+_CRC8_TABLE = _crc8_table()
+
+
+# computes the CRC-8 (polynomial 0x07, initial value 0) of a bytearray
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+# COBS encodes a bytearray, the result contains no 0 bytes
+def cobs_encode(data):
+    out = bytearray([0])
+    code_index = 0
+    code = 1
+    for byte in data:
+        if byte == 0:
+            # close the current block
+            out[code_index] = code
+            code = 1
+            code_index = len(out)
+            out.append(0)
+        else:
+            out.append(byte)
+            code += 1
+            if code == 0xFF:
+                # block is full
+                out[code_index] = code
+                code = 1
+                code_index = len(out)
+                out.append(0)
+    out[code_index] = code
+    return out
+
+
+# decodes COBS encoded data (without the delimiter), raises a ValueError if the data is invalid
+# - start, end: the range of the data to decode, so that a frame can be decoded in place in a receive buffer
+def cobs_decode(data, start=0, end=None):
+    out = bytearray()
+    index = start
+    length = len(data) if end is None else end
+    while index < length:
+        code = data[index]
+        if code == 0 or index + code > length:
+            raise ValueError('Invalid COBS data')
+        out.extend(data[index + 1:index + code])
+        index += code
+        if code < 0xFF and index < length:
+            out.append(0)
+    return out
+
+
+# appends an integer as zigzag varint to a bytearray
+def encode_varint(value, out):
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+# reads a zigzag varint from a bytearray, starting at the given index
+# returns a (value, next index) tuple, raises a ValueError if the data ends too soon
+def decode_varint(data, index):
+    value = 0
+    shift = 0
+    while True:
+        if index >= len(data):
+            raise ValueError('Truncated varint')
+        byte = data[index]
+        index += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return (value >> 1) ^ -(value & 1), index
+
+
+# adds the header and CRC to a frame body, and COBS encodes it, internal use only, do not call
+def _frame(code, tag, payload):
+    raw = bytearray([code | TAGGED, tag]) if tag is not None else bytearray([code])
+    raw.extend(payload)
+    raw.append(crc8(raw))
+    out = cobs_encode(raw)
+    out.extend(DELIMITER)
+    return bytes(out)
+
+
+# verifies and splits a frame (without the delimiter) in (code, tag, payload), internal use only, do not call
+def _unframe(frame, start=0, end=None):
+    # a bytearray is decoded as is, other data is copied to one so that indexing yields integers on Python 2 as well
+    raw = cobs_decode(frame if isinstance(frame, bytearray) else bytearray(frame), start, end)
+    if len(raw) < 2:
+        raise ValueError('Frame too short')
+    if crc8(raw[0:-1]) != raw[-1]:
+        raise ValueError('CRC mismatch')
+    code = raw[0]
+    if code & TAGGED:
+        if len(raw) < 3:
+            raise ValueError('Frame too short')
+        return code & ~TAGGED, raw[1], raw[2:-1]
+    return code, None, raw[1:-1]
+
+
+# encodes a text command (e.g. 'step 100') to a frame, including the delimiter
+# raises a ValueError for unknown commands
+def encode_command(cmd, tag=None):
+    parts = cmd.split(' ', 1)
+    name = parts[0]
+    if name not in COMMANDS:
+        raise ValueError('Unknown command: ' + cmd)
+    payload = bytearray()
+    if name in ARGUMENT_COUNTS:
+        arguments = parts[1].split(' ') if len(parts) > 1 else []
+        if len(arguments) != ARGUMENT_COUNTS[name]:
+            raise ValueError('Wrong number of arguments: ' + cmd)
+        for argument in arguments:
+            encode_varint(int(argument), payload)
+    return _frame(COMMANDS[name], tag, payload)
+
+
+# decodes a command frame (without the delimiter) to a (text command, tag) tuple
+# raises a ValueError for invalid frames
+def decode_command(frame):
+    opcode, tag, payload = _unframe(frame)
+    if opcode not in COMMAND_NAMES:
+        raise ValueError('Unknown opcode: ' + str(opcode))
+    name = COMMAND_NAMES[opcode]
+    index = 0
+    for i in range(ARGUMENT_COUNTS.get(name, 0)):
+        argument, index = decode_varint(payload, index)
+        name = name + ' ' + str(argument)
+    return name, tag
+
+
+# encodes a reply to a frame, including the delimiter
+# - reply_type: REPLY_MESSAGE, REPLY_VALUE, REPLY_CONFIRMATION, REPLY_TELEMETRY, REPLY_MOVE or REPLY_CREDIT
+# - payload: a String for messages, an integer for the other replies
+def encode_reply(reply_type, payload, tag=None):
+    if reply_type == REPLY_MESSAGE:
+        return _frame(reply_type, tag, bytearray(payload.encode('ascii', 'replace')))
+    return _frame(reply_type, tag, encode_varint(payload, bytearray()))
+
+
+# decodes a reply frame (without the delimiter) to a (reply type, payload, tag) tuple
+# raises a ValueError for invalid frames
+# - start, end: the range of the frame in a bytearray, by default all of it
+def decode_reply(frame, start=0, end=None):
+    reply_type, tag, payload = _unframe(frame, start, end)
+    if reply_type == REPLY_MESSAGE:
+        return reply_type, payload.decode('ascii', 'replace'), tag
+    if reply_type in (REPLY_VALUE, REPLY_CONFIRMATION, REPLY_TELEMETRY, REPLY_MOVE, REPLY_CREDIT):
+        return reply_type, decode_varint(payload, 0)[0], tag
+    raise ValueError('Unknown reply type: ' + str(reply_type))
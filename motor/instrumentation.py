@@ -0,0 +1,232 @@
+import os
+import threading
+import time
+from collections import deque
+
+
+# Histogram with fixed buckets, in the style of Prometheus
+class Histogram:
+    # upper bounds of the buckets, in seconds
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        # observations per bucket, the last bucket holds those above the largest bound
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    # adds an observation
+    def observe(self, value):
+        index = 0
+        while index < len(self.BUCKETS) and value > self.BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    # estimates the given percentile, as the upper bound of the bucket it falls in
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        target = p / 100.0 * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= target and count > 0:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else float('inf')
+        return float('inf')
+
+    # gets the state of the histogram as a dictionary, with cumulative bucket counts as (upper bound, count) tuples
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            buckets.append((self.BUCKETS[index] if index < len(self.BUCKETS) else float('inf'), total))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum,
+                'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+# Time stamps of a single command as it passes through the stages of the control stack, all in seconds
+class CommandRecord:
+    def __init__(self, name):
+        # name of the command, without its argument
+        self.name = name
+        # queued by MotorControl or the user
+        self.enqueued = time.time()
+        # written to the serial port
+        self.written = None
+        # reply read from the serial port
+        self.read = None
+        # reply handed to the callback by update_tick()
+        self.dispatched = None
+
+    # gets the time stamps as a dictionary
+    def to_dict(self):
+        return {'name': self.name, 'enqueued': self.enqueued, 'written': self.written, 'read': self.read,
+                'dispatched': self.dispatched}
+
+
+# Opt-in instrumentation of a MotorControl and its MotorInterface
+# Pass an instance to the MotorControl constructor, without one nothing is recorded
+# - export_interval: time in seconds between calls to the exporters, which happen on the clock thread
+# - history: number of completed command records to keep
+class Instrumentation:
+    def __init__(self, export_interval=10, history=100):
+        # lock for all recorded data, the stages are recorded from different threads
+        self.lock = threading.Lock()
+        # counters, by name
+        self.counters = {
+            'bytes_written': 0,
+            'commands_written': 0,
+            'bytes_read': 0,
+            'lines_read': 0,
+            'timeouts': 0,
+            'connection_timeouts': 0,
+        }
+        # functions returning the current value of a gauge, by name
+        self.gauges = {}
+        # round trip time histograms, by command name
+        self.round_trips = {}
+        # histograms of the time spent in each stage: waiting to be written, waiting for the reply, and
+        # waiting to be dispatched
+        self.stages = {'queue': Histogram(), 'reply': Histogram(), 'dispatch': Histogram()}
+        # most recently completed command records
+        self.recent = deque(maxlen=history)
+        # exporters, and the time of the next export
+        self.exporters = []
+        self.export_interval = export_interval
+        self.next_export = time.time() + export_interval
+
+    # adds an exporter, a function reference accepting a snapshot as parameter
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    # adds a gauge, a function reference returning its current value
+    def add_gauge(self, name, func):
+        self.gauges[name] = func
+
+    # increments a counter
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # creates the record for a command which is queued to be written
+    def command_enqueued(self, cmd):
+        return CommandRecord(cmd.split(' ', 1)[0])
+
+    # stamps the records of commands which have been written to the port together
+    def commands_written(self, records, byte_count):
+        now = time.time()
+        for record in records:
+            if record is not None:
+                record.written = now
+        with self.lock:
+            self.counters['bytes_written'] += byte_count
+            self.counters['commands_written'] += len(records)
+
+    # stamps the record of a command of which the reply has been dispatched, and records its round trip time
+    def command_completed(self, record):
+        record.dispatched = time.time()
+        with self.lock:
+            if record.name not in self.round_trips:
+                self.round_trips[record.name] = Histogram()
+            self.round_trips[record.name].observe(record.dispatched - record.enqueued)
+            if record.written is not None:
+                self.stages['queue'].observe(record.written - record.enqueued)
+                if record.read is not None:
+                    self.stages['reply'].observe(record.read - record.written)
+            if record.read is not None:
+                self.stages['dispatch'].observe(record.dispatched - record.read)
+            self.recent.append(record)
+
+    # gets the current state of all instrumentation as a dictionary
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': dict(self.counters),
+                'gauges': dict((name, func()) for name, func in self.gauges.items()),
+                'round_trips': dict((name, histogram.snapshot()) for name, histogram in self.round_trips.items()),
+                'stages': dict((name, histogram.snapshot()) for name, histogram in self.stages.items()),
+                'recent': [record.to_dict() for record in self.recent],
+            }
+
+    # passes a snapshot to all exporters
+    def export(self):
+        if len(self.exporters) > 0:
+            snapshot = self.snapshot()
+            for exporter in self.exporters:
+                exporter(snapshot)
+
+    # calls the exporters if the export interval has passed, called on every tick of the MotorControl
+    def update_tick(self):
+        now = time.time()
+        if now >= self.next_export:
+            self.next_export = now + self.export_interval
+            self.export()
+
+
+# Exporter writing snapshots to a file in the Prometheus text format, to be collected by a node exporter
+# - path: the file to write, it is replaced as a whole on every export
+# - labels: optional dictionary of labels to add to all metrics, e.g. {'port': 'COM3'}
+# - prefix: prefix of the metric names
+class PrometheusExporter:
+    def __init__(self, path, labels=None, prefix='stepper_control'):
+        self.path = path
+        self.labels = labels if labels is not None else {}
+        self.prefix = prefix
+
+    # formats the labels of a sample, internal use only, do not call
+    def __format_labels(self, extra=None):
+        labels = dict(self.labels)
+        if extra is not None:
+            labels.update(extra)
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join(key + '=\"' + str(labels[key]).replace('\\', '\\\\').replace('\"', '\\\"') + '\"'
+                              for key in sorted(labels)) + '}'
+
+    # formats a histogram, internal use only, do not call
+    def __format_histogram(self, lines, name, histogram, labels):
+        for bound, count in histogram['buckets']:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            extra = dict(labels)
+            extra['le'] = le
+            lines.append(name + '_bucket' + self.__format_labels(extra) + ' ' + str(count))
+        lines.append(name + '_sum' + self.__format_labels(labels) + ' ' + repr(histogram['sum']))
+        lines.append(name + '_count' + self.__format_labels(labels) + ' ' + str(histogram['count']))
+
+    # formats a snapshot in the Prometheus text format
+    def format(self, snapshot):
+        lines = []
+        for name in sorted(snapshot['counters']):
+            metric = self.prefix + '_' + name + '_total'
+            lines.append('# TYPE ' + metric + ' counter')
+            lines.append(metric + self.__format_labels() + ' ' + str(snapshot['counters'][name]))
+        metric = self.prefix + '_queue_depth'
+        lines.append('# TYPE ' + metric + ' gauge')
+        for name in sorted(snapshot['gauges']):
+            lines.append(metric + self.__format_labels({'queue': name}) + ' ' + str(snapshot['gauges'][name]))
+        metric = self.prefix + '_round_trip_seconds'
+        lines.append('# TYPE ' + metric + ' histogram')
+        for name in sorted(snapshot['round_trips']):
+            self.__format_histogram(lines, metric, snapshot['round_trips'][name], {'command': name})
+        metric = self.prefix + '_stage_seconds'
+        lines.append('# TYPE ' + metric + ' histogram')
+        for name in sorted(snapshot['stages']):
+            self.__format_histogram(lines, metric, snapshot['stages'][name], {'stage': name})
+        return '\n'.join(lines) + '\n'
+
+    # writes a snapshot to the file, through a temporary file so that readers never see a partial file
+    def __call__(self, snapshot):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as output:
+            output.write(self.format(snapshot))
+        if hasattr(os, 'replace'):
+            os.replace(temporary, self.path)
+        else:
+            # Python 2.7
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temporary, self.path)
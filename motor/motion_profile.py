@@ -0,0 +1,296 @@
+# Step schedules for acceleration profiled moves
+#
+# A schedule holds the interval before each step, in microseconds. It is uploaded to the controller as ramp segments
+# of (steps, first interval, last interval), the controller interpolates the intervals within a segment linearly.
+# The per step computations are vectorised with NumPy if it is available, and done step by step otherwise.
+import math
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, it only speeds up the computation of long schedules
+    numpy = None
+
+# supported profiles
+TRAPEZOIDAL = 'trapezoidal'
+S_CURVE = 's_curve'
+# shortest step interval of the controller, in microseconds
+MIN_INTERVAL = 100
+# maximum number of ramp segments the controller can hold
+MAX_SEGMENTS = 16
+# relative deviation from the exact intervals allowed when compressing to segments
+TOLERANCE = 0.01
+# number of schedules to cache
+CACHE_SIZE = 64
+
+# cached segments, by (steps, v_max, accel, profile)
+_cache = OrderedDict()
+
+
+# Element-wise operations on single values, with the same signatures as their NumPy counterparts
+class _ScalarOps:
+    sqrt = staticmethod(math.sqrt)
+    cos = staticmethod(math.cos)
+    minimum = staticmethod(min)
+    maximum = staticmethod(max)
+
+    @staticmethod
+    def where(condition, a, b):
+        return a if condition else b
+
+
+# applies a function of (value, ops) to all values, vectorised if NumPy is available, internal use only, do not call
+def _apply(func, values):
+    if numpy is not None:
+        return func(numpy.asarray(values, dtype=numpy.float64), numpy)
+    return [func(value, _ScalarOps) for value in values]
+
+
+# time (s) to travel a distance (steps) in the acceleration phase of a trapezoidal profile, internal use only
+def _trapezoidal_time(distance, accel, ops):
+    return ops.sqrt(2.0 * distance / accel)
+
+
+# time (s) to travel a distance (steps) in the acceleration phase of an S-curve profile, internal use only
+# the acceleration rises and falls as sin^2 over the phase, peaking at accel, so the jerk is limited
+# the distance covered after t seconds is accel * (t^2 / 4 + ta^2 / (8 pi^2) * (cos(2 pi t / ta) - 1)), which is
+# inverted by bisection
+def _s_curve_time(distance, accel, ta, ops):
+    low = distance * 0.0
+    high = low + ta
+    for i in range(48):
+        middle = (low + high) / 2
+        covered = accel * (middle * middle / 4 + ta * ta / (8 * math.pi * math.pi)
+                           * (ops.cos(2 * math.pi * middle / ta) - 1))
+        below = covered < distance
+        low = ops.where(below, middle, low)
+        high = ops.where(below, high, middle)
+    return (low + high) / 2
+
+
+# computes the time (s) at which each step of a move is taken, starting from standstill at time 0
+# - steps: the number of steps
+# - v_max: the maximum speed, in steps per second
+# - accel: the (peak) acceleration, in steps per second squared
+# - profile: TRAPEZOIDAL or S_CURVE
+# returns a NumPy array if NumPy is available, a list otherwise
+def step_times(steps, v_max, accel, profile=TRAPEZOIDAL):
+    if steps < 1 or v_max <= 0 or accel <= 0:
+        raise ValueError('Steps, maximum speed and acceleration must be positive')
+    if profile == TRAPEZOIDAL:
+        # distance to accelerate, lower the top speed if the move is too short to reach it
+        ramp = v_max * v_max / (2.0 * accel)
+        if 2 * ramp > steps:
+            ramp = steps / 2.0
+            v_max = math.sqrt(steps * accel)
+        ramp_time = v_max / float(accel)
+
+        def phase_time(distance, ops):
+            return _trapezoidal_time(distance, accel, ops)
+    elif profile == S_CURVE:
+        # the average acceleration is half the peak acceleration
+        ramp = v_max * v_max / float(accel)
+        if 2 * ramp > steps:
+            ramp = steps / 2.0
+            v_max = math.sqrt(steps * accel / 2.0)
+        ramp_time = 2.0 * v_max / accel
+
+        def phase_time(distance, ops):
+            return _s_curve_time(distance, accel, ramp_time, ops)
+    else:
+        raise ValueError('Unknown profile: ' + str(profile))
+    cruise = steps - 2 * ramp
+    if numpy is None:
+        # without NumPy, compute the time of each distance only once, the deceleration mirrors the acceleration
+        phase_times = {}
+        compute_phase_time = phase_time
+
+        def phase_time(distance, ops):
+            if distance not in phase_times:
+                phase_times[distance] = compute_phase_time(distance, ops)
+            return phase_times[distance]
+
+    # time of step k: accelerating up to the ramp distance, cruising, and the mirrored deceleration
+    def time_of_step(k, ops):
+        return phase_time(ops.minimum(k, ramp), ops) + ops.minimum(ops.maximum(k - ramp, 0), cruise) / v_max \
+            + ramp_time - phase_time(ops.minimum(steps - k, ramp), ops)
+    return _apply(time_of_step, range(1, steps + 1))
+
+
+# computes the interval before each step of a move, in whole microseconds, see step_times()
+# returns a list of integers
+def step_intervals(steps, v_max, accel, profile=TRAPEZOIDAL):
+    if 1000000.0 / v_max < MIN_INTERVAL:
+        raise ValueError('Maximum speed exceeds ' + str(1000000 // MIN_INTERVAL) + ' steps per second')
+    times = step_times(steps, v_max, accel, profile)
+    if numpy is not None:
+        # round the times rather than the intervals, so that rounding errors do not add up
+        micros = numpy.rint(numpy.asarray(times) * 1000000).astype(numpy.int64)
+        intervals = numpy.diff(micros, prepend=0)
+        return numpy.maximum(intervals, MIN_INTERVAL).tolist()
+    micros = [int(round(t * 1000000)) for t in times]
+    return [max(MIN_INTERVAL, b - a) for a, b in zip([0] + micros[0:-1], micros)]
+
+
+# expands ramp segments to the intervals the controller takes, with the same integer arithmetic
+# - segments: a list of (steps, first interval, last interval) tuples
+def expand_segments(segments):
+    intervals = []
+    for steps, start, end in segments:
+        divisor = max(1, steps - 1)
+        # C integer division and remainder truncate towards zero
+        delta = int(float(end - start) / divisor)
+        remainder = (end - start) - delta * divisor
+        interval = start
+        error = 0
+        for i in range(steps):
+            intervals.append(interval)
+            interval += delta
+            error += remainder
+            if error >= divisor:
+                interval += 1
+                error -= divisor
+            elif error <= -divisor:
+                interval -= 1
+                error += divisor
+    return intervals
+
+
+# greatest common divisor of two non-negative integers, internal use only, do not call
+def _gcd(a, b):
+    while b > 0:
+        a, b = b, a % b
+    return a
+
+
+# computes the time (us) the controller takes for a ramp segment, in closed form, see expand_segments()
+# its intervals are start + sign * floor(i * |end - start| / (steps - 1)), which sum up with the identity
+# sum(floor(i * m / d) for i in range(d)) == ((m - 1) * (d - 1) + gcd(m, d) - 1) / 2
+# internal use only, do not call
+def _segment_duration(steps, start, end):
+    if steps == 1:
+        return start
+    divisor = steps - 1
+    difference = abs(end - start)
+    floors = ((difference - 1) * (divisor - 1) + _gcd(difference, divisor) - 1) // 2 + difference
+    return steps * start + (floors if end >= start else -floors)
+
+
+# rounds the fitted segments to whole microseconds, carrying the time each segment gains or loses by the rounding
+# over to the next one, so that the move does not drift from its schedule, internal use only, do not call
+# - fits: (steps, duration, first interval, last interval) of the segments, the duration is that of the intervals
+#   they were fitted to, the intervals are not rounded yet
+# - spare: the number of segments which can be added, a segment of (nearly) constant intervals which does not match
+#   its duration to within an interval is split in two constant segments which do
+# returns a list of (steps, first interval, last interval) tuples
+def _round_segments(fits, spare, tolerance):
+    segments = []
+    # time the segments take beyond the schedule so far
+    drift = 0
+    for steps, duration, start, end in fits:
+        target = duration - drift
+        # shift the line by the average rounding error, and take the nearby endpoints which match the target best
+        shift = (target - _segment_duration(steps, int(round(start)), int(round(end)))) / float(steps)
+        first = int(round(start + shift))
+        last = int(round(end + shift))
+        candidates = [(max(MIN_INTERVAL, first + i), max(MIN_INTERVAL, last + j))
+                      for i in (-1, 0, 1) for j in (-1, 0, 1)]
+        first, last = min(candidates, key=lambda c: (abs(target - _segment_duration(steps, c[0], c[1])),
+                                                     abs(c[0] - start) + abs(c[1] - end)))
+        taken = _segment_duration(steps, first, last)
+        interval, longer = divmod(target, steps)
+        if spare > 0 and abs(target - taken) > max(first, last) and abs(end - start) <= 2 * max(1, tolerance * end) \
+                and interval >= MIN_INTERVAL:
+            # split in constant segments, the longer intervals last
+            segments.append((steps - longer, interval, interval))
+            segments.append((longer, interval + 1, interval + 1))
+            spare -= 1
+            taken = target
+        else:
+            segments.append((steps, first, last))
+        drift += taken - duration
+    return [segment for segment in segments if segment[0] > 0]
+
+
+# fits a line to the intervals from first to last (inclusive) by least squares, which keeps their sum, and so the
+# duration of the segment, the same; the sums are taken from the prefix sums of the intervals and of index * interval
+# returns the (first interval, last interval) of the line, internal use only, do not call
+def _fit(sums, weighted_sums, first, last):
+    n = last - first + 1
+    sum_y = sums[last + 1] - sums[first]
+    if n == 1:
+        return sum_y, sum_y
+    sum_xy = weighted_sums[last + 1] - weighted_sums[first] - first * sum_y
+    sum_x = n * (n - 1) / 2.0
+    sum_xx = (n - 1) * n * (2 * n - 1) / 6.0
+    slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x * sum_x)
+    start = (sum_y - slope * sum_x) / n
+    return start, start + slope * (n - 1)
+
+
+# checks if the intervals from first to last (inclusive) deviate at most tolerance from their fitted line
+# internal use only, do not call
+def _fits(intervals, sums, weighted_sums, first, last, tolerance):
+    start, end = _fit(sums, weighted_sums, first, last)
+    if start < MIN_INTERVAL - 0.5 or end < MIN_INTERVAL - 0.5:
+        return False
+    slope = (end - start) / max(1, last - first)
+    if numpy is not None and last - first > 64:
+        # vectorised check of long segments
+        values = numpy.asarray(intervals[first:last + 1], dtype=numpy.float64)
+        expected = start + slope * numpy.arange(last - first + 1)
+        return bool(numpy.all(numpy.abs(values - expected) <= numpy.maximum(1.0, tolerance * values)))
+    for index in range(first, last + 1):
+        if abs(intervals[index] - (start + slope * (index - first))) > max(1.0, tolerance * intervals[index]):
+            return False
+    return True
+
+
+# compresses intervals to ramp segments of (steps, first interval, last interval)
+# each segment is the least squares line through its intervals, so that the time it takes is preserved, the rounding
+# of the lines to whole microseconds is made up for in the next segments
+# the tolerance is relaxed until the segments fit in max_segments
+def compress(intervals, max_segments=MAX_SEGMENTS, tolerance=TOLERANCE):
+    sums = [0]
+    weighted_sums = [0]
+    for index, interval in enumerate(intervals):
+        sums.append(sums[-1] + interval)
+        weighted_sums.append(weighted_sums[-1] + index * interval)
+    while True:
+        fits = []
+        first = 0
+        while first < len(intervals):
+            # grow the segment exponentially, then bisect to its longest fitting length
+            length = 1
+            while first + length < len(intervals) \
+                    and _fits(intervals, sums, weighted_sums, first, first + length, tolerance):
+                length *= 2
+            low = length // 2
+            high = min(length, len(intervals) - first - 1)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if _fits(intervals, sums, weighted_sums, first, first + middle, tolerance):
+                    low = middle
+                else:
+                    high = middle - 1
+            start, end = _fit(sums, weighted_sums, first, first + low)
+            fits.append((low + 1, sums[first + low + 1] - sums[first], start, end))
+            first += low + 1
+            if len(fits) > max_segments:
+                break
+        if len(fits) <= max_segments:
+            return _round_segments(fits, max_segments - len(fits), tolerance)
+        tolerance *= 2
+
+
+# gets the ramp segments of a move, cached per (steps, v_max, accel, profile), see step_times()
+def get_segments(steps, v_max, accel, profile=TRAPEZOIDAL):
+    key = (steps, v_max, accel, profile)
+    if key in _cache:
+        segments = _cache.pop(key)
+    else:
+        segments = compress(step_intervals(steps, v_max, accel, profile))
+        if len(_cache) >= CACHE_SIZE:
+            _cache.popitem(last=False)
+    _cache[key] = segments
+    return segments
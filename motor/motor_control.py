@@ -1,15 +1,65 @@
+import heapq
+import numbers
 import threading
 import time
-from motor_interface import MotorInterface
+from collections import OrderedDict, deque
+from . import motion_profile
+from .motor_interface import MotorInterface, BLOCK, QUEUE_SIZE
+from .telemetry import TelemetryBuffer
+
+# capability flags, sent by the controller in reply to the 'tagged' probe
+CAPABILITY_TAGGED = 1
+CAPABILITY_BINARY = 2
+CAPABILITY_BAUD_RATE = 4
+CAPABILITY_TELEMETRY = 8
+CAPABILITY_RAMP = 16
+CAPABILITY_MOVE_QUEUE = 32
+CAPABILITY_CREDITS = 64
+
+# baud rates to negotiate, fastest first
+BAUD_RATES = (500000, 250000, 115200)
+# time in seconds to wait for the handshake at a new baud rate, the controller reverts after half of this
+BAUD_RATE_CHECK_TIME = 1
+# number of moves the controller can queue
+MOVE_QUEUE_SIZE = 8
+# longest time in seconds between two ticks of the clock thread
+TICK_INTERVAL = 0.1
+# time in seconds between handshakes while waiting for the controller to boot
+HANDSHAKE_INTERVAL = 0.1
+# time in seconds the controller is given to boot after the port has been opened, on top of the time out
+BOOT_TIME = 2
+# read-only queries of which the replies are mirrored on the host
+MIRRORED_QUERIES = ('getDelay', 'isForward', 'getStepTarget')
+# number of tags of the tagged protocol, which runs from 1 to 255, so at most this many commands can await a reply
+MAX_TAG = 255
 
 
 # Class to control the stepper motor using Python commands
+# - interface_factory: creates the motor interface from (port, value_func, confirm_func, message_func) and the keyword
+#   arguments baudrate, queue_size and policy
+# - clock: when False, no clock thread is started, and update_tick() must be called externally instead
+# - tagged: when True, the tagged protocol is negotiated with the controller during validation, in this protocol
+#   commands carry a tag which the controller echoes in its replies, so that they can be matched out of order
+# - binary: when True, the compact binary protocol is used during validation if the controller supports it
+# - baudrate: the baud rate to open the port with
+# - negotiate_baudrate: when True, the fastest baud rate supported by both sides is negotiated during validation
+# - flow_control: when True, commands are only written while the controller has room for them in its receive buffer,
+#   if it supports this, so that bursts of commands can not overrun it
+# - queue_size: the number of commands to queue on the host, 0 for an unbounded queue, the replies are not bounded
+# - policy: what happens when a command is sent while the command queue is full: motor_interface.BLOCK waits for room,
+#   DROP_OLDEST drops the oldest queued command (its reply is None), and RAISE raises queue.Full
+# - instrumentation: an optional Instrumentation object, recording the stages, round trip times and traffic of the
+#   commands, without it nothing is recorded
 class MotorControl:
-    def __init__(self, port, time_out, message_func, debug=False):
+    def __init__(self, port, time_out, message_func, debug=False, interface_factory=MotorInterface, clock=True,
+                 tagged=False, binary=False, baudrate=9600, negotiate_baudrate=False, flow_control=False,
+                 queue_size=QUEUE_SIZE, policy=BLOCK, instrumentation=None):
         # message callback function
         self.message_func = message_func
         # motor interface
-        self.mi = MotorInterface(port, self.__value_func, self.__confirm_func, self.message_func)
+        self.mi = interface_factory(port, self.__value_func, self.__confirm_func, self.message_func,
+                                    baudrate=baudrate, queue_size=queue_size, policy=policy)
+        self.mi.drop_func = self.__drop_func
         # state flag:
         #  -1: invalid
         #   0: validating
@@ -17,102 +67,542 @@ class MotorControl:
         #   2: await stepping
         #   3: stepping
         self.state = -1
-        # command callbacks
-        self.command_callbacks = []
+        # command callbacks, by tag, in the order the commands were sent
+        self.command_callbacks = OrderedDict()
+        # heap of (deadline, sequence number, tag, command) tuples of the command callbacks, so that time outs are
+        # found without scanning all commands, entries of commands which have been replied to are skipped
+        self.deadlines = []
+        self.sequence = 0
+        # lock to keep the order of the command callbacks in line with the order of the sent commands
+        self.command_lock = threading.RLock()
+        # tag of the last sent command, and the key of the last command awaiting a reply in the untagged protocol, of
+        # which the replies are matched in order, so that its keys need not be reused
+        self.tag = 0
+        self.key = 0
+        # condition to wait for a free tag, the number of threads waiting for one, and the thread calling update_tick(),
+        # which frees the tags and therefore never waits
+        self.tag_condition = threading.Condition()
+        self.tag_waiting = 0
+        self.tick_thread = None
+        # tagged protocol flags: requested, and confirmed by the controller
+        self.tagged = tagged
+        self.tagged_mode = False
+        # binary protocol flag: requested
+        self.binary = binary
+        # flow control flag: requested
+        self.flow_control = flow_control
+        # capability flags of the controller
+        self.capabilities = 0
+        # baud rate negotiation: flag, rates left to try, requested rate, previous rate and deadline of the check
+        self.negotiate_baudrate = negotiate_baudrate
+        self.baud_rates = []
+        self.baud_rate_request = 0
+        self.baud_rate_previous = baudrate
+        self.baud_rate_check = -1
+        # waking the controller: time of the last handshake sent while no reply has been received (-1 once it has
+        # answered), number of handshakes sent, and whether the replies to the other handshakes are being awaited
+        self.handshake_time = -1
+        self.handshake_count = 0
+        self.handshake_fence = False
         # direction flag
         self.forwards = True
+        # state mirror: the replies to the read-only queries, by query, as far as the host knows them from its own
+        # commands and the confirmations of the controller, and a version per query which changes whenever the host
+        # sets or drops its value, so that replies to queries sent before then are not mistaken for the current value
+        self.mirror = {}
+        self.mirror_versions = dict((query, 0) for query in MIRRORED_QUERIES)
         # step and target flag
         self.last_step_command = 0
         self.last_step_count = -1
         self.step_target = 0
+        # arming: the pending arming of a move until the controller confirms its step target, and whether the motor is
+        # armed with a move which has not been started yet
+        self.arming = None
+        self.armed = False
+        # condition notified whenever the motor may have finished stepping, or its validation may have ended
+        self.state_condition = threading.Condition()
         # time stamp of last command
         self.time_stamp = -1
         # time out limit
         self.time_out = time_out
         # debug mode
         self.debug = debug
+        # buffer for the step count telemetry, if subscribed
+        self.telemetry = None
+        # queued moves: held on the host as (steps, move) until there is room in the queue of the controller, and sent
+        # to the controller but not yet completed, in order
+        self.pending_moves = deque()
+        self.queued_moves = deque()
+        # event which is set while there are no queued moves
+        self.moves_idle = threading.Event()
+        self.moves_idle.set()
+        self.mi.move_func = self.__move_func
+        # instrumentation, shared with the interface, and the record of the last step command
+        self.instrumentation = instrumentation
+        self.step_record = None
+        if instrumentation is not None:
+            self.mi.instrumentation = instrumentation
+            instrumentation.add_gauge('command_buffer', self.mi.command_buffer.qsize)
+            instrumentation.add_gauge('value_buffer', lambda: len(self.mi.value_buffer))
+            instrumentation.add_gauge('confirmation_buffer', lambda: len(self.mi.confirmation_buffer))
+            instrumentation.add_gauge('command_callbacks', lambda: len(self.command_callbacks))
+            instrumentation.add_gauge('queued_moves', lambda: len(self.pending_moves) + len(self.queued_moves))
         # Thread for handling values
-        self.clock_thread = threading.Thread(target=self.__clock_func)
+        self.clock_thread = threading.Thread(target=self.__clock_func) if clock else None
 
     # method to handle value responses, internal use only, do not call
-    def __value_func(self, value):
+    def __value_func(self, value, tag=None):
         # debug
         if self.debug:
-            self.message_func('[DEBUG] Received value: \"' + str(value) + '\"')
-        if len(self.command_callbacks) > 0:
+            self.message_func('[DEBUG] Received value: \"' + str(value) + '\"' +
+                              ('' if tag is None else ' for command ' + str(tag)))
+        with self.command_lock:
+            if tag is not None:
+                # tagged reply: match it to its command
+                command = self.command_callbacks.pop(tag, None)
+            elif len(self.command_callbacks) > 0:
+                # untagged reply: it belongs to the oldest command
+                command = self.command_callbacks.popitem(last=False)[1]
+            else:
+                command = None
+        if command is not None:
+            self.__notify_tag()
             # command reply
-            command = self.command_callbacks.pop(0)
-            command.accept_value(value)
-        else:
+            if command.record is not None:
+                command.record.read = self.mi.reply_time
+                command.accept_value(value)
+                self.instrumentation.command_completed(command.record)
+            else:
+                command.accept_value(value)
+        elif tag is None:
             self.message_func('Error: received a value without commands')
+        else:
+            self.message_func('Error: received a value for unknown command ' + str(tag))
 
     # method to handle confirmation responses, internal use only, do not call
-    def __confirm_func(self, value):
+    def __confirm_func(self, value, tag=None):
         # note: Python 2.7 does not have switch case statements yet
         if self.state == -1:
             # Invalid
             return
         elif self.state == 0:
             # validating
-            if value == 1:
-                # validation passed
-                self.state = 1
-                self.time_stamp = -1
+            self.__validate(value, tag)
         elif self.state == 1:
             # standby, do nothing
             pass
+        elif self.state == 2 and self.tagged_mode and tag is None:
+            # the previous steps finished before the added steps were confirmed
+            self.last_step_count = value
+            self.state = 1
+            self.time_stamp = -1
+            self.__mirror_drop('getStepTarget')
         elif self.state == 2:
+            # the step command has been confirmed
+            if self.step_record is not None:
+                self.step_record.read = self.mi.reply_time
+                self.instrumentation.command_completed(self.step_record)
+                self.step_record = None
             # update the step target
             self.step_target = value
-            # start stepping
+            self.__mirror_set('getStepTarget', value)
+            # start stepping, or wait for start_armed() if the move has been armed
             self.state = 3
             self.time_stamp = -1
+            arming, self.arming = self.arming, None
+            if arming is not None:
+                self.armed = True
+                arming.accept_value(value)
         elif self.state == 3:
-            # finished stepping
+            # finished stepping, the controller has reset its step target
             self.last_step_count = value
             self.state = 1
+            self.__mirror_set('getStepTarget', 0)
+        self.__notify_state()
+
+    # wakes up the threads waiting for the motor to finish stepping or validating, internal use only, do not call
+    def __notify_state(self):
+        with self.state_condition:
+            self.state_condition.notify_all()
+
+    # method to handle completions of queued moves, called on the reading thread, internal use only, do not call
+    def __move_func(self, value):
+        if self.debug:
+            self.message_func('[DEBUG] Received move completion: \"' + str(value) + '\"')
+        with self.command_lock:
+            move = self.queued_moves.popleft() if len(self.queued_moves) > 0 else None
+        # top up the queue of the controller
+        self.__send_moves()
+        if move is None:
+            self.message_func('Error: received a move completion without queued moves')
+            return
+        move.accept_value(value)
+        self.__check_moves_idle()
+
+    # method to handle commands dropped from the full command queue, internal use only, do not call
+    def __drop_func(self, key):
+        with self.command_lock:
+            command = self.command_callbacks.pop(key, None)
+        if command is not None:
+            self.__notify_tag()
+            command.accept_value(None)
+
+    # wakes up the threads waiting for a free tag, internal use only, do not call
+    def __notify_tag(self):
+        if self.tag_waiting > 0:
+            with self.tag_condition:
+                self.tag_condition.notify_all()
+
+    # waits until a tag is free for a command awaiting a reply, without holding the command lock, as replies must be
+    # handled meanwhile, internal use only, do not call
+    # the thread calling update_tick() never waits, as it frees the tags, its commands fail if no tag is free
+    def __wait_for_tag(self):
+        if not self.tagged_mode or len(self.command_callbacks) < MAX_TAG \
+                or threading.current_thread() is self.tick_thread:
+            return
+        with self.tag_condition:
+            self.tag_waiting += 1
+            while self.is_valid() and len(self.command_callbacks) >= MAX_TAG:
+                self.tag_condition.wait(TICK_INTERVAL)
+            self.tag_waiting -= 1
+
+    # sends held moves while there is room in the queue of the controller, room in the command queue is made before
+    # taking the command lock, the moves stay held if there is none, until the next tick, internal use only, do not call
+    def __send_moves(self):
+        while self.__has_moves_to_send():
+            room = self.mi.make_room()
+            with self.command_lock:
+                if not room or not self.__has_moves_to_send():
+                    return
+                steps, move = self.pending_moves.popleft()
+                self.queued_moves.append(move)
+                self.__queue_string_command('queue ' + str(steps))
+
+    # checks if there are held moves for which the controller has room, internal use only, do not call
+    def __has_moves_to_send(self):
+        return len(self.pending_moves) > 0 and len(self.queued_moves) < MOVE_QUEUE_SIZE
+
+    # removes the moves held on the host, internal use only, do not call
+    # returns the removed moves
+    def __discard_pending_moves(self):
+        with self.command_lock:
+            discarded = [move for steps, move in self.pending_moves]
+            self.pending_moves.clear()
+            return discarded
+
+    # sets the idle event if there are no queued moves left, internal use only, do not call
+    def __check_moves_idle(self):
+        with self.command_lock:
+            if len(self.pending_moves) == 0 and len(self.queued_moves) == 0:
+                self.moves_idle.set()
+
+    # sets the mirrored reply to a query, internal use only, do not call
+    def __mirror_set(self, query, value):
+        with self.command_lock:
+            self.mirror[query] = value
+            self.mirror_versions[query] += 1
+
+    # drops the mirrored replies to the given queries, or to all queries if none are given, internal use only, do not
+    # call
+    def __mirror_drop(self, *queries):
+        with self.command_lock:
+            for query in queries if len(queries) > 0 else MIRRORED_QUERIES:
+                self.mirror.pop(query, None)
+                self.mirror_versions[query] += 1
+
+    # checks if the host can track the reply to a query, the controller changes the direction and step target by
+    # itself while it steps queued moves, internal use only, do not call
+    def __is_mirror_trackable(self, query):
+        return query == 'getDelay' or not self.has_queued_moves()
+
+    # sends a mirrored query to the controller, of which the reply updates the mirror, internal use only, do not call
+    # returns the pending command
+    def __submit_mirrored_query(self, query):
+        with self.command_lock:
+            version = self.mirror_versions[query] if self.__is_mirror_trackable(query) else None
+        command = _MirroredCommand(lambda value: self.__mirror_reply(query, version, value))
+        self.__submit_command(query, command)
+        return command
+
+    # handles the reply to a mirrored query, internal use only, do not call
+    # - version: the version of the mirrored reply when the query was sent, None if it could not be tracked then
+    def __mirror_reply(self, query, version, value):
+        if value is None or version is None:
+            return
+        with self.command_lock:
+            if version != self.mirror_versions[query] or not self.__is_mirror_trackable(query):
+                # the host has changed the value since, or can no longer track it
+                return
+            known = self.mirror.get(query)
+            if known is not None and known != value:
+                # the controller has changed state behind the back of the host, trust none of the mirror
+                self.message_func('State mirror out of date: \"' + query + '\" returned ' + str(value)
+                                  + ' instead of ' + str(known))
+                self.__mirror_drop()
+            self.__mirror_set(query, value)
+
+    # answers a mirrored query from the mirror if its reply is known, and from the controller otherwise, internal use
+    # only, do not call
+    def __read_mirrored(self, query, refresh):
+        if not refresh and self.is_valid():
+            with self.command_lock:
+                value = self.mirror.get(query)
+            if value is not None:
+                if self.instrumentation is not None:
+                    self.instrumentation.count('mirror_hits')
+                return value
+        return self.__wait_for_reply_or_time_out(self.__submit_mirrored_query(query))
+
+    # method to handle confirmations during validation, internal use only, do not call
+    # validation goes through: the capability probe, the handshake, switching the baud rate followed by a new
+    # handshake, and switching to the binary protocol
+    def __validate(self, value, tag):
+        if self.handshake_time >= 0:
+            # the controller is up, its boot no longer counts against the time out
+            self.handshake_time = -1
+            self.time_stamp = time.time()
+            if self.handshake_count > 1:
+                # the later handshakes may be answered as well, their replies come before the reply to a query sent
+                # now, so the validation proper starts on that reply
+                self.handshake_fence = True
+                self.__send_string_command('getStepCount', _Command(self.__fence_handshakes))
+            else:
+                self.__start_validation()
+        elif self.handshake_fence:
+            # late reply to another handshake
+            pass
+        elif tag == 0:
+            # the controller replied to the probe with its capabilities
+            self.capabilities = value
+            self.tagged_mode = self.tagged and (value & CAPABILITY_TAGGED) > 0
+            if self.negotiate_baudrate and (value & CAPABILITY_BAUD_RATE) > 0:
+                self.baud_rates = [rate for rate in BAUD_RATES if rate > self.baud_rate_previous]
+        elif self.baud_rate_request > 0:
+            # the controller replied to the baud rate request
+            rate = self.baud_rate_request
+            self.baud_rate_request = 0
+            if value == rate:
+                # the controller switched, follow it and verify with a new handshake
+                self.baud_rates = []
+                self.baud_rate_check = time.time() + BAUD_RATE_CHECK_TIME
+                if self.mi.set_baudrate(rate):
+                    self.mi.send_command('stepper_control')
+            elif not self.__request_baud_rate():
+                # no other rates to try
+                self.__validate(1, None)
+        elif value == 1:
+            # handshake passed
+            self.baud_rate_check = -1
+            if self.__request_baud_rate():
+                return
+            if self.flow_control and (self.capabilities & CAPABILITY_CREDITS) > 0:
+                # the controller reports the bytes it reads from here on, the request itself is not replied to
+                self.mi.request_credits()
+            if self.binary and (self.capabilities & CAPABILITY_BINARY) > 0 \
+                    and not (self.mi.binary or self.mi.binary_pending):
+                # switch to the binary protocol before completing the validation, the next confirmation confirms it
+                self.time_stamp = time.time()
+                self.mi.request_binary()
+                return
+            # validation passed
+            self.state = 1
+            self.time_stamp = -1
+
+    # requests the next baud rate to negotiate, internal use only, do not call
+    # returns False if there are no rates left to try
+    def __request_baud_rate(self):
+        if len(self.baud_rates) == 0:
+            return False
+        self.baud_rate_request = self.baud_rates.pop(0)
+        self.time_stamp = time.time()
+        self.mi.send_command('baud ' + str(self.baud_rate_request))
+        return True
+
+    # starts the validation proper once the replies to all handshakes are in, internal use only, do not call
+    # - value: the reply to the query sent after them, None if it has timed out, the connection times out then as well
+    def __fence_handshakes(self, value):
+        if self.handshake_fence and self.state == 0 and value is not None:
+            self.handshake_fence = False
+            self.__start_validation()
+
+    # repeats the handshake while the controller has not answered, internal use only, do not call
+    def __check_handshake(self):
+        if 0 <= self.handshake_time and self.handshake_time + HANDSHAKE_INTERVAL <= time.time():
+            self.__send_handshake()
+
+    # sends a handshake to wake the controller, internal use only, do not call
+    def __send_handshake(self):
+        self.handshake_time = time.time()
+        self.handshake_count += 1
+        if self.debug:
+            self.message_func('[DEBUG] Sending command: \"stepper_control\"')
+        self.mi.send_command('stepper_control')
+
+    # starts the validation proper: the capability probe if needed, and the handshake, internal use only, do not call
+    def __start_validation(self):
+        if self.tagged or self.binary or self.negotiate_baudrate or self.flow_control:
+            # probe the capabilities of the controller, these are confirmed under tag 0, old controllers ignore it
+            self.mi.send_command('tagged', 0)
+        self.__send_string_command('stepper_control')
+
+    # checks if the handshake at a new baud rate has timed out, internal use only, do not call
+    def __check_baud_rate(self):
+        if 0 <= self.baud_rate_check <= time.time():
+            # no handshake at the new rate, the controller has reverted by now, revert as well and retry
+            self.message_func('Baud rate switch failed, reverting to ' + str(self.baud_rate_previous) + ' baud')
+            self.baud_rate_check = -1
+            self.mi.set_baudrate(self.baud_rate_previous)
+            self.time_stamp = time.time()
+            self.mi.send_command('stepper_control')
 
     # Clock thread function, internal use only, do not call
     def __clock_func(self):
         while self.mi.is_running():
-            # tick the interface clock
-            self.mi.update_tick()
-            # own update logic
-            if self.time_stamp < 0:
-                # not waiting for a reply, nothing must be done
-                pass
-            # if we are waiting for a confirmation reply, check for timeout
-            elif time.time() - self.time_stamp >= self.time_out:
-                # log message
-                self.message_func('Connection timed out')
-                # toggle flags
-                self.state = -1
-                self.time_stamp = -1
-                # return 'None' on the callbacks
-                for command in self.command_callbacks:
-                    command.accept_value(None)
-                    self.command_callbacks.remove(command)
-                # close the connection
-                self.stop_connection()
+            # tick
+            if not self.update_tick():
                 return
-            # check commands for time outs
-            for command in self.command_callbacks:
-                if command.is_timed_out(self.time_out):
-                    command.accept_value(None)
-                    self.command_callbacks.remove(command)
-            # short delay
-            time.sleep(0.1)
+            # wait for replies, or until the next deadline
+            self.mi.wait_for_data(min(TICK_INTERVAL, max(0, self.get_next_deadline() - time.time())))
         # no longer running: toggle the state:
         self.message_func('Connection lost')
         # toggle flags
         self.state = -1
         self.time_stamp = -1
+        self.__notify_state()
+
+    # tick loop method, called by the clock thread, must be called externally if there is no clock thread
+    # returns False if the connection has timed out and has been closed
+    def update_tick(self):
+        self.tick_thread = threading.current_thread()
+        # tick the interface clock, and send the held moves for which there was no room in the command queue
+        self.mi.update_tick()
+        self.__send_moves()
+        # check the handshake and the baud rate negotiation
+        if self.state == 0:
+            self.__check_handshake()
+            self.__check_baud_rate()
+        # own update logic
+        if self.time_stamp < 0:
+            # not waiting for a reply, nothing must be done
+            pass
+        # if we are waiting for a confirmation reply, check for timeout
+        elif time.time() - self.time_stamp >= self.time_out:
+            # log message
+            self.message_func('Connection timed out')
+            if self.instrumentation is not None:
+                self.instrumentation.count('connection_timeouts')
+            # toggle flags
+            self.state = -1
+            self.time_stamp = -1
+            # close the connection, this returns 'None' on the callbacks
+            self.stop_connection()
+            return False
+        # check commands for time outs, in the order of their deadlines
+        now = time.time()
+        timed_out = []
+        with self.command_lock:
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                deadline, sequence, tag, command = heapq.heappop(self.deadlines)
+                if self.command_callbacks.get(tag) is command:
+                    del self.command_callbacks[tag]
+                    timed_out.append(command)
+        if len(timed_out) > 0:
+            self.__notify_tag()
+        for command in timed_out:
+            command.accept_value(None)
+        if self.instrumentation is not None:
+            if len(timed_out) > 0:
+                self.instrumentation.count('timeouts', len(timed_out))
+            self.instrumentation.update_tick()
+        return True
+
+    # gets the time at which update_tick() has to be called next to handle a time out, as time.time()
+    # returns infinity if nothing can time out
+    def get_next_deadline(self):
+        deadline = float('inf')
+        if self.time_stamp >= 0:
+            deadline = self.time_stamp + self.time_out
+        if self.baud_rate_check >= 0:
+            deadline = min(deadline, self.baud_rate_check)
+        if self.handshake_time >= 0:
+            deadline = min(deadline, self.handshake_time + HANDSHAKE_INTERVAL)
+        with self.command_lock:
+            if len(self.deadlines) > 0:
+                deadline = min(deadline, self.deadlines[0][0])
+        return deadline
 
     # sends a String command to the motor for interpretation, internal use only, do not call
-    def __send_string_command(self, cmd):
-        if self.debug:
-            self.message_func('[DEBUG] Sending command: \"' + cmd + '\"')
-        self.mi.send_command(cmd)
+    # - command: the command object awaiting the reply, if any, which is given a None reply if the command is dropped
+    # returns the instrumentation record of the command, or None if not instrumented or dropped
+    def __send_string_command(self, cmd, command=None):
+        # apply the policy of the command queue before taking the lock, replies must be handled while waiting for room
+        if not self.mi.make_room():
+            return self.__drop_string_command(cmd, command)
+        return self.__queue_string_command(cmd, command)
+
+    # sends a String command which sets the reply to a mirrored query, the mirror is only set once the command has been
+    # queued, internal use only, do not call
+    def __send_setting_command(self, cmd, query, value):
+        if not self.mi.make_room():
+            self.__drop_string_command(cmd)
+            return
+        self.__queue_string_command(cmd)
+        self.__mirror_set(query, value)
+
+    # drops a String command for which there is no room in the command queue, internal use only, do not call
+    # returns None
+    def __drop_string_command(self, cmd, command=None):
+        self.mi.drop_command(cmd)
+        if command is not None:
+            command.accept_value(None)
+        return None
+
+    # queues a String command regardless of the bound of the command queue, with room made for it beforehand, see
+    # __send_string_command(), internal use only, do not call
+    def __queue_string_command(self, cmd, command=None):
+        with self.command_lock:
+            key = self.__next_key(command is not None)
+            if key is not None and command is not None:
+                # add the command to the queue, and its deadline to the heap
+                self.command_callbacks[key] = command
+                self.sequence += 1
+                heapq.heappush(self.deadlines, (command.time_stamp + self.time_out, self.sequence, key, command))
+                if len(self.deadlines) > 2 * len(self.command_callbacks) + 64:
+                    # most entries belong to commands which have been replied to, drop those
+                    self.deadlines = [entry for entry in self.deadlines
+                                      if self.command_callbacks.get(entry[2]) is entry[3]]
+                    heapq.heapify(self.deadlines)
+            if key is not None or command is None:
+                if self.debug:
+                    self.message_func('[DEBUG] Sending command: \"' + cmd + '\"' +
+                                      (' as command ' + str(self.tag) if self.tagged_mode else ''))
+                # the tag is only sent if the controller supports it, the key only if the command awaits a reply
+                record = self.mi.queue_command(cmd, self.tag if self.tagged_mode else None, key)
+                if command is not None:
+                    command.record = record
+                return record
+        self.message_func('Error: no free tag for command \"' + cmd + '\", ' + str(MAX_TAG)
+                          + ' commands are awaiting a reply')
+        command.accept_value(None)
+        return None
+
+    # picks the tag of the next command, with the command lock held, internal use only, do not call
+    # - reply: True if the command awaits a reply, its tag must not be in use then, other commands take any tag
+    # returns the key of the command callback, None if there is no free tag or if the command does not await a reply
+    def __next_key(self, reply):
+        if not self.tagged_mode:
+            if not reply:
+                return None
+            self.key += 1
+            return self.key
+        self.tag = self.tag % MAX_TAG + 1
+        if not reply:
+            return None
+        for i in range(MAX_TAG):
+            if self.tag not in self.command_callbacks:
+                return self.tag
+            self.tag = self.tag % MAX_TAG + 1
+        return None
 
     # submits a String command for sending, expecting a reply, internal use only, do not call
     def __submit_value_command(self, command_string):
@@ -125,27 +615,22 @@ class MotorControl:
 
     # submits a command, internal use only, do not call
     def __submit_command(self, command_string, command):
+        self.__wait_for_tag()
         # check if there is a valid connection
         if self.is_valid():
-            # add the command to the queue
-            self.command_callbacks.append(command)
             # send the string command
-            self.__send_string_command(command_string)
+            self.__send_string_command(command_string, command)
         else:
             # if there is not a valid connection, give the command a None reply
             command.accept_value(None)
 
-    # waits for a response or time_out, internal use, do not call
-
-    # waits for a reply on a value command
+    # waits for a reply on a value command or time_out, internal use, do not call
     def __wait_for_reply_or_time_out(self, value_command):
         # check if it is an actual value command
         if isinstance(value_command, _ValueCommand):
-            while True:
-                if value_command.has_reply():
-                    return value_command.get_value()
-                if value_command.is_timed_out(self.time_out):
-                    return None
+            # sleep until the reply arrives or the deadline of the command has passed
+            if value_command.wait(self.time_out):
+                return value_command.get_value()
         # default to returning None
         return None
 
@@ -153,61 +638,94 @@ class MotorControl:
     def get_port(self):
         return self.mi.get_port()
 
-    # starts up the connection with the motor
-    def start_connection(self):
+    # starts up the connection with the motor, and starts its validation, which is awaited with await_validation()
+    # the controller resets when the port is opened and ignores its input while it boots, so the handshake is repeated
+    # every HANDSHAKE_INTERVAL until the controller answers, or the connection times out
+    # - delay: optional time in seconds to wait before the first handshake
+    # - boot_time: the time in seconds the controller is given to boot before the time out starts
+    def start_connection(self, delay=0, boot_time=BOOT_TIME):
         # start the connection
         running = self.mi.start_connection()
         # check if the connection is running
         if running:
             # start the clock thread
-            self.clock_thread.start()
-            # short delay
-            time.sleep(1)
-            # perform validation test
+            if self.clock_thread is not None:
+                self.clock_thread.start()
+            if delay > 0:
+                time.sleep(delay)
+            # perform validation test, the controller may have been changed or reset since the last connection
+            self.__mirror_drop()
+            self.baud_rate_previous = self.mi.get_baudrate()
+            self.handshake_count = 0
+            self.handshake_fence = False
+            self.time_stamp = time.time() + boot_time
             self.state = 0
-            self.time_stamp = time.time()
-            self.__send_string_command('stepper_control')
+            self.__send_handshake()
         return running
 
-#    # halts program execution until the motor connection has been validated or timed out
-#    def await_validation(self):
-#        while True:
-#            if self.is_validating():
-#                # Motor is still validating, wait a bit longer
-#                time.sleep(1)
-#            else:
-#                # Motor has stopped validating
-#                if self.is_valid():
-#                    return True
-#                else:
-#                    return False
+    # halts program execution until the motor connection has been validated or timed out
+    # returns True if the connection has been validated
+    def await_validation(self):
+        with self.state_condition:
+            while self.is_validating():
+                self.state_condition.wait()
+        return self.is_valid()
 
     # stops the motor connection
     def stop_connection(self):
         self.state = -1
+        self.tagged_mode = False
+        self.capabilities = 0
+        self.handshake_time = -1
+        self.handshake_fence = False
+        self.armed = False
+        self.__mirror_drop()
         self.mi.stop_connection()
+        self.__notify_state()
+        # end the telemetry streams
+        self.mi.telemetry_func = None
+        if self.telemetry is not None:
+            self.telemetry.close()
         # clear all commands
-        for command in self.command_callbacks:
+        with self.command_lock:
+            commands = list(self.command_callbacks.values())
+            self.command_callbacks.clear()
+            self.deadlines = []
+            if self.arming is not None:
+                commands.append(self.arming)
+                self.arming = None
+        self.__notify_tag()
+        for command in commands:
             command.accept_value(None)
-        self.command_callbacks = []
+        # clear all queued moves
+        with self.command_lock:
+            moves = self.__discard_pending_moves() + list(self.queued_moves)
+            self.queued_moves.clear()
+        for move in moves:
+            move.accept_value(None)
+        self.__check_moves_idle()
 
     # sends a command to the motor to execute a number of steps
     # only works if the motor is not currently stepping, or already stepping in the same direction
     # pass in positive value to step clockwise, a negative value to step anti-clockwise
     def do_steps(self, steps):
         if self.is_valid():
-            if self.is_stepping():
+            if self.has_queued_moves():
+                self.message_func('Motor is stepping queued moves, ignoring command')
+            elif self.is_stepping():
                 # motor is already stepping
                 if self.forwards and steps > 0:
                     # forwards: add the steps
                     self.state = 2
                     self.last_step_command += steps
-                    self.__send_string_command('step ' + str(steps))
+                    self.__mirror_drop('getStepTarget')
+                    self.step_record = self.__send_string_command('step ' + str(steps))
                 elif (not self.forwards) and steps < 0:
                     # backwards: add the steps
                     self.state = 2
                     self.last_step_command -= steps
-                    self.__send_string_command('step ' + str(abs(steps)))
+                    self.__mirror_drop('getStepTarget')
+                    self.step_record = self.__send_string_command('step ' + str(abs(steps)))
                 else:
                     self.message_func('Motor is currently stepping in the opposite direction, ignoring command')
             else:
@@ -223,10 +741,12 @@ class MotorControl:
                 else:
                     # we just ignore zero steps
                     return
-                # send the number of steps
+                self.__mirror_set('isForward', 1 if self.forwards else 0)
+                # send the number of steps, the step target is known once the controller confirms it
+                self.__mirror_drop('getStepTarget')
                 self.last_step_count = -1
                 self.last_step_command = abs(steps)
-                self.__send_string_command('step ' + str(abs(steps)))
+                self.step_record = self.__send_string_command('step ' + str(abs(steps)))
                 # start stepping
                 self.state = 2
                 self.time_stamp = time.time()
@@ -237,24 +757,223 @@ class MotorControl:
         # do the steps
         self.do_steps(steps)
         # wait until done stepping
-        while self.is_stepping():
-            # wait
-            time.sleep(0.05)
+        self.wait_finish()
         # return the number of steps
         return self.last_step_count
 
-    # sends a command to the motor to stop stepping
+    # sends a command to the motor to perform a number of steps with an acceleration profile
+    # the step schedule is computed on the host, and uploaded as ramp segments which the controller times in
+    # microseconds, so that the motor can run faster than the step delay allows without losing steps
+    # only works if the motor is not currently stepping, and requires a controller which supports ramps
+    # - steps: the number of steps, positive to step clockwise, negative to step anti-clockwise
+    # - v_max: the maximum speed, in steps per second
+    # - accel: the (peak) acceleration, in steps per second squared
+    # - profile: motion_profile.TRAPEZOIDAL or motion_profile.S_CURVE
+    def move(self, steps, v_max, accel, profile=motion_profile.TRAPEZOIDAL):
+        if not self.is_valid() or steps == 0:
+            return
+        if self.is_stepping() or self.has_queued_moves():
+            self.message_func('Motor is currently stepping, ignoring move')
+            return
+        self.__upload_move(steps, motion_profile.get_segments(abs(steps), v_max, accel, profile))
+        # start stepping
+        self.__send_string_command('start')
+
+    # sets the direction, uploads the ramp segments of a move if it has any, and commits it to the step target, which
+    # is known once the controller confirms it, internal use only, do not call
+    # - segments: the ramp segments, None to add the steps to the step target, to be taken at the step delay
+    def __upload_move(self, steps, segments):
+        # set the direction, unless the mirror knows it has been set already
+        self.forwards = steps > 0
+        with self.command_lock:
+            known = self.mirror.get('isForward') == (1 if self.forwards else 0)
+        if not known:
+            self.__send_setting_command('forwards' if self.forwards else 'backwards', 'isForward',
+                                        1 if self.forwards else 0)
+        # upload the ramp, and commit it to the step target
+        self.__mirror_drop('getStepTarget')
+        for segment in segments or []:
+            self.__send_string_command('ramp ' + ' '.join([str(value) for value in segment]))
+        self.last_step_count = -1
+        self.last_step_command = abs(steps)
+        self.state = 2
+        self.time_stamp = time.time()
+        self.step_record = self.__send_string_command('move' if segments is not None else 'step ' + str(abs(steps)))
+
+    # same as 'move()', but also halts program execution until the motor has finished stepping
+    def move_and_wait_finish(self, steps, v_max, accel, profile=motion_profile.TRAPEZOIDAL):
+        # do the move
+        self.move(steps, v_max, accel, profile)
+        # wait until done stepping
+        self.wait_finish()
+        # return the number of steps
+        return self.last_step_count
+
+    # arms the motor with a move of a number of steps, which is started by start_armed(), so that the commands setting
+    # it up are sent ahead of time, e.g. to start several motors together (see multi_axis.py), or to prepare the next
+    # move of a scan while measuring (see scan.py)
+    # only works if the motor is not currently stepping
+    # - steps: the number of steps, positive to step clockwise, negative to step anti-clockwise
+    # - segments: optional ramp segments of (steps, first interval, last interval), see motion_profile.py, of which the
+    #   steps add up to the number of steps, requires a controller which supports ramps, without them the motor steps
+    #   at the step delay as with do_steps()
+    # returns the pending arming, of which the value is the step target confirmed by the controller, None if the motor
+    # has not been armed
+    def arm(self, steps, segments=None):
+        arming = _ValueCommand()
+        if not self.is_valid() or steps == 0:
+            arming.accept_value(None)
+        elif self.is_stepping() or self.has_queued_moves():
+            self.message_func('Motor is currently stepping, ignoring move')
+            arming.accept_value(None)
+        else:
+            self.arming = arming
+            self.__upload_move(steps, segments)
+        return arming
+
+    # starts the move the motor has been armed with, the start command is written to the port right away on the
+    # calling thread, so that several motors are started in a tight burst
+    # returns the time (as time.time()) at which the start command was handed to the port, or None if it has been
+    # queued, or if the motor is not armed
+    def start_armed(self):
+        if not self.armed:
+            return None
+        self.armed = False
+        if self.debug:
+            self.message_func('[DEBUG] Sending command: \"start\"')
+        return self.mi.write_command('start')
+
+    # disarms the motor, the controller is reset, as it does not confirm a stop while it is not stepping, internal use
+    # only, do not call
+    def __disarm(self):
+        arming, self.arming = self.arming, None
+        self.armed = False
+        self.state = 1
+        self.time_stamp = -1
+        self.__mirror_set('getStepTarget', 0)
+        self.__send_string_command('reset')
+        if arming is not None:
+            arming.accept_value(None)
+        self.__notify_state()
+
+    # queues a move of a number of steps, which the motor steps at the step delay once the moves queued before it have
+    # been completed, changing direction by itself where needed
+    # the controller queues up to MOVE_QUEUE_SIZE moves, further moves are held on the host, and sent as the
+    # controller completes its moves, so that the motor does not idle between them
+    # requires a controller which supports the move queue
+    # - steps: positive to step clockwise, negative to step anti-clockwise
+    # - callback: optional function called with the number of steps taken once the move has been completed, this is
+    #   0 if the move has been discarded, and None if the connection has been lost
+    # returns the pending move, of which the value is the number of steps taken, await all moves with wait_idle()
+    def enqueue_move(self, steps, callback=None):
+        move = _MoveCommand(callback)
+        if not self.is_valid():
+            move.accept_value(None)
+        elif steps == 0:
+            move.accept_value(0)
+        else:
+            with self.command_lock:
+                self.moves_idle.clear()
+                # the controller changes direction and step target by itself from here on
+                self.__mirror_drop('isForward', 'getStepTarget')
+                self.pending_moves.append((steps, move))
+            self.__send_moves()
+        return move
+
+    # discards the queued moves which have not been started yet, the move being stepped is completed
+    # the discarded moves are completed with 0 steps
+    def flush(self):
+        self.__wait_for_tag()
+        # make room for the flush before taking the lock
+        room = self.mi.make_room() if len(self.queued_moves) > 0 else True
+        with self.command_lock:
+            discarded = self.__discard_pending_moves()
+            if len(self.queued_moves) > 0 and self.is_valid():
+                # the controller replies with the number of moves it discarded, which are the last ones it received
+                moves = list(self.queued_moves)
+                command = _Command(lambda count: self.__flushed(moves, count))
+                if room:
+                    self.__queue_string_command('flush', command)
+                else:
+                    self.__drop_string_command('flush', command)
+        for move in discarded:
+            move.accept_value(0)
+        self.__check_moves_idle()
+
+    # handles the reply to a flush, internal use only, do not call
+    # - moves: the moves which were queued on the controller when flushing
+    # - count: the number of these moves the controller discarded
+    def __flushed(self, moves, count):
+        if count is None or count <= 0:
+            return
+        discarded = moves[-count:]
+        with self.command_lock:
+            for move in discarded:
+                if move in self.queued_moves:
+                    self.queued_moves.remove(move)
+        for move in discarded:
+            move.accept_value(0)
+        self.__check_moves_idle()
+
+    # halts program execution until all queued moves have been completed, or the time out (in seconds) has passed
+    # - time_out: the time out, None to wait indefinitely
+    # returns True if all queued moves have been completed
+    def wait_idle(self, time_out=None):
+        return self.moves_idle.wait(time_out)
+
+    # sends a command to the motor to stop stepping, this discards all queued moves as well, and disarms the motor
     def stop_stepping(self):
-        if self.is_stepping():
+        stop = False
+        if self.arming is not None or self.armed:
+            self.__disarm()
+        elif self.is_stepping():
             # toggle flags
             self.state = 3
             self.time_stamp = -1
-            # send stop command
-            self.__send_string_command('stop')
+            stop = True
+        # make room for the stop before taking the lock
+        room = self.mi.make_room() if stop or len(self.queued_moves) > 0 else True
+        with self.command_lock:
+            discarded = self.__discard_pending_moves()
+            if len(self.queued_moves) > 0:
+                # the controller completes the move being stepped, and discards the others
+                stop = True
+            if stop:
+                # send stop command
+                if room:
+                    self.__queue_string_command('stop')
+                else:
+                    self.__drop_string_command('stop')
+        for move in discarded:
+            move.accept_value(0)
+        self.__check_moves_idle()
+
+    # halts program execution until the motor has finished stepping, queued moves excluded, or the time out (in
+    # seconds) has passed, an armed motor finishes once it has been started and completed its move
+    # - time_out: the time out, None to wait indefinitely
+    # returns True if the motor is not stepping
+    def wait_finish(self, time_out=None):
+        deadline = None if time_out is None else time.time() + time_out
+        with self.state_condition:
+            while self.is_stepping():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.state_condition.wait(remaining)
+        return True
 
     # sets the stepping delay, minimum value is 2
     def set_step_delay(self, delay):
-        self.__send_string_command('delay ' + str(delay))
+        if not isinstance(delay, numbers.Integral):
+            # the controller reads the leading digits of the delay in the text protocol, and rejects it in the binary
+            # protocol, ask it next time
+            self.__send_string_command('delay ' + str(delay))
+            self.__mirror_drop('getDelay')
+        elif delay > 1:
+            self.__send_setting_command('delay ' + str(delay), 'getDelay', int(delay))
+        else:
+            # the controller ignores smaller delays
+            self.__send_string_command('delay ' + str(delay))
 
     # sends a command to the motor to query its current step count
     # halts program execution until a reply has been received, or the connection has timed out
@@ -273,41 +992,68 @@ class MotorControl:
     def get_last_step_command(self):
         return self.last_step_command
 
-    # sends a command to the motor to query its current step target
+    # gets the motor's current step target, from the state mirror if the host knows it, or else by sending a command
+    # to query the motor
     # halts program execution until a reply has been received, or the connection has timed out
+    # - refresh: when True, the motor is always queried
     # returns None if the connection has been lost or is timed out
-    def get_step_target(self):
-        # send the command
-        command = self.__submit_value_command('getStepTarget')
-        # wait for response or timeout
-        return self.__wait_for_reply_or_time_out(command)
+    def get_step_target(self, refresh=False):
+        return self.__read_mirrored('getStepTarget', refresh)
 
-    # sends a command to the motor to query if it's running clockwise
+    # gets if the motor is running clockwise, from the state mirror if the host knows it, or else by sending a command
+    # to query the motor
     # halts program execution until a reply has been received, or the connection has timed out
+    # - refresh: when True, the motor is always queried
     # returns None if the connection has been lost or is timed out
-    def is_forwards(self):
-        # send the command
-        command = self.__submit_value_command('isForward')
-        # wait for response or timeout
-        return self.__wait_for_reply_or_time_out(command)
+    def is_forwards(self, refresh=False):
+        return self.__read_mirrored('isForward', refresh)
 
-    # sends a command to the motor to query if it's running anti-clockwise
+    # gets if the motor is running anti-clockwise, from the state mirror if the host knows it, or else by sending a
+    # command to query the motor
     # halts program execution until a reply has been received, or the connection has timed out
+    # - refresh: when True, the motor is always queried
     # returns None if the connection has been lost or is timed out
-    def is_backwards(self):
-        # send the command
-        command = self.__submit_value_command('isBackward')
-        # wait for response or timeout
-        return self.__wait_for_reply_or_time_out(command)
+    def is_backwards(self, refresh=False):
+        forwards = self.__read_mirrored('isForward', refresh)
+        return None if forwards is None else 1 - forwards
 
-    # sends a command to the motor to query its current step delay
+    # gets the motor's current step delay, from the state mirror if the host knows it, or else by sending a command
+    # to query the motor
     # halts program execution until a reply has been received, or the connection has timed out
+    # - refresh: when True, the motor is always queried
     # returns None if the connection has been lost or is timed out
-    def get_delay(self):
-        # send the command
-        command = self.__submit_value_command('getDelay')
-        # wait for response or timeout
-        return self.__wait_for_reply_or_time_out(command)
+    def get_delay(self, refresh=False):
+        return self.__read_mirrored('getDelay', refresh)
+
+    # sends a command to the motor to query its current step count, without halting program execution
+    # returns the pending command, of which the value can be awaited with wait_for_replies()
+    def query_step_count(self):
+        return self.__submit_value_command('getStepCount')
+
+    # sends a command to the motor to query its current step target, without halting program execution
+    # returns the pending command, of which the value can be awaited with wait_for_replies()
+    def query_step_target(self):
+        return self.__submit_mirrored_query('getStepTarget')
+
+    # sends a command to the motor to query if it's running clockwise, without halting program execution
+    # returns the pending command, of which the value can be awaited with wait_for_replies()
+    def query_forwards(self):
+        return self.__submit_mirrored_query('isForward')
+
+    # sends a command to the motor to query if it's running anti-clockwise, without halting program execution
+    # returns the pending command, of which the value can be awaited with wait_for_replies()
+    def query_backwards(self):
+        return self.__submit_value_command('isBackward')
+
+    # sends a command to the motor to query its current step delay, without halting program execution
+    # returns the pending command, of which the value can be awaited with wait_for_replies()
+    def query_delay(self):
+        return self.__submit_mirrored_query('getDelay')
+
+    # halts program execution until all given pending commands have been replied to, or have timed out
+    # returns a list with the values of the commands, in the same order, None for commands which timed out
+    def wait_for_replies(self, commands):
+        return [self.__wait_for_reply_or_time_out(command) for command in commands]
 
     # polls the step count by sending a command to query its current step count
     # the callback function is called whenever the reply is received
@@ -344,6 +1090,37 @@ class MotorControl:
         # submit the command
         self.__submit_command('getDelay', _Command(callback))
 
+    # subscribes to the step count telemetry: while stepping, the controller pushes its step count without being polled
+    # the samples are stored as (time stamp, step count) in a ring buffer as soon as they arrive
+    # requires a controller which supports telemetry
+    # - interval: time in milliseconds between the samples, 0 for none
+    # - steps: number of steps between the samples, 0 for none
+    # - size: the number of samples the buffer keeps
+    # returns the TelemetryBuffer, or None if there is no valid connection
+    def subscribe_step_count(self, interval=50, steps=0, size=4096):
+        if not self.is_valid():
+            return None
+        if self.telemetry is not None:
+            self.telemetry.close()
+        self.telemetry = TelemetryBuffer(size)
+        self.mi.telemetry_func = self.telemetry.append
+        self.__send_string_command('telemetry ' + str(interval))
+        self.__send_string_command('telemetrySteps ' + str(steps))
+        return self.telemetry
+
+    # stops the step count telemetry, the buffer keeps its samples, but its streams end
+    def unsubscribe_step_count(self):
+        if self.telemetry is not None:
+            if self.is_valid():
+                self.__send_string_command('telemetry 0')
+                self.__send_string_command('telemetrySteps 0')
+            self.mi.telemetry_func = None
+            self.telemetry.close()
+
+    # gets the TelemetryBuffer of the last subscription, or None if there has not been one
+    def get_telemetry(self):
+        return self.telemetry
+
     # checks if the motor control is in a valid state, meaning it is connected to the controller with an open connection
     def is_valid(self):
         return self.state > 0
@@ -356,26 +1133,53 @@ class MotorControl:
     def is_valid_or_validating(self):
         return self.state >= 0
 
-    # checks if the motor is currently stepping
+    # checks if the motor is currently stepping, queued moves excluded
     def is_stepping(self):
         return self.state >= 2
 
+    # checks if the motor is armed with a move which has not been started yet
+    def is_armed(self):
+        return self.armed
+
+    # checks if there are queued moves which have not been completed yet
+    def has_queued_moves(self):
+        return not self.moves_idle.is_set()
+
+    # drops the state mirror, so that the next queries are answered by the motor, e.g. after commands have been sent
+    # to the motor interface directly
+    def invalidate_mirror(self):
+        self.__mirror_drop()
+
 
 # Helper class to treat and queue commands to the motor
 class _Command:
     def __init__(self, callback):
         self.callback = callback
-        self.reply = False
+        self.reply = threading.Event()
         self.time_stamp = time.time()
+        # instrumentation record, if instrumented
+        self.record = None
 
     # called when a reply has been received
     def accept_value(self, value):
         self.callback(value)
-        self.reply = True
+        self.reply.set()
 
     # checks if a reply has been received
     def has_reply(self):
-        return self.reply
+        return self.reply.is_set()
+
+    # halts until a reply has been received, or the command has timed out
+    # the time out itself is up to the clock, which handles the replies which have arrived before it checks the time
+    # outs, so past the limit this waits up to another tick for its verdict, in case the program held the GIL
+    # returns True if a reply has been received
+    def wait(self, limit):
+        remaining = self.time_stamp + limit - time.time()
+        if remaining > 0:
+            self.reply.wait(remaining)
+        if not self.reply.is_set():
+            self.reply.wait(TICK_INTERVAL)
+        return self.reply.is_set()
 
     # checks if the command has timed out
     def is_timed_out(self, limit):
@@ -397,3 +1201,32 @@ class _ValueCommand(_Command):
     # getter for the reply value
     def get_value(self):
         return self.value
+
+
+# Helper class for mirrored queries, storing the reply on the object itself, and passing it on to the state mirror
+class _MirroredCommand(_ValueCommand):
+    def __init__(self, callback):
+        # call super constructor
+        _ValueCommand.__init__(self)
+        # callback updating the state mirror
+        self.mirror_callback = callback
+
+    # setter for the reply value, which is passed on to the callback
+    def set_value(self, value):
+        self.value = value
+        self.mirror_callback(value)
+
+
+# Helper class for queued moves, storing the number of steps taken on the object itself
+class _MoveCommand(_ValueCommand):
+    def __init__(self, callback=None):
+        # call super constructor
+        _ValueCommand.__init__(self)
+        # optional callback for the number of steps taken
+        self.move_callback = callback
+
+    # setter for the reply value, which is passed on to the callback
+    def set_value(self, value):
+        self.value = value
+        if self.move_callback is not None:
+            self.move_callback(value)
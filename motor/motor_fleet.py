@@ -0,0 +1,331 @@
+import os
+import selectors
+import threading
+import time
+import traceback
+
+import serial
+from serial.serialutil import SerialException
+
+from .motor_control import MotorControl, TICK_INTERVAL, BOOT_TIME
+from .motor_interface import MotorInterface, BLOCK, QUEUE_SIZE
+
+
+# Motor interface of which the serial port is read and written by the I/O loop of a MotorFleet instead of by threads
+class FleetMotorInterface(MotorInterface):
+    def __init__(self, fleet, port, value_func, confirm_func, message_func, baudrate=9600, queue_size=QUEUE_SIZE,
+                 policy=BLOCK):
+        # call super constructor (its threads are never started)
+        MotorInterface.__init__(self, port, value_func, confirm_func, message_func, baudrate, queue_size, policy)
+        # the fleet running the I/O loop
+        self.fleet = fleet
+        # file descriptor of the port, as registered with the I/O loop
+        self.fd = -1
+        # buffers for incoming and outgoing bytes
+        self.read_buffer = bytearray()
+        self.write_buffer = bytearray()
+
+    # reads all available bytes and handles the complete lines, called from the I/O loop, do not call
+    def read_available(self):
+        try:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+        except (SerialException, OSError):
+            self.message_func('Error while reading serial port ' + str(self.get_port()))
+            self.message_func(traceback.format_exc())
+            self.running = False
+            return
+        if self.instrumentation is not None:
+            self.instrumentation.count('bytes_read', len(data))
+        self.read_buffer.extend(data)
+        # handle all complete lines or frames
+        self.handle_buffer(self.read_buffer)
+
+    # writes as much of the queued commands as the port accepts, called from the I/O loop, do not call
+    # returns True if there are bytes left to write
+    def write_pending(self):
+        with self.write_lock:
+            # gather the queued commands which the controller has room for, the others wait for its next credit report
+            commands, data, self.held_command = self.take_commands(self.held_command)
+            self.write_buffer.extend(data)
+            records = [command[2] for command in commands]
+            if len(self.write_buffer) == 0:
+                return False
+            # write without blocking
+            try:
+                written = os.write(self.fd, self.write_buffer)
+            except (BlockingIOError, InterruptedError):
+                written = 0
+            except OSError:
+                self.message_func('Error sending commands over port ' + str(self.get_port()))
+                self.message_func(traceback.format_exc())
+                self.running = False
+                return False
+            del self.write_buffer[0:written]
+            if self.instrumentation is not None and (written > 0 or len(records) > 0):
+                # the commands count as written once they have been handed to the port
+                self.instrumentation.commands_written(records, written)
+            return len(self.write_buffer) > 0
+
+    # checks if there are no commands waiting to be written, with the write lock held
+    def is_write_idle(self):
+        return len(self.write_buffer) == 0 and MotorInterface.is_write_idle(self)
+
+    # writes a command to the port right away on the calling thread, see MotorInterface.write_command()
+    # a command which has to be queued is written by the I/O loop
+    def write_command(self, cmd, tag=None, key=None):
+        written = MotorInterface.write_command(self, cmd, tag, key)
+        if written is None:
+            self.fleet.wake(self)
+        return written
+
+    # queues a command to be sent, and wakes up the I/O loop to send it
+    def queue_command(self, cmd, tag=None, key=None):
+        record = MotorInterface.queue_command(self, cmd, tag, key)
+        self.fleet.wake(self)
+        return record
+
+    # handles the report of the number of bytes the controller has read, and sends the commands which waited for it
+    def handle_credit(self, count):
+        MotorInterface.handle_credit(self, count)
+        if self.held_command is not None:
+            self.fleet.wake(self)
+
+    # checks if the current thread is the one reading the port, which is the I/O thread of the fleet
+    def is_reading_thread(self):
+        return threading.current_thread() is self.fleet.io_thread
+
+    # method to start the connection, the port is registered with the I/O loop of the fleet
+    def start_connection(self):
+        if self.ser is None:
+            try:
+                self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=0)
+            except SerialException:
+                print(traceback.format_exc())
+                self.ser = None
+                return False
+            self.fd = self.ser.fileno()
+            self.running = True
+            self.fleet.wake(self)
+            return True
+        return self.running
+
+    # method to stop the connection, the port is closed by the I/O loop
+    def stop_connection(self):
+        self.running = False
+        self.fleet.wake(self)
+
+
+# Class to control many stepper motors, multiplexing all of their serial ports on a single I/O thread
+# Each motor is operated through a regular MotorControl object, obtained with add_motor()
+# Note: serial ports can only be selected on POSIX systems
+# The options are those of MotorControl, and apply to all motors
+class MotorFleet:
+    def __init__(self, time_out, message_func, debug=False, tagged=False, binary=False, baudrate=9600,
+                 negotiate_baudrate=False, flow_control=False, queue_size=QUEUE_SIZE, policy=BLOCK):
+        # message callback function
+        self.message_func = message_func
+        # time out limit of the motors
+        self.time_out = time_out
+        # debug mode of the motors
+        self.debug = debug
+        # whether the motors negotiate the tagged and binary protocols
+        self.tagged = tagged
+        self.binary = binary
+        # initial baud rate of the motors, and whether they negotiate a faster one
+        self.baudrate = baudrate
+        self.negotiate_baudrate = negotiate_baudrate
+        # flow control, and the bounds of the buffers of the motors
+        self.flow_control = flow_control
+        self.queue_size = queue_size
+        self.policy = policy
+        # motor controls, by port
+        self.motors = {}
+        # selector for the I/O loop, and the pipe used to wake it up
+        self.selector = selectors.DefaultSelector()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+        # interfaces which have to be (un)registered or have commands to write
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        # Run flag
+        self.running = False
+        # Thread running the I/O loop
+        self.io_thread = threading.Thread(target=self.__io_func)
+
+    # I/O thread function, internal use only, do not call
+    def __io_func(self):
+        next_tick = 0
+        while self.running:
+            ticked = set()
+            # wait for I/O, or until the next periodic tick or time out of a motor, unless the loop itself left
+            # interfaces pending
+            deadline = min([next_tick] + [motor.get_next_deadline() for motor in list(self.motors.values())])
+            if len(self.pending) > 0:
+                deadline = 0
+            for key, mask in self.selector.select(min(TICK_INTERVAL, max(0, deadline - time.time()))):
+                interface = key.data
+                if interface is None:
+                    # woken up
+                    try:
+                        while os.read(self.wake_read, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ:
+                        interface.read_available()
+                        ticked.add(interface)
+                    if mask & selectors.EVENT_WRITE:
+                        self.__update_interface(interface)
+                except Exception:
+                    self.__fail_interface(interface)
+            # register, unregister or write the interfaces which woke up the loop
+            with self.pending_lock:
+                pending = self.pending
+                self.pending = set()
+            for interface in pending:
+                try:
+                    self.__update_interface(interface)
+                except Exception:
+                    self.__fail_interface(interface)
+            # handle the replies right away, time outs at their deadline, and check all motors periodically
+            now = time.time()
+            for motor in list(self.motors.values()):
+                if now >= next_tick or motor.mi in ticked or motor.get_next_deadline() <= now:
+                    try:
+                        self.__tick_motor(motor)
+                    except Exception:
+                        self.__fail_interface(motor.mi)
+            if now >= next_tick:
+                next_tick = now + TICK_INTERVAL
+
+    # stops an interface of which the I/O has failed, the other motors carry on, internal use only, do not call
+    def __fail_interface(self, interface):
+        interface.message_func('Error on serial port ' + str(interface.get_port()))
+        interface.message_func(traceback.format_exc())
+        interface.running = False
+        # the port is closed when its motor notices the lost connection
+        try:
+            self.selector.unregister(interface.fd)
+        except (KeyError, ValueError):
+            pass
+
+    # updates the registration of an interface with the selector, internal use only, do not call
+    def __update_interface(self, interface):
+        registered = interface.fd in self.selector.get_map()
+        if not interface.is_running():
+            # stopped: close the port
+            if registered:
+                self.selector.unregister(interface.fd)
+            if interface.ser is not None:
+                interface.ser.close()
+            return
+        events = selectors.EVENT_READ
+        if interface.write_pending():
+            # wait until the port is writable for the remainder
+            events = events | selectors.EVENT_WRITE
+        if not registered:
+            self.selector.register(interface.fd, events, interface)
+        elif self.selector.get_key(interface.fd).events != events:
+            self.selector.modify(interface.fd, events, interface)
+
+    # ticks a motor, internal use only, do not call
+    def __tick_motor(self, motor):
+        if motor.mi.is_running():
+            motor.update_tick()
+        elif motor.is_valid_or_validating():
+            # connection dropped
+            motor.message_func('Connection lost')
+            motor.stop_connection()
+
+    # wakes up the I/O loop to handle the given interface, internal use, do not call
+    def wake(self, interface=None):
+        if interface is not None:
+            with self.pending_lock:
+                self.pending.add(interface)
+            if threading.current_thread() is self.io_thread:
+                # the I/O loop handles the pending interfaces before it waits again
+                return
+        try:
+            os.write(self.wake_write, b'\0')
+        except BlockingIOError:
+            # the loop has plenty of wake up calls already
+            pass
+
+    # creates a motor control for the given port, the connection is opened by start_connections()
+    # - message_func: optional message callback for this motor, defaults to the message function of the fleet
+    # - instrumentation: optional Instrumentation object for this motor
+    def add_motor(self, port, message_func=None, instrumentation=None):
+        if message_func is None:
+            message_func = self.message_func
+        motor = MotorControl(port, self.time_out, message_func, self.debug,
+                             interface_factory=lambda *args, **kwargs: FleetMotorInterface(self, *args, **kwargs),
+                             clock=False, tagged=self.tagged, binary=self.binary, baudrate=self.baudrate,
+                             negotiate_baudrate=self.negotiate_baudrate, flow_control=self.flow_control,
+                             queue_size=self.queue_size, policy=self.policy, instrumentation=instrumentation)
+        self.motors[port] = motor
+        return motor
+
+    # gets the motor control for the given port
+    def get_motor(self, port):
+        return self.motors.get(port)
+
+    # gets a list of all motor controls
+    def get_motors(self):
+        return list(self.motors.values())
+
+    # starts the I/O loop
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.io_thread.start()
+
+    # opens the connections of all motors which are not running yet and starts their validation, each motor repeats
+    # its handshake until its controller has booted, see MotorControl.start_connection()
+    # - delay: optional time in seconds to wait before the first handshakes, which the controllers share
+    # - boot_time: the time in seconds the controllers are given to boot before the time out starts
+    # returns True if all ports could be opened
+    def start_connections(self, delay=0, boot_time=BOOT_TIME):
+        self.start()
+        motors = [motor for motor in self.motors.values() if not motor.mi.is_running()]
+        opened = [motor for motor in motors if motor.mi.start_connection()]
+        if delay > 0:
+            time.sleep(delay)
+        for motor in opened:
+            motor.start_connection(boot_time=boot_time)
+        return len(opened) == len(motors)
+
+    # stops the connections of all motors, and the I/O loop
+    def stop(self):
+        for motor in self.motors.values():
+            motor.stop_connection()
+        self.running = False
+        self.wake()
+        if self.io_thread.is_alive() and threading.current_thread() is not self.io_thread:
+            self.io_thread.join()
+        # close the ports and the selector
+        for motor in self.motors.values():
+            if motor.mi.ser is not None:
+                motor.mi.ser.close()
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    # queries the step count of all motors at once
+    # halts program execution until all replies have been received, or the commands have timed out
+    # returns a dictionary with the step count for each port, None for motors which did not reply
+    def get_step_counts(self):
+        queries = [(port, motor.query_step_count()) for port, motor in self.motors.items()]
+        return dict((port, self.motors[port].wait_for_replies([command])[0]) for port, command in queries)
+
+    # tells all stepping motors to stop stepping
+    def stop_stepping(self):
+        for motor in self.motors.values():
+            motor.stop_stepping()
+
+    # checks if any of the motors is currently stepping
+    def is_stepping(self):
+        return any(motor.is_stepping() for motor in self.motors.values())
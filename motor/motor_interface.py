@@ -2,21 +2,101 @@ import serial
 import threading
 import time
 import traceback
+from collections import deque
 from serial.serialutil import SerialException
+from . import binary_protocol
+try:
+    import queue
+except ImportError:
+    # Python 2.7
+    import Queue as queue
+
+# policies when the command queue is full: wait for room, drop the oldest queued command, or raise queue.Full
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+RAISE = 'raise'
+# default number of commands to queue, the replies are buffered without a bound
+QUEUE_SIZE = 256
+# size of the serial receive buffer of the controller, in bytes
+RX_BUFFER_SIZE = 64
+# the controller reports the bytes it has read once they add up to this, smaller amounts are held back
+CREDIT_BATCH = 16
+# bytes of the reply prefixes '[<type>]' of the text protocol, and of the carriage return ending the lines
+PREFIX_OPEN = ord('[')
+PREFIX_CLOSE = ord(']')
+MESSAGE = ord('m')
+VALUE = ord('v')
+CONFIRMATION = ord('c')
+TELEMETRY = ord('t')
+MOVE = ord('q')
+CREDIT = ord('k')
+CR = ord('\r')
+
+
+# converts received bytes to a native string, which is a byte string on Python 2 and text on Python 3
+def _native_string(data):
+    if bytes is str:
+        # Python 2.7
+        return str(data)
+    return data.decode('ascii', 'replace')
 
 
 # Class to interface with the stepper motor using String commands
+# - queue_size: the number of commands to queue, 0 for an unbounded queue
+# - policy: what send_command() does when the command queue is full: BLOCK, DROP_OLDEST or RAISE
 class MotorInterface:
-    def __init__(self, port, value_func, confirm_func, message_func):
+    def __init__(self, port, value_func, confirm_func, message_func, baudrate=9600, queue_size=QUEUE_SIZE,
+                 policy=BLOCK):
         # Serial
         self.port = port
+        self.baudrate = baudrate
         self.ser = None
+        # lock of closing the port, as the clock thread closes it on a time out while the program may close it as well
+        self.close_lock = threading.Lock()
         # Run flag
         self.running = False
-        # Buffers
-        self.command_buffer = []
-        self.value_buffer = []
-        self.confirmation_buffer = []
+        # Binary protocol flags: in use, and requested but not yet confirmed
+        self.binary = False
+        self.binary_pending = False
+        # Buffers (the command buffer is a blocking queue, the writer sleeps until a command arrives)
+        # commands are buffered as (cmd, tag, record, key) tuples, replies as (value, tag, read time) tuples
+        self.command_buffer = queue.Queue()
+        self.value_buffer = deque()
+        self.confirmation_buffer = deque()
+        # bound of the command queue, and the policy for a full command queue
+        # the reply buffers are not bounded, as the reading thread must keep reading for the writing thread to get
+        # credit, they only hold the replies to the commands sent, which the bound of the command queue holds back
+        self.queue_size = queue_size
+        self.policy = policy
+        # Optional callback for commands dropped by the DROP_OLDEST policy, accepting the key they were sent with
+        self.drop_func = None
+        # flow control: the bytes the controller can receive (None while disabled), the window requested, the bytes
+        # sent which the controller has not reported as read yet, and those of the request itself, which take room in
+        # the receive buffer but are read before the controller starts counting, until the controller first reports
+        self.credit_window = None
+        self.credit_request = 0
+        self.in_flight = 0
+        self.credit_debt = 0
+        # condition to wait for room in the command queue or for credit, and the number of threads waiting for room
+        self.flow_condition = threading.Condition()
+        self.flow_waiting = 0
+        # Optional instrumentation, set by the MotorControl, and the read time of the reply being dispatched
+        self.instrumentation = None
+        self.reply_time = None
+        # the thread calling update_tick(), which dispatches the replies
+        self.tick_thread = None
+        # Optional callback for telemetry samples, accepting a time stamp and the step count, which is called on the
+        # reading thread as soon as a sample arrives
+        self.telemetry_func = None
+        # Optional callback for the completions of queued moves, accepting the number of steps taken, which is called on
+        # the reading thread as soon as a completion arrives
+        self.move_func = None
+        # Event which is set whenever a value or confirmation has been buffered
+        self.data_event = threading.Event()
+        # lock of the writes to the port, so that commands can be written on the calling thread as well, and the command
+        # taken from the queue which waits for the controller to have room for it
+        self.write_lock = threading.Lock()
+        self.held_command = None
         # Callbacks
         self.value_func = value_func
         self.confirm_func = confirm_func
@@ -28,70 +108,259 @@ class MotorInterface:
 
     # method for reading, to be ran on a separate thread, internal use only, do not call
     def __read_func(self):
+        # received bytes, the complete lines or frames are handled as they arrive, the rest is kept for the next read
+        buffer = bytearray()
         while self.running:
-            # read the line
+            # wait for the first byte (at most the read time out), then take everything which has arrived in one go
             try:
-                ln = self.ser.readline()
+                data = self.ser.read(max(1, self.ser.in_waiting))
             except SerialException:
-                self.message_func('Error while reading serial port ' + str(self.get_port()))
-                self.message_func(traceback.format_exc())
-                self.running = False
+                if self.running:
+                    self.message_func('Error while reading serial port ' + str(self.get_port()))
+                    self.message_func(traceback.format_exc())
+                    self.running = False
                 continue
-            if ln == '' or ln is None:
-                # if the line is empty, simply do nothing
+            if not data:
+                # timed out, simply do nothing
                 continue
+            if self.instrumentation is not None:
+                self.instrumentation.count('bytes_read', len(data))
+            buffer.extend(data)
+            self.handle_buffer(buffer)
+
+    # handles the complete lines or frames in a buffer of received bytes, and removes them from the buffer
+    # the lines are parsed in place, the buffer is only shifted once, and the protocol can switch halfway
+    # called by the reading thread, or by external readers
+    # - buffer: a bytearray, the incomplete line or frame at its end is kept for the next call
+    def handle_buffer(self, buffer):
+        start = 0
+        while True:
+            binary = self.binary
+            end = buffer.find(binary_protocol.DELIMITER if binary else b'\n', start)
+            if end < 0:
+                break
+            if binary:
+                self.__handle_frame(buffer, start, end)
             else:
-                # if the line starts with a prefix, handle accordingly
-                prefix = ln[0:3]
-                if prefix == '[m]':
-                    # handle the message
-                    self.__handle_message(ln[3:])
-                elif prefix == '[v]':
-                    # handle a value
-                    try:
-                        self.__handle_value(int(ln[3:]))
-                    except ValueError:
-                        self.__handle_invalid_value(ln[3:])
-                elif prefix == '[c]':
-                    # handle a confirmation
-                    try:
-                        self.__handle_confirmation(int(ln[3:]))
-                    except ValueError:
-                        self.__handle_invalid_value(ln[3:])
-
-            # short delay
-            time.sleep(0.05)
+                self.__handle_line(buffer, start, end)
+            start = end + 1
+        if start > 0:
+            del buffer[0:start]
+
+    # handles a line received from the controller, called by external readers
+    def handle_line(self, ln):
+        if not isinstance(ln, bytes):
+            # text on Python 3, unicode on Python 2
+            ln = ln.encode('ascii', 'replace')
+        ln = bytearray(ln)
+        self.__handle_line(ln, 0, len(ln))
+
+    # handles the line from start to end (exclusive) in a bytearray, internal use only, do not call
+    # the prefix is compared byte by byte, so that the line is not copied, which works the same on Python 2 and 3 as
+    # indexing a bytearray yields integers on both
+    def __handle_line(self, buffer, start, end):
+        if self.instrumentation is not None:
+            self.instrumentation.count('lines_read')
+        # lines end with '\r\n'
+        if end > start and buffer[end - 1] == CR:
+            end -= 1
+        if end - start < 3 or buffer[start] != PREFIX_OPEN or buffer[start + 2] != PREFIX_CLOSE:
+            # not a reply, ignore it
+            return
+        reply = buffer[start + 1]
+        start += 3
+        if reply == MESSAGE:
+            # handle the message
+            self.__handle_message(_native_string(buffer[start:end]))
+            return
+        try:
+            if reply == VALUE:
+                # handle a value
+                self.__handle_value(self.__parse_reply(buffer, start, end))
+            elif reply == CONFIRMATION:
+                # handle a confirmation
+                reply = self.__parse_reply(buffer, start, end)
+                if self.binary_pending:
+                    # the controller confirmed the switch, the next replies are binary frames
+                    self.binary = True
+                    self.binary_pending = False
+                self.__handle_confirmation(reply)
+            elif reply == TELEMETRY:
+                # handle a telemetry sample
+                self.__handle_telemetry(int(buffer[start:end]))
+            elif reply == MOVE:
+                # handle the completion of a queued move
+                self.__handle_move(int(buffer[start:end]))
+            elif reply == CREDIT:
+                # handle the bytes read by the controller
+                self.handle_credit(int(buffer[start:end]))
+        except ValueError:
+            self.__handle_invalid_value(_native_string(buffer[start:end]))
+
+    # handles a binary frame received from the controller, called by external readers
+    def handle_frame(self, frame):
+        frame = frame.rstrip(binary_protocol.DELIMITER)
+        self.__handle_frame(frame, 0, len(frame))
+
+    # handles the frame from start to end (exclusive, without the delimiter) in a bytearray, which is decoded in place
+    # internal use only, do not call
+    def __handle_frame(self, buffer, start, end):
+        if end <= start:
+            return
+        if self.instrumentation is not None:
+            self.instrumentation.count('lines_read')
+        try:
+            reply_type, payload, tag = binary_protocol.decode_reply(buffer, start, end)
+        except ValueError as e:
+            # corrupted frames are dropped
+            self.__handle_message('Received invalid frame: ' + str(e))
+            return
+        if reply_type == binary_protocol.REPLY_MESSAGE:
+            self.__handle_message(payload)
+        elif reply_type == binary_protocol.REPLY_VALUE:
+            self.__handle_value((payload, tag))
+        elif reply_type == binary_protocol.REPLY_TELEMETRY:
+            self.__handle_telemetry(payload)
+        elif reply_type == binary_protocol.REPLY_MOVE:
+            self.__handle_move(payload)
+        elif reply_type == binary_protocol.REPLY_CREDIT:
+            self.handle_credit(payload)
+        else:
+            self.__handle_confirmation((payload, tag))
+
+    # parses the value of a reply from start to end in a bytearray, tagged replies have the form '<tag>:<value>'
+    # internal use only, do not call
+    # returns a (value, tag) tuple, the tag is None for untagged replies
+    def __parse_reply(self, buffer, start, end):
+        separator = buffer.find(b':', start, end)
+        if separator < 0:
+            return int(buffer[start:end]), None
+        return int(buffer[separator + 1:end]), int(buffer[start:separator])
 
     # method for writing, to be ran on a separate thread, internal use only, do not call
     def __write_func(self):
         while self.running:
-            # if there are commands to send, send them one by one
-            if len(self.command_buffer) > 0:
-                # get the next command
-                command = self.command_buffer.pop(0)
-                # send it
-                try:
-                    self.ser.write(command + '\n')
-                except SerialException:
-                    self.message_func('Error sending command \"' + command + '\" over  port ' + str(self.get_port()))
-                    self.message_func(traceback.format_exc())
-                    self.running = False
-            # short delay
-            time.sleep(0.05)
+            if self.held_command is None:
+                # sleep until a command is queued
+                command = self.command_buffer.get()
+                if command is None:
+                    # wake-up call from stop_connection()
+                    continue
+            else:
+                command = self.held_command
+            with self.write_lock:
+                # gather the other queued commands as well, so that a burst is flushed in a single write
+                commands, data, self.held_command = self.take_commands(command)
+                if len(commands) > 0:
+                    # send them
+                    self.__write(commands, data)
+            if len(commands) == 0:
+                # wait until the controller reports that it has room
+                with self.flow_condition:
+                    while self.running and not self.__has_credit(len(self.encode_command(command[0], command[1]))):
+                        self.flow_condition.wait(0.1)
+
+    # writes commands to the port, with the write lock held, internal use only, do not call
+    # returns False if the port could not be written
+    def __write(self, commands, data):
+        try:
+            self.ser.write(data)
+        except SerialException:
+            if self.running:
+                self.message_func('Error sending command \"' + '\", \"'.join([entry[0] for entry in commands])
+                                  + '\" over  port ' + str(self.get_port()))
+                self.message_func(traceback.format_exc())
+                self.running = False
+            return False
+        if self.instrumentation is not None:
+            self.instrumentation.commands_written([entry[2] for entry in commands], len(data))
+        return True
+
+    # takes queued commands, starting with the given one, as long as the controller has room for them
+    # called by the writing thread
+    # returns the taken commands, their bytes, and the first command which did not fit (None if all were taken)
+    def take_commands(self, command=None):
+        if command is None:
+            command = self.__next_command()
+        commands = []
+        data = []
+        with self.flow_condition:
+            while command is not None:
+                cmd, tag, record, key = command
+                encoded = self.encode_command(cmd, tag)
+                if not self.__has_credit(len(encoded)):
+                    break
+                if self.credit_window is not None:
+                    self.in_flight += len(encoded)
+                elif cmd == 'credits' and self.credit_request > 0:
+                    # the controller counts the bytes it reads from the next command on
+                    self.credit_window = self.credit_request
+                    self.credit_request = 0
+                    self.in_flight = len(encoded)
+                    self.credit_debt = len(encoded)
+                commands.append(command)
+                data.append(encoded)
+                command = self.__next_command()
+            if self.flow_waiting > 0 and len(commands) > 0:
+                # there is room in the command queue
+                self.flow_condition.notify_all()
+        return commands, b''.join(data), command
+
+    # takes the next queued command, skipping wake-up calls, internal use only, do not call
+    # returns None if there are no commands queued
+    def __next_command(self):
+        while True:
+            try:
+                command = self.command_buffer.get_nowait()
+            except queue.Empty:
+                return None
+            if command is not None:
+                return command
+
+    # checks if the controller has room for the given number of bytes, with the flow condition held
+    # the controller holds back the report of fewer bytes than the credit batch, which must not block the next command
+    # internal use only, do not call
+    def __has_credit(self, length):
+        return self.credit_window is None or self.in_flight < CREDIT_BATCH \
+            or self.in_flight + length <= self.credit_window
 
     # method to handle feedback, internal use only, do not call
     def __handle_message(self, message):
         self.message_func(message.rstrip())
 
-    # method to handle value replies, internal use only, do not call
-    def __handle_value(self, value):
+    # method to handle (value, tag) replies, internal use only, do not call
+    def __handle_value(self, reply):
         # we need a buffer here to handle them on the main thread
-        self.value_buffer.append(value)
+        self.value_buffer.append(reply + (self.__read_time(),))
+        self.data_event.set()
 
-    # method to handle confirmation replies, internal use only, do not call
-    def __handle_confirmation(self, value):
+    # method to handle (value, tag) confirmation replies, internal use only, do not call
+    def __handle_confirmation(self, reply):
         # we need a buffer here to handle them on the main thread
-        self.confirmation_buffer.append(value)
+        self.confirmation_buffer.append(reply + (self.__read_time(),))
+        self.data_event.set()
+
+    # handles the report of the number of bytes the controller has read, called by the reading thread
+    def handle_credit(self, count):
+        with self.flow_condition:
+            # the controller has read the request by the time it reports
+            self.in_flight = max(0, self.in_flight - count - self.credit_debt)
+            self.credit_debt = 0
+            self.flow_condition.notify_all()
+
+    # method to handle telemetry samples, internal use only, do not call
+    def __handle_telemetry(self, value):
+        if self.telemetry_func is not None:
+            self.telemetry_func(time.time(), value)
+
+    # method to handle completions of queued moves, internal use only, do not call
+    def __handle_move(self, value):
+        if self.move_func is not None:
+            self.move_func(value)
+
+    # gets the read time to buffer with a reply, only when instrumented, internal use only, do not call
+    def __read_time(self):
+        return time.time() if self.instrumentation is not None else None
 
     # method to handle invalid values, internal use only, do not call
     def __handle_invalid_value(self, message):
@@ -101,34 +370,166 @@ class MotorInterface:
     def get_port(self):
         return self.port
 
+    # get the baud rate used for communicating
+    def get_baudrate(self):
+        return self.baudrate
+
+    # changes the baud rate of the port, only to be used after the controller has switched
+    # returns False if the port does not support the baud rate
+    def set_baudrate(self, baudrate):
+        if self.ser is not None:
+            try:
+                self.ser.baudrate = baudrate
+            except (ValueError, SerialException):
+                self.message_func('Baud rate ' + str(baudrate) + ' is not supported by port ' + str(self.get_port()))
+                return False
+        self.baudrate = baudrate
+        return True
+
     # tick loop method, must be called externally
     def update_tick(self):
-        # empty the confirmation buffer
-        if len(self.confirmation_buffer) > 0:
-            # Make a copy of the confirmation buffer and reset it
-            confirmations = self.confirmation_buffer[:]
-            self.confirmation_buffer = []
-            # Handle all confirmations
-            for confirmation in confirmations:
-                self.confirm_func(confirmation)
+        self.tick_thread = threading.current_thread()
+        # reset the data flag first, anything arriving from here on will be handled by the next tick
+        self.data_event.clear()
+        # empty the confirmation buffer, the tag is only passed on for tagged replies
+        while len(self.confirmation_buffer) > 0:
+            value, tag, self.reply_time = self.confirmation_buffer.popleft()
+            if tag is None:
+                self.confirm_func(value)
+            else:
+                self.confirm_func(value, tag)
         # empty the value buffer
-        if len(self.value_buffer) > 0:
-            # Make a copy of the value buffer and reset it
-            values = self.value_buffer[:]
-            self.value_buffer = []
-            # Handle all values
-            for value in values:
+        while len(self.value_buffer) > 0:
+            value, tag, self.reply_time = self.value_buffer.popleft()
+            if tag is None:
                 self.value_func(value)
+            else:
+                self.value_func(value, tag)
+
+    # halts until a value or confirmation has been received, or the time out (in seconds) has passed
+    # returns True if there is data to be handled by update_tick()
+    def wait_for_data(self, time_out):
+        return self.data_event.wait(time_out)
+
+    # encodes a command to the bytes to send, in the protocol currently in use, called by the writing thread
+    def encode_command(self, cmd, tag=None):
+        if self.binary:
+            try:
+                return binary_protocol.encode_command(cmd, tag)
+            except ValueError:
+                self.message_func('Command \"' + cmd + '\" is not available in the binary protocol')
+                return b''
+        if tag is not None:
+            cmd = cmd + '#' + str(tag)
+        return (cmd + '\n').encode('ascii')
+
+    # logs a command to be sent, the policy applies if the command queue is full
+    # - tag: optional tag for the tagged protocol, which is appended to the command as '<cmd>#<tag>'
+    # - key: optional key identifying the command, passed to drop_func if the command is dropped
+    # returns the instrumentation record of the command, or None if not instrumented or dropped
+    def send_command(self, cmd, tag=None, key=None):
+        if not self.make_room():
+            self.drop_command(cmd, key)
+            return None
+        return self.queue_command(cmd, tag, key)
+
+    # queues a command to be sent regardless of the bound of the command queue, see send_command()
+    # to be preceded by make_room(), so that callers can wait for room before taking their own locks, and drop the
+    # command if there is no room
+    def queue_command(self, cmd, tag=None, key=None):
+        record = self.instrumentation.command_enqueued(cmd) if self.instrumentation is not None else None
+        self.command_buffer.put((cmd, tag, record, key))
+        return record
+
+    # writes a command to the port right away on the calling thread, rather than on the writing thread, so that commands
+    # to several ports can be written in a tight burst
+    # the command is queued as usual if earlier commands are waiting to be written or the controller has no room for
+    # it, commands queued by other threads at the same moment may be written after it
+    # returns the time (as time.time()) at which the command was handed to the port, or None if it has been queued
+    def write_command(self, cmd, tag=None, key=None):
+        record = self.instrumentation.command_enqueued(cmd) if self.instrumentation is not None else None
+        command = (cmd, tag, record, key)
+        with self.write_lock:
+            encoded = self.encode_command(cmd, tag)
+            with self.flow_condition:
+                direct = self.running and self.is_write_idle() and self.__has_credit(len(encoded))
+                if direct and self.credit_window is not None:
+                    self.in_flight += len(encoded)
+            if direct:
+                return time.time() if self.__write([command], encoded) else None
+        self.command_buffer.put(command)
+        return None
+
+    # checks if there are no commands waiting to be written, with the write lock held
+    def is_write_idle(self):
+        return self.held_command is None and self.command_buffer.empty()
+
+    # applies the policy if the command queue is full: waits for room, drops the oldest command, or raises queue.Full
+    # the reading thread and the thread calling update_tick() neither wait nor raise, as the writing thread and the
+    # callers waiting for room depend on them, there is no room for their commands then
+    # returns True if there is room for a command, False if the command has to be dropped
+    def make_room(self):
+        if self.queue_size <= 0 or self.command_buffer.qsize() < self.queue_size:
+            return True
+        if self.policy == DROP_OLDEST:
+            self.__drop_command()
+        elif self.is_reading_thread() or self.is_tick_thread():
+            return False
+        elif self.policy == RAISE:
+            raise queue.Full('The command queue of port ' + str(self.get_port()) + ' is full')
+        else:
+            with self.flow_condition:
+                self.flow_waiting += 1
+                while self.running and self.command_buffer.qsize() >= self.queue_size:
+                    self.flow_condition.wait(0.1)
+                self.flow_waiting -= 1
+        return True
+
+    # drops the oldest queued command, internal use only, do not call
+    def __drop_command(self):
+        command = self.__next_command()
+        if command is not None:
+            self.drop_command(command[0], command[3])
+
+    # reports a command which has been dropped, as the command queue is full, and passes its key to drop_func
+    def drop_command(self, cmd, key=None):
+        self.message_func('Dropped command \"' + cmd + '\", the command queue of port ' + str(self.get_port())
+                          + ' is full')
+        if self.instrumentation is not None:
+            self.instrumentation.count('commands_dropped')
+        if self.drop_func is not None:
+            self.drop_func(key)
+
+    # checks if the current thread is the one reading the port
+    def is_reading_thread(self):
+        return threading.current_thread() is self.read_thread
+
+    # checks if the current thread is the one calling update_tick()
+    def is_tick_thread(self):
+        return threading.current_thread() is self.tick_thread
+
+    # enables flow control, only to be used if the controller supports it
+    # the 'credits' command is sent, from then on commands are only written while the controller has room for them in
+    # its receive buffer, the controller reports the bytes it has read to make room for the next ones
+    # - window: the size of the receive buffer of the controller, in bytes
+    def request_credits(self, window=RX_BUFFER_SIZE):
+        if self.credit_window is None and self.credit_request == 0:
+            self.credit_request = window
+            self.send_command('credits')
 
-    # logs a command to be sent
-    def send_command(self, cmd):
-        self.command_buffer.append(cmd)
+    # switches to the binary protocol, only to be used if the controller supports it
+    # the 'binary' command is sent, and both sides switch once the controller has confirmed it
+    # no other commands may be sent until the confirmation has been received
+    def request_binary(self):
+        if not self.binary:
+            self.binary_pending = True
+            self.send_command('binary')
 
     # method to start the connection
     def start_connection(self):
         if self.ser is None:
             try:
-                self.ser = serial.Serial(port=self.port, baudrate=9600, timeout=0.1)
+                self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=0.1)
             except SerialException:
                 print(traceback.format_exc())
                 self.ser = None
@@ -143,8 +544,16 @@ class MotorInterface:
     # method to stop the connection
     def stop_connection(self):
         self.running = False
+        # wake up the writing thread, and the threads waiting for room or credit
+        self.command_buffer.put(None)
+        with self.flow_condition:
+            self.flow_condition.notify_all()
+        # let the reading thread finish its current read (at most one read time out) before closing the port
+        if self.read_thread.is_alive() and threading.current_thread() is not self.read_thread:
+            self.read_thread.join(1)
         if self.ser is not None:
-            self.ser.close()
+            with self.close_lock:
+                self.ser.close()
 
     # method to check if the connection is running
     def is_running(self):
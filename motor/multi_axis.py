@@ -0,0 +1,189 @@
+# Coordinated moves of several axes, each driven by its own MotorControl
+#
+# The axes of a move step at constant intervals, which are matched so that all axes finish together, with the axis which
+# needs the longest at its maximum rate, so that the move is a straight line. The intervals are uploaded as ramp
+# segments, which the controllers time in microseconds. The axes are armed with their moves first, and then started
+# with a burst of start commands, written to their ports one after the other on the calling thread.
+# The intervals of a batch of moves are computed at once, vectorised with NumPy if it is available.
+import time
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, it only speeds up the planning of large batches of moves
+    numpy = None
+
+from .motion_profile import MIN_INTERVAL
+
+
+# computes the duration of moves, and the step interval of each axis, so that all axes of a move finish together
+# a duration is seldom a multiple of the number of steps of an axis, so some steps take one microsecond longer
+# - targets: the moves, each a sequence of the signed number of steps of each axis
+# - rates: the maximum rate of each axis, in steps per second, or a single rate for all axes
+# returns the durations of the moves in whole microseconds, a list, and the intervals of the axes in whole microseconds
+# and the number of their steps which take one microsecond longer, as lists per move of lists per axis
+def plan_intervals(targets, rates):
+    if max(_as_list(rates)) > 1000000.0 / MIN_INTERVAL:
+        raise ValueError('Maximum rate exceeds ' + str(1000000 // MIN_INTERVAL) + ' steps per second')
+    if min(_as_list(rates)) <= 0:
+        raise ValueError('Maximum rates must be positive')
+    if numpy is not None:
+        steps = numpy.abs(numpy.asarray(targets, dtype=numpy.int64).reshape(len(targets), -1))
+        limits = numpy.broadcast_to(numpy.asarray(rates, dtype=numpy.float64), steps.shape)
+        durations = numpy.ceil(numpy.max(steps * 1000000.0 / limits, axis=1, initial=0)).astype(numpy.int64)
+        counts = numpy.maximum(steps, 1)
+        intervals = durations[:, None] // counts
+        longer = durations[:, None] - intervals * counts
+        return durations.tolist(), intervals.tolist(), longer.tolist()
+    durations = []
+    intervals = []
+    longer = []
+    for target in targets:
+        steps = [abs(int(value)) for value in target]
+        limits = _as_list(rates) if isinstance(rates, (list, tuple)) else [rates] * len(steps)
+        duration = 0
+        for count, limit in zip(steps, limits):
+            duration = max(duration, _ceil(count * 1000000.0 / limit))
+        durations.append(duration)
+        intervals.append([duration // max(count, 1) for count in steps])
+        longer.append([duration - duration // max(count, 1) * max(count, 1) for count in steps])
+    return durations, intervals, longer
+
+
+# plans a batch of moves of the same axes at once, see plan_intervals()
+# - motors: the MotorControl of each axis
+# returns a list of MultiAxisMove objects
+def plan_moves(motors, targets, rates):
+    durations, intervals, longer = plan_intervals(targets, rates)
+    plans = zip(durations, intervals, longer)
+    return [MultiAxisMove(motors, target, rates, plan) for target, plan in zip(targets, plans)]
+
+
+# converts a rate or a sequence of rates to a list, internal use only, do not call
+def _as_list(rates):
+    if numpy is not None:
+        return numpy.atleast_1d(numpy.asarray(rates, dtype=numpy.float64)).tolist()
+    return list(rates) if isinstance(rates, (list, tuple)) else [rates]
+
+
+# rounds up to a whole number, internal use only, do not call
+def _ceil(value):
+    rounded = int(value)
+    return rounded + 1 if rounded < value else rounded
+
+
+# gets the ramp segments of an axis: the steps at the interval, followed by the steps which take one microsecond
+# longer, internal use only, do not call
+def _segments(steps, interval, longer):
+    segments = []
+    if steps > longer:
+        segments.append((steps - longer, interval, interval))
+    if longer > 0:
+        segments.append((longer, interval + 1, interval + 1))
+    return segments
+
+
+# Move of several axes, which all finish together
+# Arm the axes with arm(), start them with start(), and wait for them to finish with wait(), or do all at once with
+# run(), the axes without steps are left alone
+# - motors: the MotorControl of each axis, which must be connected to controllers which support ramps
+# - steps: the signed number of steps of each axis
+# - rates: the maximum rate of each axis, in steps per second, or a single rate for all axes
+# - plan: the (duration, intervals, longer steps) of the move as computed by plan_intervals(), internal use only
+class MultiAxisMove:
+    def __init__(self, motors, steps, rates, plan=None):
+        if len(motors) != len(steps):
+            raise ValueError('Expected the steps of ' + str(len(motors)) + ' axes, got ' + str(len(steps)))
+        self.motors = list(motors)
+        self.steps = [int(value) for value in steps]
+        if plan is None:
+            durations, intervals, longer = plan_intervals([self.steps], rates)
+            plan = durations[0], intervals[0], longer[0]
+        duration, intervals, longer = plan
+        # duration of the move in seconds, and the ramp segments of each axis
+        self.duration = duration / 1000000.0
+        self.segments = [_segments(abs(count), interval, count_longer)
+                         for count, interval, count_longer in zip(self.steps, intervals, longer)]
+        # estimated times (as time.time()) at which the start commands reached the controllers, by axis, None for the
+        # axes which have not been started
+        self.start_times = [None] * len(self.motors)
+
+    # gets the duration of the move, in seconds
+    def get_duration(self):
+        return self.duration
+
+    # gets the axes which have steps to do, as (motor, steps, segments) tuples, internal use only, do not call
+    def __get_axes(self):
+        return [axis for axis in zip(self.motors, self.steps, self.segments) if axis[1] != 0]
+
+    # arms all axes with their moves, and halts program execution until the controllers have confirmed them
+    # returns True if all axes have been armed, otherwise the axes which have been armed are disarmed again
+    def arm(self):
+        # send the moves to all axes before waiting for any, so that they are uploaded in parallel
+        armings = [(motor, motor.arm(steps, segments)) for motor, steps, segments in self.__get_axes()]
+        armed = True
+        for motor, arming in armings:
+            armed = arming.wait(motor.time_out) and arming.get_value() is not None and armed
+        if not armed:
+            for motor, arming in armings:
+                if motor.is_armed():
+                    motor.stop_stepping()
+        return armed
+
+    # starts all armed axes with a burst of start commands, see MotorControl.start_armed()
+    # returns the skew between the axes, see get_skew()
+    def start(self):
+        axes = [index for index, motor in enumerate(self.motors) if self.steps[index] != 0 and motor.is_armed()]
+        # the time the start commands spend on the serial lines, which differs between lines of other baud rates
+        transfers = [len(self.motors[index].mi.encode_command('start')) * 10.0
+                     / self.motors[index].mi.get_baudrate() for index in axes]
+        # the burst itself, nothing else happens in between the writes
+        written = [self.motors[index].start_armed() for index in axes]
+        self.start_times = [None] * len(self.motors)
+        for index, transfer, time_written in zip(axes, transfers, written):
+            if time_written is not None:
+                self.start_times[index] = time_written + transfer
+        return self.get_skew()
+
+    # gets the skew between the axes: the spread of the estimated times at which their start commands reached the
+    # controllers, in seconds, estimated from the times the commands were handed to the ports and the time they spend
+    # on the serial lines
+    # returns None if not all axes have been started, or if a start command had to be queued
+    def get_skew(self):
+        times = [self.start_times[index] for index in range(len(self.motors)) if self.steps[index] != 0]
+        if len(times) == 0 or None in times:
+            return None
+        return max(times) - min(times)
+
+    # gets the estimated times (as time.time()) at which the start commands reached the controllers, by axis, None for
+    # the axes which have not been started
+    def get_start_times(self):
+        return list(self.start_times)
+
+    # halts program execution until all axes have finished their moves, or the time out (in seconds) has passed
+    # the waits are woken up by the confirmations of the controllers
+    # - time_out: the time out, None to wait indefinitely
+    # returns True if all axes have finished
+    def wait(self, time_out=None):
+        deadline = None if time_out is None else time.time() + time_out
+        for motor, steps, segments in self.__get_axes():
+            if not motor.wait_finish(None if deadline is None else max(0, deadline - time.time())):
+                return False
+        return True
+
+    # arms the axes, starts them, and waits until they have finished, see arm(), start() and wait()
+    # - time_out: time in seconds to wait beyond the duration of the move, None to wait indefinitely
+    # returns True if all axes have finished their moves
+    def run(self, time_out=None):
+        if not self.arm():
+            return False
+        self.start()
+        return self.wait(None if time_out is None else self.duration + time_out)
+
+    # gets the numbers of steps the axes took, by axis, -1 for the axes which have not finished yet
+    def get_step_counts(self):
+        return [motor.get_last_step_count() if steps != 0 else 0 for motor, steps in zip(self.motors, self.steps)]
+
+    # stops all axes, and disarms the axes which have not been started
+    def stop(self):
+        for motor, steps, segments in self.__get_axes():
+            motor.stop_stepping()
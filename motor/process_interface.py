@@ -0,0 +1,413 @@
+import multiprocessing
+import os
+import struct
+import threading
+import time
+
+from .motor_interface import MotorInterface, BLOCK, QUEUE_SIZE
+
+# capacity of the shared memory rings, in bytes
+RING_SIZE = 65536
+# time in seconds to wait for the worker process to open the port, and to change the baud rate
+START_TIME_OUT = 10
+BAUD_RATE_TIME_OUT = 1
+# operations sent to the worker process
+OP_COMMAND = 0
+OP_CREDITS = 1
+OP_BINARY = 2
+OP_BAUD_RATE = 3
+OP_STOP = 4
+# events sent back by the worker process
+EVENT_STARTED = 0
+EVENT_STOPPED = 1
+EVENT_VALUE = 2
+EVENT_CONFIRMATION = 3
+EVENT_MESSAGE = 4
+EVENT_TELEMETRY = 5
+EVENT_MOVE = 6
+EVENT_BAUD_RATE = 7
+# layouts of the ring header (write and read positions), record lengths, operations (op, argument) and events
+# (event, value, tag, time), the text of commands and messages follows the operation or event
+HEADER = struct.Struct('<QQ')
+LENGTH = struct.Struct('<I')
+OPERATION = struct.Struct('<Bq')
+EVENT = struct.Struct('<Bqqd')
+# tag of untagged commands and replies
+NO_TAG = -1
+
+
+# Ring of variable length records in shared memory, for a single producer and a single consumer
+# The write and read positions count all bytes ever written and read, and are only advanced once the record itself
+# has been written or read, so that the other side never sees a partial record
+# Stores to shared memory can become visible to the other process out of order on weakly ordered processors (e.g.
+# ARM), so the positions are only loaded and stored with the lock of the memory held: taking and releasing the lock are
+# full memory barriers, which order the bytes of a record before the position covering them
+# - memory: a multiprocessing.Array of bytes with a lock, of which the first bytes hold the positions
+class SharedRing:
+    def __init__(self, memory):
+        self.memory = memory
+        self.lock = memory.get_lock()
+        self.buffer = memory.get_obj()
+        self.data = memoryview(self.buffer).cast('B')[HEADER.size:]
+        self.size = len(self.data)
+
+    # creates the shared memory for a ring of the given capacity, in bytes
+    @staticmethod
+    def allocate(context, size=RING_SIZE):
+        return context.Array('B', HEADER.size + size, lock=context.Lock())
+
+    # loads the write and read positions, internal use only, do not call
+    def __load(self):
+        with self.lock:
+            return HEADER.unpack_from(self.buffer, 0)
+
+    # stores the write or read position, internal use only, do not call
+    def __store(self, offset, position):
+        with self.lock:
+            struct.pack_into('<Q', self.buffer, offset, position)
+
+    # copies bytes into the ring at a position, wrapping around its end, internal use only, do not call
+    def __write(self, position, data):
+        index = position % self.size
+        first = min(len(data), self.size - index)
+        self.data[index:index + first] = data[0:first]
+        if first < len(data):
+            self.data[0:len(data) - first] = data[first:]
+
+    # copies bytes out of the ring from a position, wrapping around its end, internal use only, do not call
+    def __read(self, position, length):
+        index = position % self.size
+        first = min(length, self.size - index)
+        if first == length:
+            return self.data[index:index + length].tobytes()
+        return self.data[index:].tobytes() + self.data[0:length - first].tobytes()
+
+    # appends a record, called by the producer
+    # returns False if there is no room for it
+    def put(self, record):
+        write, read = self.__load()
+        if write + LENGTH.size + len(record) - read > self.size:
+            return False
+        self.__write(write, LENGTH.pack(len(record)) + record)
+        self.__store(0, write + LENGTH.size + len(record))
+        return True
+
+    # takes all records, oldest first, called by the consumer
+    def take(self):
+        write, read = self.__load()
+        records = []
+        position = read
+        while position < write:
+            length = LENGTH.unpack(self.__read(position, LENGTH.size))[0]
+            records.append(self.__read(position + LENGTH.size, length))
+            position += LENGTH.size + length
+        if position > read:
+            self.__store(HEADER.size // 2, position)
+        return records
+
+
+# appends a record to a ring and signals the other side, waiting while the ring is full
+# - lock: the lock of the producers of this side of the ring
+# - alive: function reference returning False once waiting is pointless
+# returns False if the record could not be sent
+def _send(ring, event, lock, record, alive):
+    with lock:
+        while not ring.put(record):
+            if not alive():
+                return False
+            # the consumer frees the ring soon, a full ring is rare enough to poll
+            time.sleep(0.001)
+    event.set()
+    return True
+
+
+# main function of the worker process, which owns the serial port through a regular MotorInterface
+# internal use only, do not call
+def _worker_main(port, baudrate, commands, replies, command_event, reply_event):
+    parent = os.getppid()
+    commands = SharedRing(commands)
+    replies = SharedRing(replies)
+    lock = threading.Lock()
+
+    # sends an event to the parent, from any thread of the worker
+    def send_event(event, value=0, tag=None, text=''):
+        record = EVENT.pack(event, value, NO_TAG if tag is None else tag, time.time()) + text.encode('utf-8')
+        return _send(replies, reply_event, lock, record, lambda: os.getppid() == parent)
+
+    # the replies are passed on as soon as they are dispatched, so the read time is stamped here
+    mi = MotorInterface(port,
+                        lambda value, tag=None: send_event(EVENT_VALUE, value, tag),
+                        lambda value, tag=None: send_event(EVENT_CONFIRMATION, value, tag),
+                        lambda message: send_event(EVENT_MESSAGE, text=message),
+                        baudrate=baudrate, queue_size=0)
+    mi.telemetry_func = lambda timestamp, value: send_event(EVENT_TELEMETRY, value)
+    mi.move_func = lambda value: send_event(EVENT_MOVE, value)
+    started = mi.start_connection()
+    send_event(EVENT_STARTED, 1 if started else 0)
+    if not started:
+        return
+
+    # dispatches the replies of the interface to the parent as soon as they arrive
+    def dispatch_func():
+        while mi.is_running():
+            if mi.wait_for_data(0.1):
+                mi.update_tick()
+    dispatch_thread = threading.Thread(target=dispatch_func)
+    dispatch_thread.daemon = True
+    dispatch_thread.start()
+    # hand the operations of the parent to the interface, until it stops the worker or goes away
+    stopping = False
+    while not stopping and mi.is_running() and os.getppid() == parent:
+        command_event.wait(0.1)
+        command_event.clear()
+        for record in commands.take():
+            op, argument = OPERATION.unpack_from(record)
+            if op == OP_COMMAND:
+                mi.send_command(record[OPERATION.size:].decode('utf-8'), None if argument == NO_TAG else argument)
+            elif op == OP_CREDITS:
+                mi.request_credits(argument)
+            elif op == OP_BINARY:
+                mi.request_binary()
+            elif op == OP_BAUD_RATE:
+                send_event(EVENT_BAUD_RATE, 1 if mi.set_baudrate(argument) else 0)
+            elif op == OP_STOP:
+                stopping = True
+    if not stopping and os.getppid() == parent:
+        send_event(EVENT_STOPPED)
+    mi.stop_connection()
+
+
+# Motor interface of which the serial port is owned by a worker process, so that reading and writing the port does not
+# compete for the GIL with the rest of the program
+# The commands and the parsed replies are exchanged with the worker through two rings in shared memory, the worker
+# stamps the replies as it reads them, and the replies are taken from the ring by update_tick(), right before the time
+# outs are checked, so that a busy host does not time out commands which have been replied to in time
+# Pass it as the interface_factory of a MotorControl, which works on top of it as usual
+# Note: requires Python 3, as with any multiprocessing program, scripts must guard their main code with
+# "if __name__ == '__main__':" on platforms which spawn the worker
+# - start_method: the multiprocessing start method for the worker, None for the default of the platform
+# - ring_size: capacity of each of the rings, in bytes
+class ProcessMotorInterface(MotorInterface):
+    def __init__(self, port, value_func, confirm_func, message_func, baudrate=9600, queue_size=QUEUE_SIZE,
+                 policy=BLOCK, start_method=None, ring_size=RING_SIZE):
+        # call super constructor (its threads are never started)
+        MotorInterface.__init__(self, port, value_func, confirm_func, message_func, baudrate, queue_size, policy)
+        # shared memory for the rings to the worker and back, and the events signalling new records in them
+        self.context = multiprocessing.get_context(start_method)
+        self.ring_size = ring_size
+        self.commands = None
+        self.replies = None
+        self.command_event = self.context.Event()
+        self.reply_event = self.context.Event()
+        # locks of the producers of the command ring, and of the consumers of the reply ring
+        self.command_lock = threading.Lock()
+        self.reply_lock = threading.RLock()
+        # the worker process, and the results of its last start and baud rate change (None while pending)
+        self.process = None
+        self.started = None
+        self.baudrate_result = None
+        # the command taken from the queue which did not fit in the ring yet, and the event waking up the writing thread
+        self.held_command = None
+        self.write_event = threading.Event()
+        # Thread for handing the commands which did not fit in the ring to the worker
+        self.write_thread = threading.Thread(target=self.__write_func)
+        self.write_thread.daemon = True
+
+    # encodes a command to the operation to send to the worker, with the command lock held, internal use only, do not
+    # call
+    def __encode_command(self, command):
+        cmd, tag, record, key = command
+        # the requests to enable flow control and the binary protocol are handled by the interface of the worker
+        if cmd == 'credits' and self.credit_request > 0:
+            window = self.credit_request
+            self.credit_request = 0
+            return OPERATION.pack(OP_CREDITS, window)
+        if cmd == 'binary' and self.binary_pending:
+            return OPERATION.pack(OP_BINARY, 0)
+        return OPERATION.pack(OP_COMMAND, NO_TAG if tag is None else tag) + cmd.encode('utf-8')
+
+    # method for handing the queued commands to the worker once there is room in the ring, to be ran on a separate
+    # thread, internal use only, do not call
+    def __write_func(self):
+        while self.running:
+            self.write_event.wait()
+            commands = []
+            with self.command_lock:
+                self.write_event.clear()
+                while True:
+                    if self.held_command is None:
+                        self.held_command = self.__next_command()
+                    if self.held_command is None or not self.commands.put(self.__encode_command(self.held_command)):
+                        break
+                    commands.append(self.held_command)
+                    self.held_command = None
+            if len(commands) > 0:
+                self.__commands_sent(commands)
+            if self.held_command is not None:
+                # the worker empties the ring soon, a full ring is rare enough to poll
+                if not self.process.is_alive():
+                    return
+                time.sleep(0.001)
+                self.write_event.set()
+
+    # takes the next queued command, skipping wake-up calls, internal use only, do not call
+    # returns None if there are no commands queued
+    def __next_command(self):
+        while self.command_buffer.qsize() > 0:
+            command = self.command_buffer.get_nowait()
+            if command is not None:
+                return command
+        return None
+
+    # signals the worker that commands have been added to the ring, internal use only, do not call
+    def __commands_sent(self, commands):
+        self.command_event.set()
+        if self.flow_waiting > 0:
+            # there is room in the command queue
+            with self.flow_condition:
+                self.flow_condition.notify_all()
+        if self.instrumentation is not None:
+            # the commands count as written once they have been handed to the worker
+            self.instrumentation.commands_written([command[2] for command in commands],
+                                                  sum(len(command[0]) + 1 for command in commands))
+
+    # queues a command to be sent regardless of the bound of the command queue, see send_command()
+    # the command is added to the ring right away, on the calling thread, unless earlier commands are still waiting for
+    # room in it, so that it reaches the worker even if the program holds the GIL right after
+    def queue_command(self, cmd, tag=None, key=None):
+        return self.__put_command(cmd, tag, key)[0]
+
+    # hands a command to the worker right away, see MotorInterface.write_command(), as queue_command() does
+    # returns the time (as time.time()) at which the command was added to the ring, or None if it has been queued
+    def write_command(self, cmd, tag=None, key=None):
+        return self.__put_command(cmd, tag, key)[1]
+
+    # adds a command to the ring, or queues it if earlier commands are still waiting for room in it, internal use only,
+    # do not call
+    # returns the instrumentation record of the command, and the time it was added to the ring (None if queued)
+    def __put_command(self, cmd, tag, key):
+        record = self.instrumentation.command_enqueued(cmd) if self.instrumentation is not None else None
+        command = (cmd, tag, record, key)
+        with self.command_lock:
+            sent = self.commands is not None and self.held_command is None and self.command_buffer.qsize() == 0 \
+                and self.commands.put(self.__encode_command(command))
+            if not sent:
+                self.command_buffer.put(command)
+        if sent:
+            written = time.time()
+            self.__commands_sent([command])
+            return record, written
+        self.write_event.set()
+        return record, None
+
+    # sends an operation to the worker, internal use only, do not call
+    # returns False if the worker has gone
+    def __send_operation(self, operation):
+        return _send(self.commands, self.command_event, self.command_lock, operation, self.process.is_alive)
+
+    # takes the events sent by the worker, and handles them, internal use only, do not call
+    def __take_events(self):
+        with self.reply_lock:
+            records = self.replies.take()
+            if self.instrumentation is not None and len(records) > 0:
+                # each event stands for a line or frame read by the worker, the bytes read are not reported
+                self.instrumentation.count('lines_read', len(records))
+            for record in records:
+                event, value, tag, timestamp = EVENT.unpack_from(record)
+                tag = None if tag == NO_TAG else tag
+                if event == EVENT_VALUE:
+                    self.value_buffer.append((value, tag, timestamp))
+                elif event == EVENT_CONFIRMATION:
+                    if self.binary_pending:
+                        # the worker switched with this confirmation
+                        self.binary = True
+                        self.binary_pending = False
+                    self.confirmation_buffer.append((value, tag, timestamp))
+                elif event == EVENT_MESSAGE:
+                    self.message_func(record[EVENT.size:].decode('utf-8', 'replace'))
+                elif event == EVENT_TELEMETRY:
+                    if self.telemetry_func is not None:
+                        self.telemetry_func(timestamp, value)
+                elif event == EVENT_MOVE:
+                    if self.move_func is not None:
+                        self.move_func(value)
+                elif event == EVENT_BAUD_RATE:
+                    self.baudrate_result = value == 1
+                elif event == EVENT_STARTED:
+                    self.started = value == 1
+                elif event == EVENT_STOPPED:
+                    self.running = False
+
+    # waits until the worker has reported a result, handling its other events meanwhile, internal use only, do not call
+    # returns the result, or None if it did not arrive in time
+    def __wait_for_result(self, name, time_out):
+        deadline = time.time() + time_out
+        while getattr(self, name) is None and time.time() < deadline and self.process.is_alive():
+            self.reply_event.wait(0.01)
+            self.reply_event.clear()
+            self.__take_events()
+        return getattr(self, name)
+
+    # tick loop method, must be called externally, takes the replies from the worker before handling them
+    def update_tick(self):
+        # reset the signal first, anything arriving from here on will be handled by the next tick
+        self.reply_event.clear()
+        self.__take_events()
+        if self.running and not self.process.is_alive():
+            self.message_func('The worker process of port ' + str(self.get_port()) + ' has exited')
+            self.running = False
+        MotorInterface.update_tick(self)
+
+    # halts until the worker has sent a reply, or the time out (in seconds) has passed
+    # returns True if there is data to be handled by update_tick()
+    def wait_for_data(self, time_out):
+        return self.reply_event.wait(time_out)
+
+    # checks if the current thread is the one handling the replies, which is the one calling update_tick()
+    def is_reading_thread(self):
+        return threading.current_thread() is self.tick_thread
+
+    # changes the baud rate of the port, only to be used after the controller has switched
+    # returns False if the port does not support the baud rate
+    def set_baudrate(self, baudrate):
+        if self.process is not None:
+            self.baudrate_result = None
+            if not self.__send_operation(OPERATION.pack(OP_BAUD_RATE, baudrate)) \
+                    or not self.__wait_for_result('baudrate_result', BAUD_RATE_TIME_OUT):
+                return False
+        self.baudrate = baudrate
+        return True
+
+    # method to start the connection, the worker process is started and opens the port
+    def start_connection(self):
+        if self.process is None:
+            self.commands = SharedRing(SharedRing.allocate(self.context, self.ring_size))
+            self.replies = SharedRing(SharedRing.allocate(self.context, self.ring_size))
+            self.process = self.context.Process(target=_worker_main,
+                                                args=(self.port, self.baudrate, self.commands.memory,
+                                                      self.replies.memory, self.command_event, self.reply_event))
+            self.process.daemon = True
+            self.process.start()
+            if not self.__wait_for_result('started', START_TIME_OUT):
+                self.process.join(1)
+                if self.process.is_alive():
+                    self.process.terminate()
+                return False
+            self.running = True
+            self.write_thread.start()
+            return True
+        return self.running
+
+    # method to stop the connection, the worker closes the port and exits
+    def stop_connection(self):
+        self.running = False
+        # wake up the writing thread, and the threads waiting for room
+        self.write_event.set()
+        with self.flow_condition:
+            self.flow_condition.notify_all()
+        if self.process is not None and self.process.is_alive():
+            self.__send_operation(OPERATION.pack(OP_STOP, 0))
+            if threading.current_thread() is not self.write_thread:
+                self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
@@ -0,0 +1,328 @@
+# Scans: moving a motor through a list of positions, taking a measurement at each
+#
+# The scan is pipelined: while a measurement is taken, the next move is armed, i.e. its direction and steps are
+# uploaded to the controller, so that between measurements only the start command is left to send. The completion of
+# each move is handled as soon as its confirmation arrives, rather than on a clock tick.
+# The results are appended to a ScanLog, backed by arrays, which can be streamed while the scan runs.
+import threading
+import time
+from array import array
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, it is only needed for to_numpy()
+    numpy = None
+
+from . import motion_profile
+
+# states of a scan
+IDLE = 'idle'
+RUNNING = 'running'
+PAUSED = 'paused'
+ABORTED = 'aborted'
+DONE = 'done'
+FAILED = 'failed'
+
+
+# Log of the results of a scan, as (position, step count, move start, move end, measurement time, value) tuples
+# - position: the position of the point, in steps from where the scan started
+# - step count: the number of steps the motor took to reach it
+# - move start, move end and measurement time: time stamps (as time.time()) of the start command, of the completion of
+#   the move, and of the end of the measurement, the move times are those of the measurement if there was no move
+# - value: the value returned by the measurement function
+# The numbers are kept in arrays, the values in a list
+class ScanLog:
+    def __init__(self):
+        self.positions = array('l')
+        self.step_counts = array('l')
+        self.move_starts = array('d')
+        self.move_ends = array('d')
+        self.measure_times = array('d')
+        self.values = []
+        # condition to wait for new results, and the flag which ends the streams
+        self.condition = threading.Condition()
+        self.closed = False
+
+    # appends a result, called by the scan
+    def append(self, position, step_count, move_start, move_end, measure_time, value):
+        with self.condition:
+            self.positions.append(position)
+            self.step_counts.append(step_count)
+            self.move_starts.append(move_start)
+            self.move_ends.append(move_end)
+            self.measure_times.append(measure_time)
+            self.values.append(value)
+            self.condition.notify_all()
+
+    # gets the number of results
+    def __len__(self):
+        return len(self.values)
+
+    # iterates over the results, as tuples
+    def __iter__(self):
+        return iter(self.get_results())
+
+    # gets a result as a tuple, internal use only, do not call
+    def __get(self, index):
+        return (self.positions[index], self.step_counts[index], self.move_starts[index], self.move_ends[index],
+                self.measure_times[index], self.values[index])
+
+    # gets the results, as a list of tuples
+    def get_results(self):
+        with self.condition:
+            return [self.__get(index) for index in range(len(self.values))]
+
+    # generator yielding the results as they arrive, as tuples, see TelemetryBuffer.stream()
+    # - time_out: time in seconds after which the generator stops if no new result arrives, None to wait until the
+    #   log is closed
+    # - history: when True, the results logged before are yielded first
+    def stream(self, time_out=None, history=False):
+        with self.condition:
+            position = 0 if history else len(self.values)
+        while True:
+            with self.condition:
+                if position >= len(self.values):
+                    deadline = None if time_out is None else time.time() + time_out
+                    while position >= len(self.values):
+                        if self.closed:
+                            return
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            return
+                        self.condition.wait(remaining)
+                results = [self.__get(index) for index in range(position, len(self.values))]
+                position = len(self.values)
+            for result in results:
+                yield result
+
+    # gets the numbers of the results as a dictionary of NumPy arrays, by 'positions', 'step_counts', 'move_starts',
+    # 'move_ends' and 'measure_times', the values are added as 'values' if they are numbers
+    # requires NumPy
+    def to_numpy(self):
+        if numpy is None:
+            raise ImportError('NumPy is required to export scan results to NumPy arrays')
+        with self.condition:
+            columns = {
+                'positions': numpy.array(self.positions, dtype=numpy.int64),
+                'step_counts': numpy.array(self.step_counts, dtype=numpy.int64),
+                'move_starts': numpy.array(self.move_starts, dtype=numpy.float64),
+                'move_ends': numpy.array(self.move_ends, dtype=numpy.float64),
+                'measure_times': numpy.array(self.measure_times, dtype=numpy.float64),
+            }
+            values = list(self.values)
+        try:
+            columns['values'] = numpy.array(values, dtype=numpy.float64)
+        except (TypeError, ValueError):
+            pass
+        return columns
+
+    # closes the log, ending all streams once they have yielded the remaining results
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+# Scan of a motor through a sequence of positions, with a measurement at each
+# The positions are in steps from where the motor is when the scan starts, the motor moves to each position in turn,
+# and the measurement function is called once it has arrived
+# - mc: the MotorControl of the motor
+# - positions: a list, or any iterable, of the positions, which is read one position ahead
+# - measure_func: a function accepting the position, of which the return value is logged
+# - result_func: an optional function accepting the result tuples (see ScanLog), called after each measurement
+# - v_max, accel, profile: optionally, the speed (steps per second) of the moves, and their acceleration (steps per
+#   second squared) and profile, see MotorControl.move(), which requires a controller which supports ramps, by default
+#   the motor moves at its step delay as with do_steps()
+# - pipelined: whether the next move is armed during a measurement, when False, each move is set up and started once
+#   the measurement before it has been taken
+# - log: the ScanLog to append the results to, a new one by default
+class Scan:
+    def __init__(self, mc, positions, measure_func, result_func=None, v_max=None, accel=None,
+                 profile=motion_profile.TRAPEZOIDAL, pipelined=True, log=None):
+        self.mc = mc
+        self.positions = positions
+        self.measure_func = measure_func
+        self.result_func = result_func
+        self.v_max = v_max
+        self.accel = accel
+        self.profile = profile
+        self.pipelined = pipelined
+        self.log = ScanLog() if log is None else log
+        # state of the scan, the condition to wait for it to change, and the event which is set once the scan has ended
+        self.state = IDLE
+        self.state_condition = threading.Condition()
+        self.ended = threading.Event()
+        # the thread running the scan, if started with start()
+        self.scan_thread = None
+
+    # runs the scan on a separate thread, see run()
+    def start(self):
+        self.scan_thread = threading.Thread(target=self.run)
+        self.scan_thread.daemon = True
+        self.scan_thread.start()
+
+    # runs the scan on the calling thread, halting program execution until it has ended
+    # an exception raised by the measurement function ends the scan, as failed, and is raised again
+    # returns the ScanLog, which is closed
+    def run(self):
+        if self.ended.is_set() or self.state in (RUNNING, PAUSED):
+            raise RuntimeError('A scan can only be ran once')
+        try:
+            # a scan aborted before it started does not run
+            if self.__set_state(RUNNING, (IDLE,)):
+                if self.pipelined:
+                    self.__run_pipelined()
+                else:
+                    self.__run_sequential()
+        except Exception:
+            # the measurement or the motor control failed, the motor is stopped, and disarmed
+            self.mc.stop_stepping()
+            self.__set_state(FAILED, (RUNNING, PAUSED))
+            raise
+        finally:
+            self.__set_state(DONE, (RUNNING, PAUSED))
+            self.log.close()
+            self.ended.set()
+        return self.log
+
+    # moves to each position and measures, arming the next move during each measurement, internal use only, do not
+    # call
+    def __run_pipelined(self):
+        segments = self.__get_segments()
+        iterator = (int(target) for target in self.positions)
+        position = 0
+        target = next(iterator, None)
+        arming = self.__arm(target, position, segments)
+        while target is not None:
+            # wait until the move has been armed, and start it
+            if arming is not None:
+                if not (arming.wait(self.mc.time_out) and arming.get_value() is not None and self.__await_turn()):
+                    return self.__fail()
+                move_start = self.mc.start_armed()
+                if move_start is None:
+                    move_start = time.time()
+                if not self.__await_move():
+                    return
+                move_end = time.time()
+                step_count = self.mc.get_last_step_count()
+            else:
+                if not self.__await_turn():
+                    return
+                move_start = move_end = None
+                step_count = 0
+            position = target
+            # arm the next move while measuring
+            target = next(iterator, None)
+            arming = self.__arm(target, position, segments)
+            self.__measure(position, step_count, move_start, move_end)
+
+    # moves to each position and measures, internal use only, do not call
+    def __run_sequential(self):
+        position = 0
+        for target in self.positions:
+            target = int(target)
+            if not self.__await_turn():
+                return
+            move_start = move_end = None
+            step_count = 0
+            if target != position:
+                move_start = time.time()
+                self.mc.do_steps(target - position)
+                if not self.__await_move():
+                    return
+                move_end = time.time()
+                step_count = self.mc.get_last_step_count()
+            position = target
+            self.__measure(position, step_count, move_start, move_end)
+
+    # gets the ramp segments of the moves, by the number of steps, internal use only, do not call
+    # returns a function of the number of steps to the segments, which are None for moves at the step delay
+    def __get_segments(self):
+        if self.accel is not None:
+            return lambda steps: motion_profile.get_segments(steps, self.v_max, self.accel, self.profile)
+        if self.v_max is None:
+            return lambda steps: None
+        interval = int(round(1000000.0 / self.v_max))
+        if interval < motion_profile.MIN_INTERVAL:
+            raise ValueError('Maximum speed exceeds ' + str(1000000 // motion_profile.MIN_INTERVAL)
+                             + ' steps per second')
+        return lambda steps: [(steps, interval, interval)]
+
+    # arms the move to a target position, internal use only, do not call
+    # returns the pending arming, or None if there is nothing to move
+    def __arm(self, target, position, segments):
+        if target is None or target == position:
+            return None
+        return self.mc.arm(target - position, segments(abs(target - position)))
+
+    # waits while the scan is paused, internal use only, do not call
+    # returns False if the scan has been aborted
+    def __await_turn(self):
+        with self.state_condition:
+            while self.state == PAUSED:
+                self.state_condition.wait()
+            return self.state == RUNNING
+
+    # waits until the motor has completed its move, internal use only, do not call
+    # returns False if the scan has been aborted, or the move has not been completed
+    def __await_move(self):
+        self.mc.wait_finish()
+        if self.state == ABORTED:
+            return False
+        if not self.mc.is_valid() or self.mc.get_last_step_count() != self.mc.get_last_step_command():
+            self.__set_state(FAILED, (RUNNING, PAUSED))
+            return False
+        return True
+
+    # ends the scan if a move could not be armed, internal use only, do not call
+    def __fail(self):
+        if self.mc.is_armed():
+            self.mc.stop_stepping()
+        self.__set_state(FAILED, (RUNNING, PAUSED))
+
+    # takes a measurement, and logs it, internal use only, do not call
+    def __measure(self, position, step_count, move_start, move_end):
+        value = self.measure_func(position)
+        measure_time = time.time()
+        if move_start is None:
+            move_start = move_end = measure_time
+        self.log.append(position, step_count, move_start, move_end, measure_time, value)
+        if self.result_func is not None:
+            self.result_func((position, step_count, move_start, move_end, measure_time, value))
+
+    # changes the state if it is one of the given states, internal use only, do not call
+    # returns True if the state has been changed
+    def __set_state(self, state, states):
+        with self.state_condition:
+            if self.state not in states:
+                return False
+            self.state = state
+            self.state_condition.notify_all()
+            return True
+
+    # pauses the scan before its next move, the measurement being taken is completed
+    def pause(self):
+        self.__set_state(PAUSED, (RUNNING,))
+
+    # resumes the paused scan
+    def resume(self):
+        self.__set_state(RUNNING, (PAUSED,))
+
+    # aborts the scan, the motor is stopped right away, and the scan ends without measuring where it stopped
+    def abort(self):
+        if self.__set_state(ABORTED, (IDLE, RUNNING, PAUSED)):
+            self.mc.stop_stepping()
+
+    # halts program execution until the scan has ended, or the time out (in seconds) has passed
+    # - time_out: the time out, None to wait indefinitely
+    # returns True if the scan has ended
+    def wait(self, time_out=None):
+        return self.ended.wait(time_out)
+
+    # gets the state of the scan: IDLE, RUNNING, PAUSED, ABORTED, DONE or FAILED
+    def get_state(self):
+        return self.state
+
+    # gets the ScanLog of the scan
+    def get_log(self):
+        return self.log
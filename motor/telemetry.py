@@ -0,0 +1,108 @@
+import threading
+import time
+from array import array
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, it is only needed for to_numpy()
+    numpy = None
+
+
+# Fixed size ring buffer of (time stamp, step count) telemetry samples, backed by arrays
+# Samples are appended by the reading thread of the motor interface, once the buffer is full the oldest are overwritten
+# - size: the number of samples to keep
+class TelemetryBuffer:
+    def __init__(self, size=4096):
+        self.size = size
+        # time stamps (seconds since the epoch, as time.time()) and step counts
+        self.timestamps = array('d', [0.0]) * size
+        self.counts = array('l', [0]) * size
+        # total number of samples appended, the next sample is written at total % size
+        self.total = 0
+        # condition to wait for new samples, and the flag which ends the streams
+        self.condition = threading.Condition()
+        self.closed = False
+
+    # appends a sample, called by the motor interface
+    def append(self, timestamp, count):
+        with self.condition:
+            index = self.total % self.size
+            self.timestamps[index] = timestamp
+            self.counts[index] = count
+            self.total += 1
+            self.condition.notify_all()
+
+    # gets the number of buffered samples
+    def __len__(self):
+        return min(self.total, self.size)
+
+    # iterates over the buffered samples, oldest first, as (time stamp, step count) tuples
+    def __iter__(self):
+        return iter(self.get_samples())
+
+    # gets the buffered samples, oldest first, as a list of (time stamp, step count) tuples
+    def get_samples(self):
+        with self.condition:
+            return [(self.timestamps[index % self.size], self.counts[index % self.size])
+                    for index in range(self.total - len(self), self.total)]
+
+    # gets the latest sample as a (time stamp, step count) tuple, or None if there are no samples yet
+    def get_latest(self):
+        with self.condition:
+            if self.total == 0:
+                return None
+            index = (self.total - 1) % self.size
+            return self.timestamps[index], self.counts[index]
+
+    # generator yielding the samples as they arrive, as (time stamp, step count) tuples
+    # samples which have been overwritten before they could be yielded are skipped
+    # - time_out: time in seconds after which the generator stops if no new sample arrives, None to wait until the
+    #   buffer is closed
+    # - history: when True, the buffered samples are yielded first
+    def stream(self, time_out=None, history=False):
+        with self.condition:
+            position = self.total - len(self) if history else self.total
+        while True:
+            with self.condition:
+                if position >= self.total:
+                    deadline = None if time_out is None else time.time() + time_out
+                    while position >= self.total:
+                        if self.closed:
+                            return
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            return
+                        self.condition.wait(remaining)
+                # skip the samples which have been overwritten
+                position = max(position, self.total - self.size)
+                samples = [(self.timestamps[index % self.size], self.counts[index % self.size])
+                           for index in range(position, self.total)]
+                position = self.total
+            for sample in samples:
+                yield sample
+
+    # gets the buffered samples, oldest first, as a pair of NumPy arrays: time stamps (float64) and step counts
+    # requires NumPy
+    def to_numpy(self):
+        if numpy is None:
+            raise ImportError('NumPy is required to export telemetry to NumPy arrays')
+        with self.condition:
+            timestamps = numpy.frombuffer(self.timestamps, dtype=numpy.float64).copy()
+            counts = numpy.frombuffer(self.counts, dtype=numpy.dtype('i' + str(self.counts.itemsize))).copy()
+            total = self.total
+        if total < self.size:
+            return timestamps[0:total], counts[0:total]
+        # rotate the oldest sample to the front
+        start = total % self.size
+        return numpy.roll(timestamps, -start), numpy.roll(counts, -start)
+
+    # closes the buffer, ending all streams once they have yielded the remaining samples
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    # removes all samples
+    def clear(self):
+        with self.condition:
+            self.total = 0
@@ -0,0 +1,567 @@
+# Benchmark suite for the control stack, driving MotorControl and MotorFleet against simulated controllers
+# The simulated controllers run in a separate process, so that the CPU time measured is that of the host alone
+#
+# Usage (Python 3, POSIX only), from the root of the repository:
+#   python -m simulator.benchmark [--output benchmark.json] [--quick]
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import pty
+import random
+import sys
+import threading
+import time
+import tty
+
+import stepper_control
+from motor import binary_protocol
+from motor.motor_control import MotorControl, MAX_TAG
+from motor.motor_fleet import MotorFleet
+from motor.motor_interface import MotorInterface
+from motor.multi_axis import MultiAxisMove
+from motor.process_interface import ProcessMotorInterface
+from motor.scan import Scan
+from .simulated_controller import SimulatedController
+
+# time out used for all motors, in seconds
+TIME_OUT = 5
+# maximum number of outstanding poll commands, more than the tags, so that polls in the tagged protocol wait for tags
+POLL_WINDOW = 2 * MAX_TAG
+
+
+# serves simulated controllers until told to stop, to be ran in a separate process, internal use only, do not call
+# sends the ports over the connection when started, and the line statistics when stopped
+def _serve(connection, count, options):
+    controllers = [SimulatedController(**options) for i in range(count)]
+    connection.send([controller.start() for controller in controllers])
+    connection.recv()
+    for controller in controllers:
+        controller.stop()
+    connection.send([{'bytes_received': controller.bytes_received, 'bytes_sent': controller.bytes_sent,
+                      'overruns': controller.get_firmware().overruns} for controller in controllers])
+
+
+# Simulated controllers running in a separate process
+class _Simulators:
+    def __init__(self, count=1, **options):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_connection, count, options))
+        self.process.daemon = True
+        self.process.start()
+        self.ports = self.connection.recv()
+
+    # stops the simulated controllers, returns their line statistics
+    def stop(self):
+        self.connection.send(None)
+        statistics = self.connection.recv()
+        self.process.join()
+        return statistics
+
+
+# ignores messages of the motors
+def _ignore(message):
+    pass
+
+
+# computes the given percentile of a list of samples
+def percentile(samples, p):
+    if len(samples) == 0:
+        return None
+    samples = sorted(samples)
+    return samples[int(round(p / 100.0 * (len(samples) - 1)))]
+
+
+# summarizes a list of durations in seconds, in milliseconds
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'max_ms': max(samples) * 1000,
+    }
+
+
+# connects a motor control to a port, and waits for its validation
+def connect(port, **options):
+    mc = MotorControl(port, TIME_OUT, _ignore, **options)
+    mc.start_connection(0.1)
+    _wait_until(lambda: not mc.is_validating())
+    if not mc.is_valid():
+        raise RuntimeError('Could not validate the simulated controller on ' + port)
+    return mc
+
+
+# waits until a condition holds, internal use only, do not call
+def _wait_until(condition, time_out=TIME_OUT):
+    deadline = time.time() + time_out
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError('Benchmark timed out')
+        time.sleep(0.001)
+
+
+# measures the round trip latency of get_step_count()
+def bench_get_step_count(count, **options):
+    simulators = _Simulators()
+    mc = connect(simulators.ports[0], **options)
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        mc.get_step_count()
+        samples.append(time.perf_counter() - start)
+    mc.stop_connection()
+    simulators.stop()
+    return summarize(samples)
+
+
+# measures the time from do_steps() to the confirmation of the steps
+def bench_first_confirmation(count):
+    simulators = _Simulators()
+    mc = connect(simulators.ports[0])
+    mc.set_step_delay(2)
+    # record the arrival of confirmations as they are handled by the interface
+    confirmations = []
+    confirm_func = mc.mi.confirm_func
+
+    def record(*args):
+        confirmations.append(time.perf_counter())
+        confirm_func(*args)
+    mc.mi.confirm_func = record
+    samples = []
+    for i in range(count):
+        del confirmations[:]
+        start = time.perf_counter()
+        mc.do_steps(1)
+        _wait_until(lambda: not mc.is_stepping())
+        samples.append(confirmations[0] - start)
+    mc.stop_connection()
+    simulators.stop()
+    return summarize(samples)
+
+
+# measures the time do_steps_and_wait_finish() takes beyond the time the steps take
+def bench_wait_finish_overhead(count, steps=100, delay=2):
+    simulators = _Simulators()
+    mc = connect(simulators.ports[0])
+    mc.set_step_delay(delay)
+    # a step is completed at the end of its high phase, the low phase of the last step is not waited for
+    stepping_time = (2 * steps - 1) * delay / 1000.0
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        mc.do_steps_and_wait_finish(steps)
+        samples.append(time.perf_counter() - start - stepping_time)
+    mc.stop_connection()
+    simulators.stop()
+    result = summarize(samples)
+    result['steps'] = steps
+    result['stepping_time_ms'] = stepping_time * 1000
+    return result
+
+
+# measures the time from stop_stepping() to the confirmation that the motor halted, at a random point of a step
+# the controller halts as it sends the confirmation, so this is the stop-to-halt latency as seen by the host, which
+# should not depend on the step delay
+def bench_stop_latency(count, delay=20):
+    simulators = _Simulators()
+    mc = connect(simulators.ports[0])
+    mc.set_step_delay(delay)
+    confirmations = []
+    confirm_func = mc.mi.confirm_func
+
+    def record(*args):
+        confirmations.append(time.perf_counter())
+        confirm_func(*args)
+    mc.mi.confirm_func = record
+    samples = []
+    for i in range(count):
+        mc.do_steps(1000000)
+        # wait for the steps to be confirmed, and stop somewhere within a step
+        _wait_until(lambda: len(confirmations) > 0)
+        time.sleep(random.uniform(0, 2 * delay / 1000.0))
+        del confirmations[:]
+        start = time.perf_counter()
+        mc.stop_stepping()
+        _wait_until(lambda: not mc.is_stepping())
+        samples.append(confirmations[0] - start)
+        del confirmations[:]
+    mc.stop_connection()
+    simulators.stop()
+    result = summarize(samples)
+    result['step_period_ms'] = 2 * delay
+    return result
+
+
+# measures the round trip latency of get_step_count() while the motor is stepping
+def bench_query_while_stepping(count, delay=20):
+    simulators = _Simulators()
+    mc = connect(simulators.ports[0])
+    mc.set_step_delay(delay)
+    mc.do_steps(1000000)
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        mc.get_step_count()
+        samples.append(time.perf_counter() - start)
+    mc.stop_stepping()
+    mc.stop_connection()
+    simulators.stop()
+    result = summarize(samples)
+    result['step_period_ms'] = 2 * delay
+    return result
+
+
+# measures the number of poll_step_count() replies per second, with up to POLL_WINDOW polls outstanding, or as many
+# as a limited line carries in half the time out, as the replies to untagged polls which time out are mismatched
+def bench_poll_rate(duration, line_baudrate=None, **options):
+    simulators = _Simulators(baudrate=line_baudrate)
+    mc = connect(simulators.ports[0], **options)
+    limit = POLL_WINDOW
+    if line_baudrate is not None:
+        # about 16 bytes per tagged text query, of 10 bits each
+        limit = min(limit, int(line_baudrate / 160.0 * TIME_OUT / 2))
+    window = threading.Semaphore(limit)
+    replies = [0]
+    timed_out = [0]
+    outstanding = [0]
+
+    def callback(value):
+        replies[0] += 1
+        if value is None:
+            timed_out[0] += 1
+        window.release()
+    start = time.perf_counter()
+    sent = 0
+    while time.perf_counter() - start < duration:
+        window.acquire()
+        mc.poll_step_count(callback)
+        sent += 1
+        outstanding[0] = max(outstanding[0], sent - replies[0])
+    # wait for the outstanding polls
+    _wait_until(lambda: replies[0] >= sent)
+    elapsed = time.perf_counter() - start
+    mc.stop_connection()
+    statistics = simulators.stop()[0]
+    return {
+        'queries': sent,
+        'timed_out': timed_out[0],
+        'max_outstanding': outstanding[0],
+        'queries_per_second': (sent - timed_out[0]) / elapsed,
+        'bytes_per_query_sent': statistics['bytes_received'] / float(sent),
+        'bytes_per_query_received': statistics['bytes_sent'] / float(sent),
+    }
+
+
+# measures the time to get the replies to bursts of step count queries, against a controller with the 64 byte receive
+# buffer of an Arduino, and the number of queries lost to overruns of that buffer
+def bench_burst(count, burst=100, flow_control=False):
+    simulators = _Simulators(rx_buffer_size=64)
+    mc = connect(simulators.ports[0], tagged=True, flow_control=flow_control)
+    samples = []
+    lost = 0
+    for i in range(count):
+        start = time.perf_counter()
+        values = mc.wait_for_replies([mc.query_step_count() for j in range(burst)])
+        samples.append(time.perf_counter() - start)
+        lost += values.count(None)
+    mc.stop_connection()
+    statistics = simulators.stop()[0]
+    result = summarize(samples)
+    result['burst'] = burst
+    result['lost_queries'] = lost
+    result['overrun_bytes'] = statistics['overruns']
+    return result
+
+
+# holds the GIL for about the given time in seconds, with a single call into C, internal use only, do not call
+def _hold_gil(duration):
+    # calibrate the length of the call first
+    start = time.perf_counter()
+    sum(range(1000000))
+    length = int(1000000 * duration / max(1e-6, time.perf_counter() - start))
+    start = time.perf_counter()
+    sum(range(length))
+    return time.perf_counter() - start
+
+
+# measures how many step count queries time out while the program repeatedly holds the GIL for longer than their time
+# out, with a thread polling the step count meanwhile, and the serial port read by threads or by a worker process
+def bench_gil_stall(count, time_out=0.2, process=False):
+    simulators = _Simulators()
+    mc = MotorControl(simulators.ports[0], time_out, _ignore, tagged=True,
+                      interface_factory=ProcessMotorInterface if process else MotorInterface)
+    mc.start_connection(0.1)
+    _wait_until(lambda: not mc.is_validating())
+    replies = []
+    stalls = []
+
+    def poll():
+        while len(stalls) < count:
+            replies.append(mc.get_step_count())
+    thread = threading.Thread(target=poll)
+    thread.start()
+    for i in range(count):
+        stalls.append(_hold_gil(2 * time_out))
+        time.sleep(0.01)
+    thread.join()
+    mc.stop_connection()
+    simulators.stop()
+    return {
+        'queries': len(replies),
+        'timed_out': replies.count(None),
+        'time_out_ms': time_out * 1000,
+        'mean_stall_ms': sum(stalls) / len(stalls) * 1000,
+    }
+
+
+# measures the CPU time the host spends on idle connections, in CPU seconds per second per connection, and the threads
+# it runs for them
+def bench_idle_cpu(connections, duration, fleet=False):
+    simulators = _Simulators(connections)
+    threads = threading.active_count()
+    if fleet:
+        motor_fleet = MotorFleet(TIME_OUT, _ignore)
+        motors = [motor_fleet.add_motor(port) for port in simulators.ports]
+        motor_fleet.start_connections(0.1)
+        for mc in motors:
+            _wait_until(lambda: not mc.is_validating())
+    else:
+        motors = [connect(port) for port in simulators.ports]
+    threads = threading.active_count() - threads
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    time.sleep(duration)
+    cpu = time.process_time() - start_cpu
+    elapsed = time.perf_counter() - start
+    if fleet:
+        motor_fleet.stop()
+    else:
+        for mc in motors:
+            mc.stop_connection()
+    simulators.stop()
+    return {
+        'connections': connections,
+        'threads': threads,
+        'cpu_seconds_per_second': cpu / elapsed,
+        'cpu_seconds_per_second_per_connection': cpu / elapsed / connections,
+    }
+
+
+# measures the latency of querying the step counts of all motors at once, with one thread per motor or a fleet
+def bench_query_all(connections, count, fleet=False):
+    simulators = _Simulators(connections)
+    if fleet:
+        motor_fleet = MotorFleet(TIME_OUT, _ignore)
+        motors = [motor_fleet.add_motor(port) for port in simulators.ports]
+        motor_fleet.start_connections(0.1)
+        for mc in motors:
+            _wait_until(lambda: not mc.is_validating())
+    else:
+        motors = [connect(port) for port in simulators.ports]
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        if fleet:
+            motor_fleet.get_step_counts()
+        else:
+            commands = [mc.query_step_count() for mc in motors]
+            for mc, command in zip(motors, commands):
+                mc.wait_for_replies([command])
+        samples.append(time.perf_counter() - start)
+    if fleet:
+        motor_fleet.stop()
+    else:
+        for mc in motors:
+            mc.stop_connection()
+    simulators.stop()
+    result = summarize(samples)
+    result['connections'] = connections
+    return result
+
+
+# measures the bytes and the host CPU time of a tagged step count query and its reply, in the text or binary protocol,
+# and the query rate this leaves on serial lines of common baud rates, which carry 10 bits per byte
+def bench_codec(count, binary=False):
+    replies = []
+    mi = MotorInterface(None, lambda *reply: replies.append(reply), _ignore, _ignore)
+    mi.binary = binary
+    if binary:
+        reply = binary_protocol.encode_reply(binary_protocol.REPLY_VALUE, 1000, 12)
+        handle = mi.handle_frame
+    else:
+        reply = b'[v]12:1000\r\n'
+        handle = mi.handle_line
+    command_bytes = len(mi.encode_command('getStepCount', 12))
+    start = time.perf_counter()
+    for i in range(count):
+        mi.encode_command('getStepCount', 12)
+        handle(reply)
+        mi.update_tick()
+    elapsed = time.perf_counter() - start
+    if len(replies) != count:
+        raise RuntimeError('Replies were lost')
+    # the line in the busier direction limits the query rate
+    busiest = max(command_bytes, len(reply))
+    return {
+        'bytes_per_query_sent': command_bytes,
+        'bytes_per_query_received': len(reply),
+        'host_us_per_query': elapsed / count * 1000000,
+        'queries_per_second_9600': 9600 / 10.0 / busiest,
+        'queries_per_second_115200': 115200 / 10.0 / busiest,
+    }
+
+
+# measures the skew between the axes of multi-axis moves, and the time their runs take beyond the moves themselves
+def bench_multi_axis(count, axes=3, rate=2000):
+    simulators = _Simulators(axes)
+    motors = [connect(port) for port in simulators.ports]
+    skews = []
+    overheads = []
+    for i in range(count):
+        move = MultiAxisMove(motors, [random.randint(-200, 200) or 1 for motor in motors], rate)
+        start = time.perf_counter()
+        if not move.run(TIME_OUT):
+            raise RuntimeError('Multi-axis move failed')
+        overheads.append(time.perf_counter() - start - move.get_duration())
+        skews.append(move.get_skew())
+    for motor in motors:
+        motor.stop_connection()
+    simulators.stop()
+    result = summarize(overheads)
+    result['axes'] = axes
+    result['skew_p50_us'] = percentile(skews, 50) * 1000000
+    result['skew_p99_us'] = percentile(skews, 99) * 1000000
+    return result
+
+
+# measures the time of a scan through a number of points, with a measurement taking a fixed time at each, by the
+# legacy loop of do_steps_and_wait_finish() and measurements, and by a pipelined Scan
+def bench_scan(points, steps=10, delay=2, measure_time=0.005, line_baudrate=None, **options):
+    simulators = _Simulators(baudrate=line_baudrate)
+    mc = connect(simulators.ports[0], **options)
+    mc.set_step_delay(delay)
+
+    def measure(position):
+        time.sleep(measure_time)
+        return position
+    start = time.perf_counter()
+    for i in range(points):
+        mc.do_steps_and_wait_finish(steps)
+        measure(i)
+    legacy = time.perf_counter() - start
+    start = time.perf_counter()
+    log = Scan(mc, [(i + 1) * steps for i in range(points)], measure).run()
+    scan = time.perf_counter() - start
+    if len(log) != points or any(step_count != steps for step_count in log.step_counts):
+        raise RuntimeError('Scan failed')
+    mc.stop_connection()
+    simulators.stop()
+    return {
+        'points': points,
+        'steps': steps,
+        'measure_time_ms': measure_time * 1000,
+        'legacy_ms': legacy * 1000,
+        'scan_ms': scan * 1000,
+        'legacy_per_point_ms': legacy / points * 1000,
+        'scan_per_point_ms': scan / points * 1000,
+    }
+
+
+# measures the time to discover controllers which are booting, on ports probed together with a silent port which
+# takes the boot time and the whole time out
+def bench_discover(connections, boot_time=0.5, time_out=2):
+    simulators = _Simulators(connections, boot_time=boot_time)
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    silent = os.ttyname(slave)
+    start = time.perf_counter()
+    found = stepper_control.discover_controllers(simulators.ports, time_out, boot_time=boot_time)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    found_with_silent = stepper_control.discover_controllers(simulators.ports + [silent], time_out,
+                                                             boot_time=boot_time)
+    elapsed_with_silent = time.perf_counter() - start
+    simulators.stop()
+    os.close(master)
+    os.close(slave)
+    return {
+        'connections': connections,
+        'boot_time_ms': boot_time * 1000,
+        'time_out_ms': time_out * 1000,
+        'found': len(found),
+        'discover_ms': elapsed * 1000,
+        'found_with_silent_port': len(found_with_silent),
+        'silent_port_found': silent in found_with_silent,
+        'discover_with_silent_port_ms': elapsed_with_silent * 1000,
+    }
+
+
+# runs all benchmarks, returns the results as a dictionary
+# - quick: when True, fewer samples are taken
+def run(quick=False, report=print):
+    scale = 0.1 if quick else 1.0
+    count = max(10, int(1000 * scale))
+    duration = 2 * scale
+    results = {}
+
+    def bench(name, func, *args, **kwargs):
+        report('Running ' + name)
+        results[name] = func(*args, **kwargs)
+
+    for protocol, options in (('text', {}), ('tagged', {'tagged': True}), ('binary', {'binary': True})):
+        bench('get_step_count_' + protocol, bench_get_step_count, count, **options)
+    bench('do_steps_first_confirmation', bench_first_confirmation, max(5, int(50 * scale)))
+    bench('do_steps_and_wait_finish_overhead', bench_wait_finish_overhead, max(3, int(20 * scale)))
+    for protocol, binary in (('text', False), ('binary', True)):
+        bench('codec_' + protocol, bench_codec, max(1000, int(100000 * scale)), binary=binary)
+    bench('stop_latency', bench_stop_latency, max(5, int(50 * scale)))
+    bench('get_step_count_while_stepping', bench_query_while_stepping, max(10, int(200 * scale)))
+    # without flow control, every burst waits for the time out of its lost queries
+    bench('burst_no_flow_control', bench_burst, 3)
+    bench('burst_flow_control', bench_burst, max(3, int(20 * scale)), flow_control=True)
+    bench('multi_axis', bench_multi_axis, max(5, int(50 * scale)))
+    for line in (None, 9600):
+        for protocol, options in (('tagged', {'tagged': True}), ('binary', {'tagged': True, 'binary': True})):
+            name = 'scan_' + protocol + ('_unlimited' if line is None else '_' + str(line))
+            bench(name, bench_scan, max(10, int(100 * scale)), line_baudrate=line, **options)
+    for process in (False, True):
+        bench('gil_stall_' + ('process' if process else 'threads'), bench_gil_stall, max(5, int(20 * scale)),
+              process=process)
+    for line in (None, 115200, 9600):
+        for protocol, options in (('text', {}), ('tagged', {'tagged': True}), ('binary', {'binary': True})):
+            name = 'poll_rate_' + protocol + ('_unlimited' if line is None else '_' + str(line))
+            bench(name, bench_poll_rate, duration, line_baudrate=line, **options)
+    for connections in (1, 8, 32):
+        bench('discover_' + str(connections), bench_discover, connections)
+        for fleet in (False, True):
+            suffix = ('fleet_' if fleet else 'threads_') + str(connections)
+            bench('idle_cpu_' + suffix, bench_idle_cpu, connections, max(1, duration), fleet=fleet)
+            bench('query_all_' + suffix, bench_query_all, connections, max(10, int(200 * scale)), fleet=fleet)
+    return results
+
+
+# runs the benchmarks and writes the results to a JSON file
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the control stack against simulated controllers.')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--quick', action='store_true', help='take fewer samples')
+    arguments = parser.parse_args(arguments)
+    results = run(arguments.quick)
+    document = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': arguments.quick,
+        'results': results,
+    }
+    with open(arguments.output, 'w') as output:
+        json.dump(document, output, indent=2, sort_keys=True)
+    print('Results written to ' + arguments.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
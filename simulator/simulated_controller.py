@@ -0,0 +1,160 @@
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from .simulated_firmware import SimulatedFirmware
+
+
+# Class exposing a simulated stepper controller on a pseudo terminal, so it can be opened like a real serial port
+# The firmware is simulated by a SimulatedFirmware, the serial line in between is simulated by this class
+# Note: pseudo terminals are only available on POSIX systems
+# - latency: delay in seconds before received bytes reach the firmware
+# - baudrate: baud rate of the simulated serial line, which limits its throughput, None for an unlimited line
+# - drop_rate: probability that a line or frame sent by the firmware is lost
+# - garble_rate: probability that a byte of a line or frame sent by the firmware is corrupted
+# - boot_time: time in seconds after starting during which the controller boots and ignores its input
+# - seed: optional seed for the fault injection, to make runs reproducible
+# - rx_buffer_size: size of the receive buffer of the firmware, bytes arriving while it is full are lost, None for an
+#   unbounded buffer
+class SimulatedController:
+    def __init__(self, latency=0, baudrate=None, drop_rate=0, garble_rate=0, boot_time=0, seed=None,
+                 rx_buffer_size=None):
+        # serial line parameters
+        self.latency = latency
+        self.baudrate = baudrate
+        # fault injection parameters
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.random = random.Random(seed)
+        # boot time, and the time at which booting is done
+        self.boot_time = boot_time
+        self.boot_end = 0
+        # the simulated firmware, the line follows its baud rate switches if the line is limited
+        self.firmware = SimulatedFirmware(self.__write_func, self.__baud_func, rx_buffer_size)
+        # pseudo terminal file descriptors, the slave end is kept open so the master end survives the port closing
+        self.master = -1
+        self.slave = -1
+        self.port = None
+        # statistics of the simulated line
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.garbled = 0
+        # bytes on their way to the firmware, as (time due, data), and the time the line is done with the bytes sent
+        self.in_transit = deque()
+        self.line_free = 0
+        # lock for writing to the pseudo terminal
+        self.write_lock = threading.Lock()
+        # Run flag
+        self.running = False
+        # Thread reading the pseudo terminal
+        self.read_thread = threading.Thread(target=self.__read_func)
+        self.read_thread.daemon = True
+
+    # method for reading, to be ran on a separate thread, internal use only, do not call
+    def __read_func(self):
+        while self.running:
+            # wait for bytes, or until the next bytes in transit are due
+            wait = 0.1
+            if len(self.in_transit) > 0:
+                wait = min(wait, max(0, self.in_transit[0][0] - time.time()))
+            try:
+                readable = select.select([self.master], [], [], wait)[0]
+                data = os.read(self.master, 1024) if readable else b''
+            except (OSError, ValueError):
+                # disconnected
+                break
+            now = time.time()
+            if len(data) > 0:
+                self.bytes_received += len(data)
+                # the bytes are lost while the controller is still booting, else simulate the line: the bytes arrive
+                # once the line has sent them, after the latency, chunks are under way together so it does not add up
+                if now >= self.boot_end:
+                    self.line_free = max(now, self.line_free) + self.__transfer_time(len(data))
+                    self.in_transit.append((self.line_free + self.latency, data))
+            while len(self.in_transit) > 0 and self.in_transit[0][0] <= now:
+                self.firmware.receive(self.in_transit.popleft()[1])
+
+    # method to send the bytes of the firmware over the line, internal use only, do not call
+    def __write_func(self, data):
+        if self.drop_rate > 0 and self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        if self.garble_rate > 0:
+            data = bytearray(data)
+            # the delimiter is left intact, so that only this line or frame is affected
+            for index in range(len(data) - 1):
+                if self.random.random() < self.garble_rate:
+                    data[index] = data[index] ^ (1 << self.random.randint(0, 6))
+                    self.garbled += 1
+            data = bytes(data)
+        # the firmware blocks while its bytes are being sent
+        delay = self.__transfer_time(len(data))
+        if delay > 0:
+            time.sleep(delay)
+        with self.write_lock:
+            if self.master < 0:
+                return
+            try:
+                os.write(self.master, data)
+            except OSError:
+                return
+        self.bytes_sent += len(data)
+
+    # method following the baud rate switches of the firmware, internal use only, do not call
+    def __baud_func(self, baudrate):
+        if self.baudrate is not None:
+            self.baudrate = baudrate
+
+    # time in seconds to transfer the given number of bytes (8N1: 10 bits per byte), internal use only, do not call
+    def __transfer_time(self, length):
+        if self.baudrate is None:
+            return 0
+        return length * 10.0 / self.baudrate
+
+    # get the port to pass to MotorControl or MotorInterface
+    def get_port(self):
+        return self.port
+
+    # gets the simulated firmware, to inspect its state
+    def get_firmware(self):
+        return self.firmware
+
+    # starts the simulated controller, returns the port
+    def start(self):
+        if not self.running:
+            self.master, self.slave = pty.openpty()
+            tty.setraw(self.slave)
+            self.port = os.ttyname(self.slave)
+            self.boot_end = time.time() + self.boot_time
+            self.running = True
+            self.read_thread.start()
+            self.firmware.start()
+        return self.port
+
+    # simulates pulling the cable: the port stops responding and reading it fails
+    def disconnect(self):
+        self.running = False
+        self.firmware.stop_running()
+        with self.write_lock:
+            if self.master >= 0:
+                os.close(self.master)
+                self.master = -1
+        if self.slave >= 0:
+            os.close(self.slave)
+            self.slave = -1
+
+    # stops the simulated controller
+    def stop(self):
+        self.disconnect()
+        if self.read_thread.is_alive() and threading.current_thread() is not self.read_thread:
+            self.read_thread.join()
+
+    # method to check if the simulated controller is running
+    def is_running(self):
+        return self.running
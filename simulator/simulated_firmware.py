@@ -0,0 +1,518 @@
+import threading
+import time
+from collections import deque
+
+from motor import binary_protocol
+from motor.motion_profile import expand_segments
+
+
+# parses the leading integer of a string like C's strtol(), skipping leading white space
+# returns a (value, rest of the string) tuple, or None if there is no integer
+def parse_long(string):
+    string = string.lstrip()
+    end = 1 if string[0:1] in ('-', '+') else 0
+    while end < len(string) and string[end].isdigit():
+        end += 1
+    try:
+        return int(string[0:end]), string[end:]
+    except ValueError:
+        return None
+
+
+# parses the leading integer of a string like C's atoi(), returns 0 if there is none
+def to_int(string):
+    parsed = parse_long(string)
+    return 0 if parsed is None else parsed[0]
+
+
+# Class reimplementing Stepping_Code.ino, command for command, on a thread instead of an Arduino
+# The sketch's loop() is mirrored: one command is handled per pass, and the step pin is toggled when it is due, where
+# the sketch spins until then the simulation sleeps until then or until input arrives
+# - write_func: a function reference accepting the bytes the firmware sends
+# - baud_func: a function reference accepting the new baud rate when the firmware switches
+# - rx_buffer_size: size of the serial receive buffer (64 bytes on an Arduino), bytes arriving while it is full are
+#   lost, None for an unbounded buffer
+class SimulatedFirmware:
+    # capability flags: tagged protocol, binary protocol, baud rate switching, telemetry, ramped moves, the move queue
+    # and flow control credits
+    CAPABILITIES = 127
+    # baud rates the firmware can switch to
+    BAUD_RATES = (115200, 250000, 500000)
+    # time in seconds after which a baud rate switch is reverted without a valid command
+    BAUD_RATE_CHECK_TIME = 0.5
+    # maximum size of a binary frame, and of a text command including its terminator
+    FRAME_SIZE = 32
+    CMD_SIZE = 64
+    # number of integer arguments of the commands, mirrors the command table, 'baud' and 'credits' are only available
+    # in text
+    ARGUMENT_COUNTS = dict((name, binary_protocol.ARGUMENT_COUNTS.get(name, 0)) for name in binary_protocol.COMMANDS)
+    ARGUMENT_COUNTS['baud'] = 1
+    ARGUMENT_COUNTS['credits'] = 0
+    # number of bytes read before they are reported as credits
+    CREDIT_BATCH = 16
+    # maximum number of ramp segments, and the shortest interval of a ramp in microseconds
+    RAMP_SIZE = 16
+    MIN_RAMP_INTERVAL = 100
+    # maximum number of queued moves
+    MOVE_QUEUE_SIZE = 8
+
+    def __init__(self, write_func, baud_func=None, rx_buffer_size=None):
+        # output callbacks
+        self.write_func = write_func
+        self.baud_func = baud_func
+        # received bytes which have not been read yet, and the condition to wait for them
+        self.rx_buffer = bytearray()
+        self.rx_condition = threading.Condition()
+        # size of the receive buffer, and the number of bytes lost because it was full
+        self.rx_buffer_size = rx_buffer_size
+        self.overruns = 0
+        # command tracking fields
+        self.cmd = ''
+        self.cmd_overflow = False
+        self.has_cmd = False
+        self.cmd_tag = -1
+        # the command being handled: its name and integer arguments
+        self.cmd_name = ''
+        self.arguments = []
+        # status field (0: standby, 1: running)
+        self.mode = 0
+        # stepping parameters
+        self.step_counter = 0
+        self.step_target = 0
+        self.step_delay = 5
+        self.forward = True
+        # telemetry parameters
+        self.telemetry_interval = 0
+        self.telemetry_steps = 0
+        self.telemetry_time = 0
+        # ramp parameters: the segments, and the intervals of the ramp being stepped, in microseconds
+        self.ramp = []
+        self.ramp_active = False
+        self.ramp_intervals = deque()
+        # step scheduler parameters: the state of the step pin, the wait (s) before the next toggle, and the time of the
+        # last toggle
+        self.step_high = False
+        self.step_wait = 0
+        self.last_step_time = 0
+        # queued moves (signed steps), and whether the steps being taken are those of a queued move
+        self.move_queue = deque()
+        self.queued_move = False
+        # protocol fields
+        self.binary_mode = False
+        self.frame = bytearray()
+        self.baud_rate = 9600
+        self.previous_baud_rate = 9600
+        self.baud_rate_check = False
+        self.baud_rate_switch_time = 0
+        # flow control fields: enabled, and the bytes read which have not been reported yet
+        self.credit_mode = False
+        self.credit_bytes = 0
+        # total number of steps performed since creation
+        self.total_steps = 0
+        # when set to a list, the time of each step is appended to it
+        self.step_log = None
+        # Run flag
+        self.running = False
+        # Thread running the loop
+        self.loop_thread = threading.Thread(target=self.__loop_func)
+        self.loop_thread.daemon = True
+
+    # passes bytes received over the serial line to the firmware
+    def receive(self, data):
+        with self.rx_condition:
+            if self.rx_buffer_size is not None and len(self.rx_buffer) + len(data) > self.rx_buffer_size:
+                room = max(0, self.rx_buffer_size - len(self.rx_buffer))
+                self.overruns += len(data) - room
+                data = data[0:room]
+            self.rx_buffer.extend(data)
+            self.rx_condition.notify()
+
+    # starts running the firmware
+    def start(self):
+        self.running = True
+        self.loop_thread.start()
+
+    # stops running the firmware
+    def stop_running(self):
+        self.running = False
+        with self.rx_condition:
+            self.rx_condition.notify()
+        if self.loop_thread.is_alive() and threading.current_thread() is not self.loop_thread:
+            self.loop_thread.join()
+
+    # loop thread function, internal use only, do not call
+    def __loop_func(self):
+        while self.running:
+            self.loop()
+            self.serial_event()
+
+    # mirrors loop()
+    def loop(self):
+        # revert a baud rate switch which was not followed by a valid command
+        if self.baud_rate_check and time.time() - self.baud_rate_switch_time > self.BAUD_RATE_CHECK_TIME:
+            self.set_baud_rate(self.previous_baud_rate)
+            self.baud_rate_check = False
+        if self.has_cmd:
+            self.handle_command()
+        if self.mode == 1:
+            self.run()
+            # push the step count if the telemetry interval has passed
+            if self.mode == 1 and self.telemetry_interval > 0 \
+                    and time.time() - self.telemetry_time >= self.telemetry_interval / 1000.0:
+                self.telemetry_time = time.time()
+                self.send_telemetry(self.step_counter)
+        elif len(self.move_queue) > 0 and self.step_target == 0:
+            self.start_queued_move()
+        else:
+            # idle: the sketch spins, here we sleep until input arrives
+            with self.rx_condition:
+                if len(self.rx_buffer) == 0 and self.running:
+                    self.rx_condition.wait(0.05)
+
+    # mirrors serialEvent(): reads input until a command is complete
+    def serial_event(self):
+        with self.rx_condition:
+            while not self.has_cmd and len(self.rx_buffer) > 0:
+                input_char = self.rx_buffer[0]
+                del self.rx_buffer[0]
+                if self.credit_mode:
+                    self.credit_bytes += 1
+                if self.binary_mode:
+                    # binary frames end with a 0 byte
+                    if input_char == 0:
+                        self.has_cmd = True
+                    else:
+                        self.frame.append(input_char)
+                elif input_char == ord('\n'):
+                    self.has_cmd = True
+                elif len(self.cmd) < self.CMD_SIZE - 1:
+                    self.cmd = self.cmd + chr(input_char)
+                else:
+                    self.cmd_overflow = True
+
+    # mirrors handleCommand()
+    def handle_command(self):
+        if self.binary_mode:
+            if not self.decode_frame():
+                self.send_message('Invalid frame.')
+            else:
+                self.baud_rate_check = False
+                self.run_command()
+            self.frame = bytearray()
+        else:
+            if not self.parse_command():
+                self.send_message('Invalid command.')
+            else:
+                self.baud_rate_check = False
+                self.run_command()
+        self.cmd = ''
+        self.cmd_overflow = False
+        self.cmd_tag = -1
+        self.has_cmd = False
+        # report the bytes read, now that the host may send the next ones
+        if self.credit_mode and self.credit_bytes >= self.CREDIT_BATCH:
+            self.send_credits(self.credit_bytes)
+            self.credit_bytes = 0
+
+    # mirrors decodeFrame()
+    def decode_frame(self):
+        if len(self.frame) > self.FRAME_SIZE:
+            return False
+        try:
+            cmd, tag = binary_protocol.decode_command(bytes(self.frame))
+        except ValueError:
+            return False
+        self.cmd_tag = -1 if tag is None else tag
+        parts = cmd.split(' ')
+        self.cmd_name = parts[0]
+        self.arguments = [int(argument) for argument in parts[1:]]
+        return True
+
+    # mirrors parseCommand()
+    def parse_command(self):
+        if self.cmd_overflow:
+            return False
+        cmd = self.cmd
+        separator = cmd.find('#')
+        if separator >= 0:
+            self.cmd_tag = to_int(cmd[separator + 1:])
+            cmd = cmd[0:separator]
+        space = cmd.find(' ')
+        self.cmd_name = cmd if space < 0 else cmd[0:space]
+        if self.cmd_name not in self.ARGUMENT_COUNTS:
+            return False
+        self.arguments = []
+        rest = '' if space < 0 else cmd[space:]
+        for i in range(self.ARGUMENT_COUNTS[self.cmd_name]):
+            parsed = parse_long(rest)
+            if parsed is None:
+                return False
+            argument, rest = parsed
+            self.arguments.append(argument)
+        return True
+
+    # mirrors the command handlers
+    def run_command(self):
+        cmd = self.cmd_name
+        arguments = self.arguments
+        if cmd == 'stepper_control':
+            self.send_confirmation(1)
+        elif cmd == 'tagged':
+            self.send_confirmation(self.CAPABILITIES)
+        elif cmd == 'baud':
+            rate = arguments[0]
+            if rate in self.BAUD_RATES:
+                self.send_confirmation(rate)
+                self.previous_baud_rate = self.baud_rate
+                self.set_baud_rate(rate)
+                self.baud_rate_check = True
+                self.baud_rate_switch_time = time.time()
+            else:
+                self.send_confirmation(0)
+        elif cmd == 'credits':
+            self.credit_mode = True
+            self.credit_bytes = 0
+        elif cmd == 'binary':
+            self.send_confirmation(1)
+            self.binary_mode = True
+        elif cmd == 'start':
+            if self.mode != 1:
+                self.mode = 1
+                self.start_steps()
+                self.send_message('Stepping ' + str(self.step_target) + ' steps')
+            else:
+                self.send_message('Already running.')
+        elif cmd == 'stop':
+            if self.mode == 0 and len(self.move_queue) > 0:
+                self.send_message('Stopping')
+                self.discard_queued_moves()
+            elif self.mode == 0:
+                self.send_message('Already in standby.')
+            else:
+                self.send_message('Stopping')
+                self.stop()
+        elif cmd == 'reset':
+            if self.mode == 1:
+                self.send_message('Cannot reset while running.')
+            else:
+                self.send_message('Reset state.')
+                self.reset()
+        elif cmd == 'forwards':
+            self.forward = True
+            self.send_message('Motor set forward')
+        elif cmd == 'backwards':
+            self.forward = False
+            self.send_message('Motor set backward')
+        elif cmd == 'getStepCount':
+            self.send_value(self.step_counter)
+        elif cmd == 'getStepTarget':
+            self.send_value(self.step_target)
+        elif cmd == 'isForward':
+            self.send_value(1 if self.forward else 0)
+        elif cmd == 'isBackward':
+            self.send_value(0 if self.forward else 1)
+        elif cmd == 'getDelay':
+            self.send_value(self.step_delay)
+        elif cmd == 'telemetry':
+            self.telemetry_interval = max(0, arguments[0])
+            self.telemetry_time = time.time()
+            self.send_message('Telemetry interval ' + str(self.telemetry_interval) + ' ms')
+        elif cmd == 'telemetrySteps':
+            self.telemetry_steps = max(0, arguments[0])
+            self.send_message('Telemetry every ' + str(self.telemetry_steps) + ' steps')
+        elif cmd == 'ramp':
+            if arguments[0] <= 0 or arguments[1] < self.MIN_RAMP_INTERVAL or arguments[2] < self.MIN_RAMP_INTERVAL:
+                self.send_message('Invalid ramp segment.')
+            elif len(self.ramp) >= self.RAMP_SIZE or self.ramp_active:
+                self.send_message('Cannot add ramp segment.')
+            else:
+                self.ramp.append(tuple(arguments))
+        elif cmd == 'move':
+            if self.mode == 1 or self.ramp_active:
+                self.send_message('Cannot move while running.')
+            elif len(self.ramp) == 0:
+                self.send_message('No ramp segments.')
+            else:
+                self.step_target = self.step_target + sum(steps for steps, start, end in self.ramp)
+                self.ramp_active = True
+                self.ramp_intervals = deque(expand_segments(self.ramp))
+                self.send_confirmation(self.step_target)
+        elif cmd == 'queue':
+            steps = arguments[0]
+            if steps == 0 or len(self.move_queue) >= self.MOVE_QUEUE_SIZE:
+                self.send_move_completion(0)
+            else:
+                self.move_queue.append(steps)
+        elif cmd == 'flush':
+            self.send_value(len(self.move_queue))
+            self.move_queue.clear()
+        elif cmd == 'step':
+            steps = arguments[0]
+            if steps > 0:
+                self.step_target = self.step_target + steps
+                self.send_confirmation(self.step_target)
+        elif cmd == 'delay':
+            self.send_message('delay ' + str(arguments[0]))
+            if arguments[0] > 1:
+                self.step_delay = arguments[0]
+            else:
+                self.send_message('Delay must be larger than 1 (minimum 2)')
+
+    # mirrors stop()
+    def stop(self):
+        if self.queued_move:
+            self.send_move_completion(self.step_counter)
+        else:
+            self.send_confirmation(self.step_counter)
+        self.discard_queued_moves()
+        self.send_message('Stopped after ' + str(self.step_counter) + '/' + str(self.step_target) + ' steps.')
+        self.reset()
+
+    # mirrors run()
+    def run(self):
+        if self.step_target > 0:
+            stepped = self.ramp_step() if self.ramp_active else self.step()
+            if not stepped:
+                return
+            if self.step_log is not None:
+                self.step_log.append(time.time())
+            self.step_counter = self.step_counter + 1
+            self.total_steps = self.total_steps + 1
+            # push the step count every number of steps
+            if self.telemetry_steps > 0 and self.step_counter % self.telemetry_steps == 0:
+                self.send_telemetry(self.step_counter)
+            if self.step_counter >= self.step_target and self.queued_move:
+                self.send_move_completion(self.step_counter)
+                self.reset()
+            elif self.step_counter >= self.step_target:
+                self.send_confirmation(self.step_counter)
+                self.send_message('Completed ' + str(self.step_counter) + ' steps.')
+                self.reset()
+        else:
+            self.reset()
+
+    # mirrors setBaudRate()
+    def set_baud_rate(self, rate):
+        self.baud_rate = rate
+        self.cmd = ''
+        self.cmd_overflow = False
+        self.frame = bytearray()
+        if self.baud_func is not None:
+            self.baud_func(rate)
+
+    # mirrors reset()
+    def reset(self):
+        self.mode = 0
+        self.step_target = 0
+        self.step_counter = 0
+        self.ramp = []
+        self.ramp_active = False
+        self.queued_move = False
+        self.step_high = False
+
+    # mirrors startQueuedMove()
+    def start_queued_move(self):
+        steps = self.move_queue.popleft()
+        self.forward = steps > 0
+        self.step_target = abs(steps)
+        self.step_counter = 0
+        self.queued_move = True
+        self.mode = 1
+        self.start_steps()
+
+    # mirrors discardQueuedMoves()
+    def discard_queued_moves(self):
+        while len(self.move_queue) > 0:
+            self.move_queue.popleft()
+            self.send_move_completion(0)
+
+    # mirrors rampStep(): takes the next step of the ramp once its interval has passed, returns False if it is not time
+    # yet, in which case it sleeps until then or until input arrives, where the sketch would spin
+    def ramp_step(self):
+        due = self.last_step_time + self.ramp_intervals[0] / 1000000.0
+        remaining = due - time.time()
+        if remaining > 0:
+            with self.rx_condition:
+                if len(self.rx_buffer) == 0 and self.running:
+                    self.rx_condition.wait(remaining)
+            return False
+        # the next interval is timed from when this step was due
+        self.last_step_time = due
+        self.ramp_intervals.popleft()
+        if len(self.ramp_intervals) == 0:
+            self.ramp_active = False
+            self.ramp = []
+            self.step_wait = self.step_delay / 1000.0
+        return True
+
+    # mirrors startSteps()
+    def start_steps(self):
+        wait = self.step_delay / 1000.0
+        if self.ramp_active or time.time() - self.last_step_time >= wait:
+            self.last_step_time = time.time()
+            self.step_wait = 0
+        else:
+            self.step_wait = wait
+
+    # mirrors step(): toggles the step pin once its wait has passed, returns True when a step has been completed
+    # where the sketch would spin, it sleeps until the toggle is due or until input arrives
+    def step(self):
+        now = time.time()
+        remaining = self.last_step_time + self.step_wait - now
+        if remaining > 0:
+            with self.rx_condition:
+                if len(self.rx_buffer) == 0 and self.running:
+                    self.rx_condition.wait(remaining)
+            return False
+        if now - self.last_step_time < 2 * self.step_wait:
+            self.last_step_time = self.last_step_time + self.step_wait
+        else:
+            self.last_step_time = now
+        self.step_wait = self.step_delay / 1000.0
+        self.step_high = not self.step_high
+        return not self.step_high
+
+    # mirrors sendMessage()
+    def send_message(self, msg):
+        if self.binary_mode:
+            # messages are truncated to fit the frame
+            self.write_func(binary_protocol.encode_reply(binary_protocol.REPLY_MESSAGE, msg[0:self.FRAME_SIZE - 2]))
+        else:
+            self.write_func(('[m]' + msg + '\r\n').encode('ascii'))
+
+    # mirrors sendValue()
+    def send_value(self, value):
+        self.__send_reply('[v]', binary_protocol.REPLY_VALUE, value)
+
+    # mirrors sendConfirmation()
+    def send_confirmation(self, value):
+        self.__send_reply('[c]', binary_protocol.REPLY_CONFIRMATION, value)
+
+    # mirrors sendTelemetry()
+    def send_telemetry(self, value):
+        if self.binary_mode:
+            self.write_func(binary_protocol.encode_reply(binary_protocol.REPLY_TELEMETRY, value))
+        else:
+            self.write_func(('[t]' + str(value) + '\r\n').encode('ascii'))
+
+    # mirrors sendMoveCompletion()
+    def send_move_completion(self, value):
+        if self.binary_mode:
+            self.write_func(binary_protocol.encode_reply(binary_protocol.REPLY_MOVE, value))
+        else:
+            self.write_func(('[q]' + str(value) + '\r\n').encode('ascii'))
+
+    # mirrors sendCredits()
+    def send_credits(self, value):
+        if self.binary_mode:
+            self.write_func(binary_protocol.encode_reply(binary_protocol.REPLY_CREDIT, value))
+        else:
+            self.write_func(('[k]' + str(value) + '\r\n').encode('ascii'))
+
+    # sends a value or confirmation, with the tag of the current command, internal use only, do not call
+    def __send_reply(self, prefix, reply_type, value):
+        tag = None if self.cmd_tag < 0 else self.cmd_tag
+        if self.binary_mode:
+            self.write_func(binary_protocol.encode_reply(reply_type, value, tag))
+        else:
+            self.write_func((prefix + ('' if tag is None else str(tag) + ':') + str(value) + '\r\n').encode('ascii'))
@@ -1,7 +1,9 @@
+import threading
+
 import serial.tools.list_ports
 
-from motor.motor_control import MotorControl
-from motor.motor_interface import MotorInterface
+from motor.motor_control import MotorControl, BOOT_TIME
+from motor.motor_interface import MotorInterface, BLOCK, QUEUE_SIZE
 
 
 # Creates a new motor controller object
@@ -9,8 +11,61 @@ from motor.motor_interface import MotorInterface
 # - time_out: an integer specifying the time in seconds to wait until no response is considered a time-out
 # - message_func: a function reference accepting a single String as parameter
 # - debug: a boolean, when True, all communication with the motor will be printed to the console
-def create_motor_controller(port, time_out, message_func, debug=False):
-    return MotorControl(port, time_out, message_func, debug)
+# - tagged: a boolean, when True, the tagged protocol is used if the controller supports it
+# - binary: a boolean, when True, the binary protocol is used if the controller supports it
+# - baudrate: an integer specifying the baud rate to open the port with
+# - negotiate_baudrate: a boolean, when True, the fastest baud rate supported by the controller is negotiated
+# - flow_control: a boolean, when True, commands are only sent while the controller has room for them
+# - queue_size: an integer specifying the number of commands to queue, 0 for no limit
+# - policy: what to do when the command queue is full: 'block', 'drop_oldest' or 'raise' (see motor/motor_interface.py)
+# - instrumentation: an optional Instrumentation object (see motor/instrumentation.py) to record statistics in
+# - process: a boolean, when True, the serial port is read and written by a worker process (Python 3 only, see
+#   motor/process_interface.py)
+def create_motor_controller(port, time_out, message_func, debug=False, tagged=False, binary=False, baudrate=9600,
+                            negotiate_baudrate=False, flow_control=False, queue_size=QUEUE_SIZE, policy=BLOCK,
+                            instrumentation=None, process=False):
+    interface_factory = MotorInterface
+    if process:
+        # imported here, as the worker process exchanges data through memoryviews which Python 2 can not cast
+        from motor.process_interface import ProcessMotorInterface
+        interface_factory = ProcessMotorInterface
+    return MotorControl(port, time_out, message_func, debug, interface_factory=interface_factory, tagged=tagged,
+                        binary=binary, baudrate=baudrate, negotiate_baudrate=negotiate_baudrate,
+                        flow_control=flow_control, queue_size=queue_size, policy=policy,
+                        instrumentation=instrumentation)
+
+
+# Creates a new asyncio motor controller object, its methods querying the motor are coroutines
+# - port: a string specifying the COM port (e.g. 'COM3')
+# - time_out: an integer specifying the time in seconds to wait until no response is considered a time-out
+# - message_func: an optional function reference accepting a single String as parameter
+# - debug: a boolean, when True, all communication with the motor will be reported as messages
+# - baudrate: an integer specifying the baud rate to open the port with
+# Note: requires Python 3 and a POSIX system
+def create_async_motor_controller(port, time_out, message_func=None, debug=False, baudrate=9600):
+    # imported here, as the asyncio module can not be loaded on Python 2
+    from motor.async_motor_control import AsyncMotorControl
+    return AsyncMotorControl(port, time_out, message_func, debug, baudrate)
+
+
+# Creates a new motor fleet object, to control many motors from a single I/O thread
+# - time_out: an integer specifying the time in seconds to wait until no response is considered a time-out
+# - message_func: a function reference accepting a single String as parameter
+# - debug: a boolean, when True, all communication with the motors will be printed to the console
+# - tagged: a boolean, when True, the tagged protocol is used for the controllers which support it
+# - binary: a boolean, when True, the binary protocol is used for the controllers which support it
+# - baudrate: an integer specifying the baud rate to open the ports with
+# - negotiate_baudrate: a boolean, when True, the fastest baud rate supported by each controller is negotiated
+# - flow_control: a boolean, when True, commands are only sent while the controllers have room for them
+# - queue_size: an integer specifying the number of commands to queue per motor, 0 for no limit
+# - policy: what to do when the command queue of a motor is full: 'block', 'drop_oldest' or 'raise'
+# Note: requires Python 3 and a POSIX system
+def create_motor_fleet(time_out, message_func, debug=False, tagged=False, binary=False, baudrate=9600,
+                       negotiate_baudrate=False, flow_control=False, queue_size=QUEUE_SIZE, policy=BLOCK):
+    # imported here, as the selectors module is not available on Python 2
+    from motor.motor_fleet import MotorFleet
+    return MotorFleet(time_out, message_func, debug, tagged, binary, baudrate, negotiate_baudrate, flow_control,
+                      queue_size, policy)
 
 
 # Creates a new motor interface object
@@ -18,10 +73,80 @@ def create_motor_controller(port, time_out, message_func, debug=False):
 # - value_func: a function reference accepting a single integer as parameter
 # - confirmation_function: a function reference accepting a single integer as parameter
 # - message_func: a function reference accepting a single String as parameter
-def create_motor_interface(port, value_func, confirmation_function, message_func):
-    return MotorInterface(port, value_func, confirmation_function, message_func)
+# - baudrate: an integer specifying the baud rate to open the port with
+# - queue_size: an integer specifying the number of commands to queue, 0 for no limit
+# - policy: what to do when the command queue is full: 'block', 'drop_oldest' or 'raise'
+def create_motor_interface(port, value_func, confirmation_function, message_func, baudrate=9600,
+                           queue_size=QUEUE_SIZE, policy=BLOCK):
+    return MotorInterface(port, value_func, confirmation_function, message_func, baudrate, queue_size, policy)
+
+
+# Creates and starts a simulated controller, its port can be passed to the other factories instead of a COM port
+# - latency: delay in seconds before commands reach the simulated firmware
+# - baudrate: baud rate of the simulated serial line, None for an unlimited line
+# - drop_rate: probability that a reply is lost
+# - garble_rate: probability that a byte of a reply is corrupted
+# - boot_time: time in seconds during which the simulated controller ignores its input after starting
+# - seed: optional seed for the fault injection
+# - rx_buffer_size: size of the receive buffer of the simulated firmware (64 on an Arduino), None for no limit
+# Note: requires a POSIX system
+def create_simulated_controller(latency=0, baudrate=None, drop_rate=0, garble_rate=0, boot_time=0, seed=None,
+                                rx_buffer_size=None):
+    # imported here, as pseudo terminals are not available on Windows
+    from simulator.simulated_controller import SimulatedController
+    controller = SimulatedController(latency, baudrate, drop_rate, garble_rate, boot_time, seed, rx_buffer_size)
+    controller.start()
+    return controller
 
 
 # Lists serial port names
 def list_serial_ports():
     return serial.tools.list_ports.comports()
+
+
+# Finds the ports controllers are connected to, by connecting to all candidate ports at once
+# Each connection repeats its handshake until the controller has booted, so finding any number of controllers takes
+# about one boot time, and ports without a controller take the boot time and the time out
+# - ports: the ports to probe, None for all USB serial ports (see list_serial_ports()), note that other devices on
+#   these ports receive the handshake as well
+# - time_out: an integer specifying the time in seconds to wait for a controller to answer once it has booted
+# - message_func: an optional function reference accepting a single String as parameter, for the messages of the
+#   connections
+# - connect: a boolean, when True, the connections to the controllers are kept open and returned
+# - boot_time: the time in seconds the controllers are given to boot, on top of the time out
+# - options: further keyword arguments for create_motor_controller() when connecting, e.g. tagged=True, only the
+#   baud rate applies to the probes otherwise
+# returns a list of the ports on which a controller answered, in the order of ports, or, when connecting, a dictionary
+# with the validated motor controller for each of these ports
+def discover_controllers(ports=None, time_out=2, message_func=None, connect=False, boot_time=BOOT_TIME, **options):
+    if ports is None:
+        ports = [port.device for port in list_serial_ports() if port.vid is not None]
+    if message_func is None:
+        message_func = _ignore
+    controllers = {}
+
+    if not connect:
+        # a plain handshake does, without changing the protocol or baud rate of the controllers
+        options = {'baudrate': options['baudrate']} if 'baudrate' in options else {}
+
+    # connects to a port and awaits the validation, on a thread per port, which also closes the connection if it is
+    # not kept, as closing a port waits for its reading thread
+    def probe(port):
+        mc = create_motor_controller(port, time_out, message_func, **options)
+        if mc.start_connection(boot_time=boot_time) and mc.await_validation():
+            controllers[port] = mc
+        if port not in controllers or not connect:
+            mc.stop_connection()
+    threads = [threading.Thread(target=probe, args=(port,)) for port in ports]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if connect:
+        return controllers
+    return [port for port in ports if port in controllers]
+
+
+# ignores messages, internal use only, do not call
+def _ignore(message):
+    pass
@@ -0,0 +1,46 @@
+# Fixtures of the test suite, which drives the control stack against simulated controllers (Python 3, POSIX only)
+#
+# Usage, from the root of the repository:
+#   python -m pytest
+import pytest
+
+from motor.motor_control import MotorControl
+from simulator.simulated_controller import SimulatedController
+
+
+# starts simulated controllers, with the options of SimulatedController, and stops them after the test
+@pytest.fixture
+def simulate():
+    controllers = []
+
+    def start(**options):
+        controller = SimulatedController(**options)
+        controller.start()
+        controllers.append(controller)
+        return controller
+    yield start
+    for controller in controllers:
+        controller.stop()
+
+
+# the messages of the connections made by connect()
+@pytest.fixture
+def messages():
+    return []
+
+
+# connects a MotorControl to a port, with the options of MotorControl, awaits its validation, and stops the
+# connection after the test, before the simulated controllers are stopped
+@pytest.fixture
+def connect(simulate, messages):
+    motors = []
+
+    def start(port, time_out=2, **options):
+        mc = MotorControl(port, time_out, messages.append, **options)
+        motors.append(mc)
+        assert mc.start_connection()
+        assert mc.await_validation()
+        return mc
+    yield start
+    for mc in motors:
+        mc.stop_connection()
@@ -0,0 +1,146 @@
+import asyncio
+
+from motor.async_motor_control import AsyncMotorControl, AsyncMotorInterface
+
+
+# runs a coroutine function with a validated AsyncMotorControl on the port, and stops the connection afterwards
+def _run(port, test, time_out=2):
+    async def main():
+        mc = AsyncMotorControl(port, time_out)
+        assert await mc.start_connection()
+        try:
+            return await test(mc)
+        finally:
+            mc.stop_connection()
+    return asyncio.run(main())
+
+
+# port handing out chunks of bytes as they are read
+class _Chunks:
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.in_waiting = 0
+
+    def read(self, size):
+        return self.chunks.pop(0)
+
+
+def test_lines_split_across_reads_are_passed_on_right_away():
+    values = []
+    messages = []
+    mi = AsyncMotorInterface(None, values.append, values.append, messages.append)
+    mi.ser = _Chunks(b'[v]12', b'3\r\n[m]Hello\r\n[v]x\r\n[c')
+    # the lines are parsed as by MotorInterface, and the replies do not wait for a tick
+    mi._AsyncMotorInterface__on_readable()
+    assert values == [] and messages == []
+    mi._AsyncMotorInterface__on_readable()
+    assert values == [123]
+    assert messages == ['Hello', 'Received invalid value: x']
+    assert mi.read_buffer == bytearray(b'[c')
+
+
+def test_queries_are_awaited(simulate):
+    async def test(mc):
+        assert await mc.get_step_count() == 0
+        assert await mc.is_forwards() == 1
+        assert await mc.get_delay() > 1
+    _run(simulate().get_port(), test)
+
+
+def test_concurrent_queries_get_their_own_replies(simulate):
+    async def test(mc):
+        mc.set_step_delay(7)
+        return await asyncio.gather(mc.get_delay(), mc.get_step_count(), mc.is_backwards(), mc.get_step_target())
+    assert _run(simulate().get_port(), test) == [7, 0, 0, 0]
+
+
+def test_steps_are_awaited(simulate):
+    sim = simulate()
+
+    async def test(mc):
+        mc.set_step_delay(2)
+        assert await mc.do_steps_and_wait_finish(-25) == 25
+        assert not mc.is_stepping()
+        assert await mc.is_backwards() == 1
+    _run(sim.get_port(), test)
+    assert sim.get_firmware().total_steps == 25
+
+
+def test_stop_ends_the_steps(simulate):
+    sim = simulate()
+
+    async def test(mc):
+        mc.do_steps(1000)
+        await asyncio.sleep(0.1)
+        mc.stop_stepping()
+        for i in range(100):
+            if not mc.is_stepping():
+                break
+            await asyncio.sleep(0.01)
+        return mc.is_stepping(), mc.get_last_step_count()
+    stepping, steps = _run(sim.get_port(), test)
+    assert not stepping
+    assert 0 < steps < 1000
+    assert sim.get_firmware().total_steps == steps
+
+
+def test_messages_end_with_the_connection(simulate):
+    async def test(mc):
+        received = []
+
+        async def collect():
+            async for message in mc.messages():
+                received.append(message)
+        task = asyncio.ensure_future(collect())
+        mc.set_step_delay(1)
+        await asyncio.sleep(0.1)
+        mc.stop_connection()
+        await asyncio.wait_for(task, 1)
+        return received
+    received = _run(simulate().get_port(), test)
+    assert received[-1] == 'Delay must be larger than 1 (minimum 2)'
+
+
+def test_lost_port_stops_the_connection(simulate):
+    sim = simulate()
+
+    async def test(mc):
+        received = []
+
+        async def collect():
+            async for message in mc.messages():
+                received.append(message)
+        task = asyncio.ensure_future(collect())
+        # the query is left unanswered until the port is lost
+        sim.get_firmware().stop_running()
+        query = asyncio.ensure_future(mc.get_step_count())
+        await asyncio.sleep(0.05)
+        sim.disconnect()
+        assert await asyncio.wait_for(query, 1) is None
+        await asyncio.wait_for(task, 1)
+        assert not mc.is_valid_or_validating()
+        assert not mc.mi.is_running()
+        assert 'Connection lost' in received
+    _run(sim.get_port(), test, time_out=5)
+
+
+def test_query_times_out_without_reply(simulate):
+    sim = simulate()
+
+    async def test(mc):
+        sim.get_firmware().stop_running()
+        return await mc.get_step_count()
+    assert _run(sim.get_port(), test, time_out=0.3) is None
+
+
+def test_late_handshake_replies_are_not_taken_for_confirmations(simulate):
+    # the controller answers every handshake sent while the first reply is under way
+    sim = simulate(latency=0.15)
+
+    async def test(mc):
+        assert mc.handshake_count > 1
+        mc.set_step_delay(5)
+        assert await mc.do_steps_and_wait_finish(50) == 50
+        # the steps have been taken, rather than confirmed by a late reply
+        assert sim.get_firmware().total_steps == 50
+    _run(sim.get_port(), test)
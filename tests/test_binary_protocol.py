@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from motor import binary_protocol
+
+
+def test_crc8_matches_the_reference_check_value():
+    # CRC-8 with polynomial 0x07 and initial value 0 (CRC-8/SMBUS)
+    assert binary_protocol.crc8(bytearray(b'123456789')) == 0xF4
+    assert binary_protocol.crc8(bytearray()) == 0
+
+
+@pytest.mark.parametrize('data, encoded', [
+    (b'\x00', b'\x01\x01'),
+    (b'\x11\x22\x00\x33', b'\x03\x11\x22\x02\x33'),
+    (b'\x11\x00\x00\x00', b'\x02\x11\x01\x01\x01'),
+])
+def test_cobs_matches_the_reference_encodings(data, encoded):
+    assert bytes(binary_protocol.cobs_encode(bytearray(data))) == encoded
+    assert bytes(binary_protocol.cobs_decode(bytearray(encoded))) == data
+
+
+def test_cobs_decodes_full_blocks():
+    data = bytes(range(1, 255))
+    assert bytes(binary_protocol.cobs_decode(bytearray(b'\xff' + data))) == data
+    assert bytes(binary_protocol.cobs_decode(binary_protocol.cobs_encode(bytearray(data)))) == data
+
+
+def test_cobs_round_trips_random_data():
+    generator = random.Random(1)
+    for length in range(0, 600, 7):
+        data = bytearray(generator.choice((0, 1, 255, generator.randint(0, 255))) for i in range(length))
+        encoded = binary_protocol.cobs_encode(data)
+        assert 0 not in encoded
+        assert binary_protocol.cobs_decode(encoded) == data
+
+
+@pytest.mark.parametrize('value', [0, 1, -1, 63, -64, 64, 127, 128, 32767, -32768, 2 ** 31 - 1, -2 ** 31])
+def test_varint_round_trips(value):
+    encoded = binary_protocol.encode_varint(value, bytearray())
+    assert binary_protocol.decode_varint(encoded, 0) == (value, len(encoded))
+
+
+@pytest.mark.parametrize('cmd', ['stepper_control', 'getStepCount', 'step 100', 'delay 2', 'queue -32000',
+                                 'ramp 400 2000 500', 'telemetrySteps 0', 'flush'])
+@pytest.mark.parametrize('tag', [None, 0, 1, 255])
+def test_commands_round_trip(cmd, tag):
+    frame = binary_protocol.encode_command(cmd, tag)
+    assert frame.endswith(binary_protocol.DELIMITER)
+    assert binary_protocol.DELIMITER not in frame[0:-1]
+    assert binary_protocol.decode_command(frame[0:-1]) == (cmd, tag)
+
+
+@pytest.mark.parametrize('reply_type, payload', [
+    (binary_protocol.REPLY_VALUE, 0), (binary_protocol.REPLY_VALUE, -123456),
+    (binary_protocol.REPLY_CONFIRMATION, 1), (binary_protocol.REPLY_TELEMETRY, 32767),
+    (binary_protocol.REPLY_MOVE, 8), (binary_protocol.REPLY_CREDIT, 16),
+    (binary_protocol.REPLY_MESSAGE, 'Invalid command.'),
+])
+@pytest.mark.parametrize('tag', [None, 7])
+def test_replies_round_trip(reply_type, payload, tag):
+    frame = binary_protocol.encode_reply(reply_type, payload, tag)
+    assert binary_protocol.decode_reply(frame[0:-1]) == (reply_type, payload, tag)
+
+
+def test_replies_decode_in_place_in_a_buffer():
+    buffer = bytearray(b'[v]1\r\n')
+    start = len(buffer)
+    buffer.extend(binary_protocol.encode_reply(binary_protocol.REPLY_VALUE, -42, 3))
+    end = len(buffer) - 1
+    buffer.extend(binary_protocol.encode_reply(binary_protocol.REPLY_MESSAGE, 'next'))
+    assert binary_protocol.decode_reply(buffer, start, end) == (binary_protocol.REPLY_VALUE, -42, 3)
+    with pytest.raises(ValueError):
+        binary_protocol.decode_reply(buffer, start, end - 1)
+
+
+def test_unknown_commands_and_wrong_arguments_are_rejected():
+    with pytest.raises(ValueError):
+        binary_protocol.encode_command('baud 115200')
+    with pytest.raises(ValueError):
+        binary_protocol.encode_command('step')
+    with pytest.raises(ValueError):
+        binary_protocol.encode_command('ramp 1 2')
+
+
+def test_corrupted_frames_are_rejected():
+    frame = bytearray(binary_protocol.encode_reply(binary_protocol.REPLY_VALUE, 1000, 12)[0:-1])
+    rejected = 0
+    for index in range(len(frame)):
+        for bit in range(8):
+            corrupted = bytearray(frame)
+            corrupted[index] ^= 1 << bit
+            try:
+                decoded = binary_protocol.decode_reply(corrupted)
+            except ValueError:
+                rejected += 1
+                continue
+            # the CRC-8 detects every single bit error, unless COBS moved the error out of the frame
+            assert decoded != (binary_protocol.REPLY_VALUE, 1000, 12)
+    assert rejected > 0.9 * len(frame) * 8
+    with pytest.raises(ValueError):
+        binary_protocol.decode_reply(bytearray(b'\x01'))
+
+
+def test_binary_replies_reach_the_callbacks_over_the_simulator(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port(), tagged=True, binary=True)
+    assert mc.mi.binary
+    mc.set_step_delay(5)
+    assert mc.wait_for_replies([mc.query_delay(), mc.query_step_count(), mc.query_backwards()]) == [5, 0, 0]
+    assert mc.do_steps_and_wait_finish(-10) == 10
+    assert sim.get_firmware().total_steps == 10
@@ -0,0 +1,81 @@
+import random
+import time
+
+
+# the time a step takes with a step delay of 20 ms: the pin is high for a delay and low for another
+STEP_TIME = 0.04
+
+
+def test_stop_is_confirmed_without_finishing_the_step(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(20)
+    generator = random.Random(1)
+    latencies = []
+    for i in range(5):
+        mc.do_steps(1000)
+        time.sleep(STEP_TIME * 2 + generator.uniform(0, STEP_TIME))
+        start = time.time()
+        mc.stop_stepping()
+        assert mc.wait_finish(1)
+        latencies.append(time.time() - start)
+        assert 0 < mc.get_last_step_count() < 1000
+    # the firmware answers between the toggles of the step pin, rather than once the step is done
+    assert max(latencies) < STEP_TIME / 2
+
+
+def test_queries_are_answered_while_stepping(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(20)
+    mc.do_steps(1000)
+    time.sleep(STEP_TIME)
+    round_trips = []
+    counts = []
+    for i in range(10):
+        start = time.time()
+        counts.append(mc.get_step_count())
+        round_trips.append(time.time() - start)
+    mc.stop_stepping()
+    assert counts == sorted(counts) and counts[-1] > 0
+    assert max(round_trips) < STEP_TIME / 2
+
+
+def test_stop_ends_a_ramp(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.move(5000, 2000, 4000)
+    time.sleep(0.5)
+    start = time.time()
+    mc.stop_stepping()
+    assert mc.wait_finish(1)
+    assert time.time() - start < 0.02
+    steps = mc.get_last_step_count()
+    assert 0 < steps < 5000
+    time.sleep(0.05)
+    assert sim.get_firmware().total_steps == steps
+
+
+def test_unknown_commands_and_wrong_arguments_are_rejected(simulate, connect, messages):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(7)
+    for cmd in ('bogus 12', 'delay', 'step', 'delay ' + '1' * 70):
+        mc.mi.send_command(cmd)
+    # rather than being taken for a delay, as any unknown command used to be
+    assert mc.get_delay(refresh=True) == 7
+    assert messages.count('Invalid command.') == 4
+    assert mc.get_step_count() == 0
+
+
+def test_latency_of_commands_sent_apart_does_not_add_up(simulate, connect):
+    sim = simulate(latency=0.3)
+    mc = connect(sim.get_port())
+    start = time.time()
+    commands = []
+    for i in range(5):
+        commands.append(mc.query_step_count())
+        time.sleep(0.02)
+    # each command is under way for the latency, rather than waiting for the commands sent before it
+    assert mc.wait_for_replies(commands) == [0] * 5
+    assert time.time() - start < 0.5
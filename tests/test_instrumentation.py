@@ -0,0 +1,94 @@
+import os
+import time
+
+from motor.instrumentation import Histogram, Instrumentation, PrometheusExporter
+
+
+def test_histogram_buckets_are_upper_bounds():
+    histogram = Histogram()
+    for value in (0.0001, 0.0003, 0.0005, 0.003, 20):
+        histogram.observe(value)
+    # a value on a bound falls in that bucket, values above the largest bound in the last one
+    assert histogram.counts[0:3] == [1, 0, 2]
+    assert histogram.counts[5] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.count == 5
+    assert abs(histogram.sum - 20.0039) < 1e-9
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'][2] == (0.0005, 3)
+    assert snapshot['buckets'][-1] == (float('inf'), 5)
+    assert snapshot['count'] == 5
+
+
+def test_histogram_percentiles_are_bucket_bounds():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for i in range(90):
+        histogram.observe(0.002)
+    for i in range(10):
+        histogram.observe(0.2)
+    assert histogram.percentile(50) == 0.0025
+    assert histogram.percentile(90) == 0.0025
+    assert histogram.percentile(91) == 0.25
+    assert histogram.percentile(99) == 0.25
+    assert histogram.percentile(100) == 0.25
+    histogram.observe(60)
+    assert histogram.percentile(100) == float('inf')
+
+
+def test_prometheus_text_format():
+    instrumentation = Instrumentation()
+    instrumentation.count('bytes_written', 13)
+    instrumentation.add_gauge('command_buffer', lambda: 3)
+    record = instrumentation.command_enqueued('step 100')
+    record.enqueued -= 0.004
+    instrumentation.commands_written([record], 9)
+    record.read = time.time()
+    instrumentation.command_completed(record)
+    lines = PrometheusExporter(None, labels={'port': 'COM"3'}).format(instrumentation.snapshot()).splitlines()
+    assert '# TYPE stepper_control_bytes_written_total counter' in lines
+    assert 'stepper_control_bytes_written_total{port="COM\\"3"} 22' in lines
+    assert 'stepper_control_commands_written_total{port="COM\\"3"} 1' in lines
+    assert 'stepper_control_queue_depth{port="COM\\"3",queue="command_buffer"} 3' in lines
+    assert '# TYPE stepper_control_round_trip_seconds histogram' in lines
+    # cumulative buckets, labelled with their upper bound
+    assert 'stepper_control_round_trip_seconds_bucket{command="step",le="0.0025",port="COM\\"3"} 0' in lines
+    assert 'stepper_control_round_trip_seconds_bucket{command="step",le="0.005",port="COM\\"3"} 1' in lines
+    assert 'stepper_control_round_trip_seconds_bucket{command="step",le="+Inf",port="COM\\"3"} 1' in lines
+    assert 'stepper_control_round_trip_seconds_count{command="step",port="COM\\"3"} 1' in lines
+    assert 'stepper_control_stage_seconds_count{port="COM\\"3",stage="queue"} 1' in lines
+    assert all(line.startswith('#') or len(line.rsplit(' ', 1)) == 2 for line in lines)
+
+
+def test_run_against_the_simulator_is_counted_and_exported(simulate, connect, tmp_path):
+    instrumentation = Instrumentation(export_interval=0.05)
+    path = str(tmp_path / 'stepper_control.prom')
+    instrumentation.add_exporter(PrometheusExporter(path))
+    sim = simulate()
+    mc = connect(sim.get_port(), time_out=0.5, instrumentation=instrumentation)
+    for i in range(10):
+        assert mc.get_step_count() == 0
+    assert mc.do_steps_and_wait_finish(5) == 5
+    sim.get_firmware().stop_running()
+    assert mc.get_delay() is None
+    # the clock thread counts the time out once it drops the command
+    deadline = time.time() + 1
+    while instrumentation.snapshot()['counters']['timeouts'] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    snapshot = instrumentation.snapshot()
+    counters = snapshot['counters']
+    # the wake-up handshakes, the handshake of the validation, the queries, and the direction, steps and start of the
+    # move
+    assert counters['commands_written'] == mc.handshake_count + 1 + 10 + 3 + 1
+    assert counters['bytes_written'] == sim.bytes_received
+    assert counters['bytes_read'] == sim.bytes_sent
+    assert counters['lines_read'] >= 1 + 10 + 2
+    assert counters['timeouts'] == 1
+    assert snapshot['round_trips']['getStepCount']['count'] == 10
+    assert snapshot['gauges']['command_callbacks'] == 0
+    time.sleep(0.2)
+    with open(path) as exported:
+        lines = exported.read().splitlines()
+    assert 'stepper_control_round_trip_seconds_count{command="getStepCount"} 10' in lines
+    assert 'stepper_control_timeouts_total 1' in lines
+    assert not os.path.exists(path + '.tmp')
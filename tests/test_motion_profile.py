@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from motor import motion_profile
+
+
+# checks a schedule: the segments fit the controller, and the expanded intervals take the time of the schedule
+def _check_schedule(steps, v_max, accel, profile):
+    intervals = motion_profile.step_intervals(steps, v_max, accel, profile)
+    segments = motion_profile.compress(intervals)
+    assert len(segments) <= motion_profile.MAX_SEGMENTS
+    assert sum(segment[0] for segment in segments) == steps
+    assert all(start >= motion_profile.MIN_INTERVAL and end >= motion_profile.MIN_INTERVAL
+               for n, start, end in segments)
+    expanded = motion_profile.expand_segments(segments)
+    # the rounding of the segments to whole microseconds is made up for, so the move ends on schedule
+    assert sum(expanded) == sum(intervals)
+    return intervals, segments, expanded
+
+
+def test_segment_duration_matches_the_expanded_intervals():
+    generator = random.Random(1)
+    for i in range(2000):
+        segment = (generator.randint(1, 500), generator.randint(100, 5000), generator.randint(100, 5000))
+        assert motion_profile._segment_duration(*segment) == sum(motion_profile.expand_segments([segment]))
+
+
+@pytest.mark.parametrize('profile', [motion_profile.TRAPEZOIDAL, motion_profile.S_CURVE])
+def test_schedule_is_symmetric_and_reaches_the_top_speed(profile):
+    intervals = motion_profile.step_intervals(4000, 2000, 8000, profile)
+    assert len(intervals) == 4000
+    # accelerating and decelerating mirror each other
+    assert all(abs(a - b) <= max(1, 0.0001 * a) for a, b in zip(intervals[0:1000], reversed(intervals[-1000:])))
+    assert min(intervals) in (500, 501)
+    assert intervals[0] > intervals[100] > intervals[200]
+
+
+def test_short_moves_lower_the_top_speed():
+    intervals = motion_profile.step_intervals(100, 5000, 1000, motion_profile.TRAPEZOIDAL)
+    # the move is too short to reach 5000 steps per second
+    assert min(intervals) > 1000000 // 5000
+
+
+@pytest.mark.parametrize('steps, v_max, accel, profile', [
+    (1, 1000, 1000, motion_profile.TRAPEZOIDAL),
+    (2000, 2000, 8000, motion_profile.TRAPEZOIDAL),
+    (5000, 3000, 10000, motion_profile.S_CURVE),
+    (30000, 7000, 20000, motion_profile.S_CURVE),
+    (100000, 3000, 5000, motion_profile.TRAPEZOIDAL),
+])
+def test_segments_keep_the_duration_of_the_schedule(steps, v_max, accel, profile):
+    intervals, segments, expanded = _check_schedule(steps, v_max, accel, profile)
+    # the segments end close to the schedule as well, the drift is not carried far
+    scheduled = 0
+    taken = 0
+    position = 0
+    for n, start, end in segments:
+        scheduled += sum(intervals[position:position + n])
+        taken += sum(expanded[position:position + n])
+        position += n
+        assert abs(taken - scheduled) <= 0.01 * sum(intervals)
+
+
+def test_random_schedules_keep_their_duration():
+    generator = random.Random(2)
+    for i in range(30):
+        _check_schedule(generator.randint(1, 5000), generator.uniform(50, 9000), generator.uniform(100, 50000),
+                        generator.choice((motion_profile.TRAPEZOIDAL, motion_profile.S_CURVE)))
+
+
+def test_invalid_moves_are_rejected():
+    with pytest.raises(ValueError):
+        motion_profile.step_intervals(100, 20000, 1000)
+    with pytest.raises(ValueError):
+        motion_profile.step_intervals(0, 1000, 1000)
+    with pytest.raises(ValueError):
+        motion_profile.step_intervals(100, 1000, 1000, 'linear')
+
+
+@pytest.mark.parametrize('profile', [motion_profile.TRAPEZOIDAL, motion_profile.S_CURVE])
+def test_simulated_move_follows_the_schedule(simulate, connect, profile):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    sim.get_firmware().step_log = []
+    assert mc.move_and_wait_finish(-2000, 4000, 20000, profile) == 2000
+    steps = sim.get_firmware().step_log
+    assert len(steps) == 2000
+    assert mc.is_backwards() == 1
+    # the first step is taken after the first interval of the schedule
+    intervals = motion_profile.step_intervals(2000, 4000, 20000, profile)
+    duration = (sum(intervals) - intervals[0]) / 1000000.0
+    assert abs((steps[-1] - steps[0]) - duration) < 0.005
@@ -0,0 +1,301 @@
+import threading
+import time
+
+import pytest
+
+from motor.motor_control import MAX_TAG, MotorControl
+from motor.motor_interface import MotorInterface
+
+
+# collects the replies to polls, and signals once a number of them has been received
+class _Polls:
+    def __init__(self, count):
+        self.count = count
+        self.values = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def callback(self, value):
+        with self.lock:
+            self.values.append(value)
+            if len(self.values) >= self.count:
+                self.done.set()
+
+
+def test_blocking_queries_return_their_replies(simulate, connect):
+    mc = connect(simulate().get_port())
+    mc.set_step_delay(7)
+    assert mc.get_delay() == 7
+    assert mc.get_step_count() == 0
+    assert mc.is_forwards() == 1
+    assert mc.wait_for_replies([mc.query_delay(), mc.query_step_count(), mc.query_backwards()]) == [7, 0, 0]
+
+
+def test_queries_from_threads_get_their_own_replies(simulate, connect):
+    mc = connect(simulate().get_port())
+    mc.set_step_delay(7)
+    results = []
+
+    def query(getter, count):
+        results.append((getter(), [getter() for i in range(count)]))
+    threads = [threading.Thread(target=query, args=(getter, 20))
+               for getter in (mc.get_delay, mc.get_step_count, mc.is_forwards, mc.get_step_target)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted((first, values == [first] * 20) for first, values in results) == \
+        [(0, True), (0, True), (1, True), (7, True)]
+
+
+def test_query_times_out_without_spinning(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port(), time_out=0.5)
+    sim.get_firmware().stop_running()
+    start = time.time()
+    cpu = time.process_time()
+    assert mc.get_step_count() is None
+    assert 0.4 < time.time() - start < 1
+    # the waiting thread sleeps until the reply or the time out
+    assert time.process_time() - cpu < 0.1
+
+
+def test_validation_is_awaited_until_it_ends(simulate, messages):
+    silent = simulate()
+    silent.get_firmware().stop_running()
+    motors = [MotorControl(silent.get_port(), 0.3, messages.append),
+              MotorControl(simulate(boot_time=5).get_port(), 5, messages.append)]
+    try:
+        assert motors[0].start_connection(boot_time=0)
+        start = time.time()
+        assert not motors[0].await_validation()
+        assert 0.3 <= time.time() - start < 0.4
+        # a connection stopped by another thread ends the validation as well
+        assert motors[1].start_connection()
+        threading.Timer(0.2, motors[1].stop_connection).start()
+        start = time.time()
+        assert not motors[1].await_validation()
+        assert 0.2 <= time.time() - start < 0.3
+    finally:
+        for mc in motors:
+            mc.stop_connection()
+
+
+def test_tagged_replies_are_matched_out_of_order(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port(), tagged=True)
+    assert mc.tagged_mode
+    mc.set_step_delay(7)
+    # hold back the replies of the firmware
+    firmware = sim.get_firmware()
+    write = firmware.write_func
+    held = []
+    firmware.write_func = held.append
+    commands = [mc.query_delay(), mc.query_step_count(), mc.query_forwards()]
+    deadline = time.time() + 1
+    while len(held) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    # the replies arrive in reverse order, and are matched to their commands by their tags
+    firmware.write_func = write
+    for data in reversed(held):
+        write(data)
+    assert mc.wait_for_replies(commands) == [7, 0, 1]
+
+
+def test_controllers_without_tags_use_the_untagged_protocol(simulate, connect):
+    sim = simulate()
+    sim.get_firmware().CAPABILITIES = 0
+    mc = connect(sim.get_port(), tagged=True)
+    assert not mc.tagged_mode
+    assert mc.get_step_count() == 0
+    assert mc.do_steps_and_wait_finish(10) == 10
+
+
+@pytest.mark.parametrize('tagged', [False, True])
+def test_more_polls_than_tags_complete(simulate, connect, messages, tagged):
+    sim = simulate(latency=0.5)
+    mc = connect(sim.get_port(), time_out=5, tagged=tagged)
+    assert mc.tagged_mode == tagged
+    polls = _Polls(MAX_TAG + 45)
+    start = time.time()
+    for i in range(polls.count):
+        mc.poll_step_count(polls.callback)
+    # the polls beyond the tags wait for a free tag without holding up the replies
+    assert polls.done.wait(20)
+    assert polls.values == [0] * polls.count
+    assert time.time() - start < 10
+    assert len(mc.command_callbacks) == 0
+    assert not any(message.startswith('Error') for message in messages)
+
+
+@pytest.mark.parametrize('tagged', [False, True])
+def test_late_handshake_replies_do_not_disturb_validation(simulate, connect, messages, tagged):
+    # the controller answers every handshake sent while the first reply is under way
+    sim = simulate(latency=0.5, boot_time=0.3)
+    start = time.time()
+    mc = connect(sim.get_port(), tagged=tagged)
+    assert mc.handshake_count > 1
+    assert mc.tagged_mode == tagged
+    mc.set_step_delay(5)
+    assert mc.do_steps_and_wait_finish(50) == 50
+    assert sim.get_firmware().total_steps == 50
+    assert time.time() - start < 10
+    assert not any(message.startswith('Error') for message in messages)
+
+
+@pytest.mark.parametrize('tagged', [False, True])
+def test_more_polls_than_tags_time_out(simulate, connect, messages, tagged):
+    sim = simulate()
+    mc = connect(sim.get_port(), time_out=0.5, tagged=tagged)
+    sim.get_firmware().stop_running()
+    polls = _Polls(MAX_TAG + 45)
+    start = time.time()
+    for i in range(polls.count):
+        mc.poll_step_count(polls.callback)
+    # the polls beyond the tags are sent as the first ones time out, and time out in turn
+    assert polls.done.wait(5)
+    assert polls.values == [None] * polls.count
+    assert time.time() - start < (2.5 if tagged else 1.5)
+    assert len(mc.command_callbacks) == 0 and len(mc.deadlines) == 0
+    assert mc.is_valid()
+
+
+def test_polls_from_the_tick_thread_fail_without_free_tag(simulate, connect, messages):
+    sim = simulate()
+    mc = connect(sim.get_port(), time_out=5, tagged=True)
+    sim.latency = 0.5
+    chained = _Polls(2)
+
+    # the clock thread frees the tags, so it must not wait for one: the second poll finds all tags in use
+    def chain(value):
+        mc.poll_step_count(chained.callback)
+        mc.poll_step_count(chained.callback)
+    mc.poll_step_count(chain)
+    polls = _Polls(MAX_TAG - 1)
+    for i in range(polls.count):
+        mc.poll_step_count(polls.callback)
+    assert chained.done.wait(10)
+    assert polls.done.wait(10)
+    assert sorted(chained.values, key=str) == [0, None]
+    assert polls.values == [0] * polls.count
+    assert any(message.startswith('Error: no free tag') for message in messages)
+
+
+def test_fastest_common_baud_rate_is_negotiated(simulate, connect, messages):
+    sim = simulate(baudrate=9600)
+    mc = connect(sim.get_port(), negotiate_baudrate=True)
+    assert mc.mi.get_baudrate() == 500000
+    assert sim.get_firmware().baud_rate == 500000
+    # the simulated line follows the switch
+    assert sim.baudrate == 500000
+    assert mc.get_step_count() == 0
+
+
+def test_baud_rates_the_controller_lacks_are_skipped(simulate, connect):
+    sim = simulate(baudrate=9600)
+    sim.get_firmware().BAUD_RATES = (115200,)
+    mc = connect(sim.get_port(), negotiate_baudrate=True)
+    assert mc.mi.get_baudrate() == 115200
+    assert sim.get_firmware().baud_rate == 115200
+    assert mc.get_step_count() == 0
+
+
+# motor interface of which the port does not support the faster baud rates
+class _SlowInterface(MotorInterface):
+    def set_baudrate(self, baudrate):
+        if baudrate > 9600:
+            return False
+        return MotorInterface.set_baudrate(self, baudrate)
+
+
+def test_failed_baud_rate_switch_reverts(simulate, connect, messages):
+    sim = simulate(baudrate=9600)
+    mc = connect(sim.get_port(), negotiate_baudrate=True, interface_factory=_SlowInterface)
+    # both sides revert once the handshake at the new rate has failed
+    assert mc.mi.get_baudrate() == 9600
+    assert sim.get_firmware().baud_rate == 9600
+    assert 'Baud rate switch failed, reverting to 9600 baud' in messages
+    assert mc.get_step_count() == 0
+
+
+def test_baud_rate_is_kept_without_negotiation(simulate, connect):
+    sim = simulate(baudrate=9600)
+    mc = connect(sim.get_port(), tagged=True)
+    assert mc.mi.get_baudrate() == 9600
+    assert sim.get_firmware().baud_rate == 9600
+
+
+@pytest.mark.parametrize('tagged', [False, True])
+def test_chained_polls_with_flow_control_do_not_deadlock(simulate, connect, messages, tagged):
+    sim = simulate()
+    mc = connect(sim.get_port(), tagged=tagged, flow_control=True, queue_size=4)
+    polls = _Polls(200)
+    chained = []
+    sent = [0]
+
+    # every reply sends the next polls from the clock thread, which must not wait for room in the command queue, a
+    # dropped poll ends its chain
+    def chain(value):
+        chained.append(value)
+        if value is not None and not polls.done.is_set():
+            sent[0] += 2
+            mc.poll_step_count(chain)
+            mc.poll_step_count(chained.append)
+    for i in range(8):
+        sent[0] += 1
+        mc.poll_step_count(chain)
+    for i in range(polls.count):
+        mc.poll_step_count(polls.callback)
+        mc.enqueue_move(1 if i % 2 == 0 else -1)
+    assert polls.done.wait(10)
+    assert mc.wait_idle(10)
+    deadline = time.time() + 5
+    while len(chained) < sent[0] and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(chained) == sent[0]
+    assert all(value is None or value >= 0 for value in polls.values + chained)
+    assert mc.is_valid() and len(mc.command_callbacks) == 0
+
+
+def test_time_outs_fire_at_their_deadline(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port(), time_out=0.3, tagged=True)
+    sim.get_firmware().stop_running()
+    lateness = []
+    done = threading.Event()
+
+    def poll():
+        sent = time.time()
+
+        def callback(value):
+            lateness.append(time.time() - sent - 0.3)
+            if len(lateness) == 100:
+                done.set()
+        mc.poll_step_count(callback)
+    for i in range(100):
+        poll()
+        time.sleep(0.002)
+    assert done.wait(2)
+    # rather than up to a tick of 100 ms late, give or take the scheduling of a busy host
+    assert min(lateness) >= 0 and max(lateness) < 0.05
+    assert sorted(lateness)[90] < 0.01
+    assert len(mc.command_callbacks) == 0 and len(mc.deadlines) == 0
+
+
+def test_deadlines_of_replied_commands_are_dropped(simulate, connect):
+    mc = connect(simulate().get_port(), tagged=True)
+    for i in range(500):
+        assert mc.get_step_count() == 0
+    assert len(mc.deadlines) <= 65
+
+
+@pytest.mark.parametrize('flow_control', [False, True])
+def test_bursts_overrun_the_receive_buffer_without_flow_control(simulate, connect, flow_control):
+    sim = simulate(rx_buffer_size=64)
+    mc = connect(sim.get_port(), time_out=1, tagged=True, flow_control=flow_control)
+    replies = mc.wait_for_replies([mc.query_step_count() for i in range(100)])
+    if flow_control:
+        # the host only writes what the controller has room for
+        assert replies == [0] * 100
+    else:
+        assert replies.count(None) > 50
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from motor.motor_fleet import MotorFleet
+
+
+# starts a fleet with a motor on each port, and waits for their validation
+def _start_fleet(ports, messages):
+    fleet = MotorFleet(2, messages.append)
+    for port in ports:
+        fleet.add_motor(port)
+    assert fleet.start_connections()
+    assert all([motor.await_validation() for motor in fleet.get_motors()])
+    return fleet
+
+
+# waits until none of the motors of the fleet is stepping
+def _wait_finish(fleet, time_out):
+    deadline = time.time() + time_out
+    while fleet.is_stepping() and time.time() < deadline:
+        time.sleep(0.01)
+    return not fleet.is_stepping()
+
+
+def test_motors_run_on_a_single_thread(simulate, messages):
+    sims = [simulate() for i in range(6)]
+    threads = threading.active_count()
+    fleet = _start_fleet([sim.get_port() for sim in sims], messages)
+    try:
+        assert threading.active_count() == threads + 1
+        assert fleet.get_step_counts() == dict((sim.get_port(), 0) for sim in sims)
+        for motor in fleet.get_motors():
+            motor.set_step_delay(2)
+            motor.do_steps(20)
+        assert _wait_finish(fleet, 2)
+        assert [motor.get_last_step_count() for motor in fleet.get_motors()] == [20] * 6
+        assert [sim.get_firmware().total_steps for sim in sims] == [20] * 6
+    finally:
+        fleet.stop()
+
+
+def test_all_motors_are_stopped(simulate, messages):
+    sims = [simulate() for i in range(3)]
+    fleet = _start_fleet([sim.get_port() for sim in sims], messages)
+    try:
+        for motor in fleet.get_motors():
+            motor.do_steps(1000)
+        time.sleep(0.1)
+        fleet.stop_stepping()
+        assert _wait_finish(fleet, 1)
+        for motor, sim in zip(fleet.get_motors(), sims):
+            assert 0 < motor.get_last_step_count() < 1000
+            assert sim.get_firmware().total_steps == motor.get_last_step_count()
+    finally:
+        fleet.stop()
+
+
+def test_lost_port_stops_only_its_motor(simulate, messages):
+    sims = [simulate() for i in range(3)]
+    fleet = _start_fleet([sim.get_port() for sim in sims], messages)
+    try:
+        motors = fleet.get_motors()
+        for motor in motors:
+            motor.set_step_delay(2)
+        sims[1].disconnect()
+        deadline = time.time() + 2
+        while motors[1].is_valid_or_validating() and time.time() < deadline:
+            time.sleep(0.01)
+        assert not motors[1].is_valid_or_validating()
+        assert 'Connection lost' in messages
+        # the other motors keep running on the I/O loop
+        assert motors[0].do_steps_and_wait_finish(20) == 20
+        assert motors[2].do_steps_and_wait_finish(-30) == 30
+        assert [sims[0].get_firmware().total_steps, sims[2].get_firmware().total_steps] == [20, 30]
+    finally:
+        fleet.stop()
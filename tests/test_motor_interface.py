@@ -0,0 +1,145 @@
+import time
+
+import pytest
+
+from motor import binary_protocol, motor_interface
+from motor.motor_interface import MotorInterface
+
+
+# collects the replies of a MotorInterface
+class _Replies:
+    def __init__(self):
+        self.values = []
+        self.confirmations = []
+        self.messages = []
+
+
+def _create_interface(port, **options):
+    replies = _Replies()
+    return MotorInterface(port, replies.values.append, replies.confirmations.append, replies.messages.append,
+                          **options), replies
+
+
+def _start_interface(port):
+    mi, replies = _create_interface(port)
+    assert mi.start_connection()
+    return mi, replies
+
+
+def test_command_is_written_without_waiting_for_a_tick(simulate):
+    sim = simulate()
+    # note the time each command reaches the firmware
+    firmware = sim.get_firmware()
+    receive = firmware.receive
+    received = []
+
+    def record(data):
+        received.extend([time.time()] * data.count(b'\n'))
+        receive(data)
+    firmware.receive = record
+    mi, replies = _start_interface(sim.get_port())
+    try:
+        sent = []
+        for i in range(20):
+            sent.append(time.time())
+            mi.send_command('getStepCount')
+            time.sleep(0.01)
+        deadline = time.time() + 1
+        while len(received) < 20 and time.time() < deadline:
+            time.sleep(0.01)
+        delays = sorted(end - start for start, end in zip(sent, received))
+        # the writing thread wakes up on the command, rather than on the next tick of a clock
+        assert delays[len(delays) // 2] < 0.005
+    finally:
+        mi.stop_connection()
+
+
+def test_reply_wakes_up_the_waiting_thread(simulate):
+    mi, replies = _start_interface(simulate().get_port())
+    try:
+        round_trips = []
+        for i in range(20):
+            start = time.time()
+            mi.send_command('getStepCount')
+            while len(replies.values) <= i:
+                assert mi.wait_for_data(1)
+                mi.update_tick()
+            round_trips.append(time.time() - start)
+        round_trips.sort()
+        assert replies.values == [0] * 20
+        # far below the 100 ms tick the replies used to wait for
+        assert round_trips[len(round_trips) // 2] < 0.02
+    finally:
+        mi.stop_connection()
+
+
+def test_commands_right_after_the_credits_request_fit_the_receive_buffer(simulate):
+    sim = simulate(rx_buffer_size=64)
+    values = []
+    mi = MotorInterface(sim.get_port(), lambda value, tag: values.append((value, tag)), None, None)
+    assert mi.start_connection()
+    try:
+        # the request takes room in the receive buffer until the controller has read it, next to four tagged commands
+        mi.request_credits()
+        for i in range(100):
+            mi.send_command('getStepCount', i % 9 + 1)
+        deadline = time.time() + 2
+        while len(values) < 100 and time.time() < deadline:
+            mi.wait_for_data(0.1)
+            mi.update_tick()
+        assert values == [(0, i % 9 + 1) for i in range(100)]
+        assert sim.get_firmware().overruns == 0
+    finally:
+        mi.stop_connection()
+
+
+def test_full_command_queue_raises():
+    mi, replies = _create_interface(None, queue_size=2, policy=motor_interface.RAISE)
+    mi.send_command('getStepCount')
+    mi.send_command('getDelay')
+    with pytest.raises(motor_interface.queue.Full):
+        mi.send_command('isForward')
+    assert mi.command_buffer.qsize() == 2
+
+
+def test_full_command_queue_drops_the_oldest_command():
+    mi, replies = _create_interface(None, queue_size=2, policy=motor_interface.DROP_OLDEST)
+    dropped = []
+    mi.drop_func = dropped.append
+    for key, cmd in enumerate(['getStepCount', 'getDelay', 'isForward']):
+        mi.send_command(cmd, key=key)
+    assert dropped == [0]
+    assert replies.messages == ['Dropped command "getStepCount", the command queue of port None is full']
+    assert [mi.command_buffer.get_nowait()[0] for i in range(2)] == ['getDelay', 'isForward']
+
+
+def test_lines_split_across_reads_are_joined():
+    mi, replies = _create_interface(None)
+    buffer = bytearray(b'[v]12')
+    mi.handle_buffer(buffer)
+    assert replies.values == [] and buffer == bytearray(b'[v]12')
+    buffer.extend(b'3\r\n[c]1\r\n[m]Hello\r\n[v')
+    mi.handle_buffer(buffer)
+    mi.update_tick()
+    assert replies.values == [123]
+    assert replies.confirmations == [1]
+    assert replies.messages == ['Hello']
+    assert buffer == bytearray(b'[v')
+
+
+def test_frames_split_across_reads_are_joined():
+    mi, replies = _create_interface(None)
+    mi.binary = True
+    frames = binary_protocol.encode_reply(binary_protocol.REPLY_VALUE, 123) \
+        + binary_protocol.encode_reply(binary_protocol.REPLY_CONFIRMATION, 1) \
+        + binary_protocol.encode_reply(binary_protocol.REPLY_MESSAGE, 'Hello')
+    buffer = bytearray(frames[0:3])
+    mi.handle_buffer(buffer)
+    assert replies.values == [] and buffer == bytearray(frames[0:3])
+    buffer.extend(frames[3:] + b'\x02')
+    mi.handle_buffer(buffer)
+    mi.update_tick()
+    assert replies.values == [123]
+    assert replies.confirmations == [1]
+    assert replies.messages == ['Hello']
+    assert buffer == bytearray(b'\x02')
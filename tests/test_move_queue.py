@@ -0,0 +1,69 @@
+import time
+
+from motor.motor_control import MOVE_QUEUE_SIZE
+
+
+def test_queued_moves_run_back_to_back(simulate, connect):
+    # replies take 100 ms to get back, which is what the motor would idle between moves without the queue
+    sim = simulate(latency=0.05)
+    mc = connect(sim.get_port())
+    mc.set_step_delay(2)
+    sim.get_firmware().step_log = []
+    completed = []
+    steps = [10, -5, 20, 15, -10, 5, 10, 10, -20, 5, 10, 15]
+    assert len(steps) > MOVE_QUEUE_SIZE
+    moves = [mc.enqueue_move(n, completed.append) for n in steps]
+    assert mc.has_queued_moves()
+    assert mc.wait_idle(5)
+    assert not mc.has_queued_moves()
+    assert [move.get_value() for move in moves] == [abs(n) for n in steps]
+    assert completed == [abs(n) for n in steps]
+    assert sim.get_firmware().total_steps == sum(abs(n) for n in steps)
+    # the moves beyond the queue of the controller were sent as the first ones completed
+    times = sim.get_firmware().step_log
+    assert max(b - a for a, b in zip(times, times[1:])) < 0.03
+    assert mc.enqueue_move(0).get_value() == 0
+
+
+def test_flush_discards_the_moves_not_started(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(5)
+    moves = [mc.enqueue_move(50) for i in range(MOVE_QUEUE_SIZE + 2)]
+    time.sleep(0.1)
+    mc.flush()
+    # the move being stepped is completed, the others are discarded
+    assert mc.wait_idle(2)
+    assert [move.get_value() for move in moves] == [50] + [0] * (MOVE_QUEUE_SIZE + 1)
+    time.sleep(0.05)
+    assert sim.get_firmware().total_steps == 50
+
+
+def test_stop_discards_the_moves_waiting_in_standby(simulate, connect, messages):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    # the queued moves wait for steps which have been added but not started, the motor stays in standby
+    sim.get_firmware().step_target = 10
+    moves = [mc.enqueue_move(50) for i in range(3)]
+    time.sleep(0.1)
+    assert not mc.wait_idle(0)
+    mc.stop_stepping()
+    assert mc.wait_idle(1)
+    assert [move.get_value() for move in moves] == [0, 0, 0]
+    assert 'Already in standby.' not in messages
+    sim.get_firmware().step_target = 0
+    time.sleep(0.05)
+    assert sim.get_firmware().total_steps == 0
+
+
+def test_wait_idle_times_out_while_moving(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    assert mc.wait_idle(0)
+    mc.set_step_delay(5)
+    move = mc.enqueue_move(-60)
+    start = time.time()
+    assert not mc.wait_idle(0.1)
+    assert 0.1 <= time.time() - start < 0.2
+    assert mc.wait_idle(2)
+    assert move.get_value() == 60
@@ -0,0 +1,75 @@
+import pytest
+
+from motor import multi_axis
+from motor.multi_axis import MultiAxisMove, plan_intervals, plan_moves
+from motor.motion_profile import MIN_INTERVAL
+
+
+# plans the moves with NumPy, when it is installed, and without
+@pytest.fixture(params=['numpy', 'python'])
+def planner(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(multi_axis, 'numpy', None)
+    return plan_intervals
+
+
+def test_slowest_axis_runs_at_its_maximum_rate(planner):
+    durations, intervals, longer = planner([[300, -100, 0]], 1000)
+    assert durations == [300000]
+    # an axis without steps is given the whole move as its interval, it is left alone anyway
+    assert intervals == [[1000, 3000, 300000]]
+    assert longer == [[0, 0, 0]]
+
+
+def test_rates_are_per_axis(planner):
+    durations, intervals, longer = planner([[100, 100]], [1000, 300])
+    # 100 steps at 300 steps per second take 333333.3 us, rounded up
+    assert durations == [333334]
+    assert intervals == [[3333, 3333]]
+    assert longer == [[34, 34]]
+
+
+def test_rounding_makes_the_axes_finish_together(planner):
+    targets = [[7, 3], [-1000, 999], [5, 0], [0, 0]]
+    durations, intervals, longer = planner(targets, 1000)
+    assert durations == [7000, 1000000, 5000, 0]
+    for target, duration, axis_intervals, axis_longer in zip(targets, durations, intervals, longer):
+        for steps, interval, count in zip(target, axis_intervals, axis_longer):
+            if steps != 0:
+                # the steps which take one microsecond longer make up for the rounding down of the interval
+                assert 0 <= count < abs(steps)
+                assert abs(steps) * interval + count == duration
+    assert intervals[0] == [1000, 2333] and longer[0] == [0, 1]
+
+
+def test_rates_out_of_range_are_rejected(planner):
+    with pytest.raises(ValueError):
+        planner([[10, 10]], 1000000.0 / MIN_INTERVAL + 1)
+    with pytest.raises(ValueError):
+        planner([[10, 10]], [1000, 0])
+
+
+def test_axes_are_started_together_and_finish_their_steps(simulate, connect):
+    sims = [simulate() for i in range(3)]
+    motors = [connect(sim.get_port()) for sim in sims]
+    move = MultiAxisMove(motors, [300, -120, 0], 2000)
+    assert move.get_duration() == 0.15
+    assert move.arm()
+    assert all(motor.is_armed() for motor in motors[0:2]) and not motors[2].is_armed()
+    assert move.start() is not None
+    assert move.wait(2)
+    assert move.get_step_counts() == [300, 120, 0]
+    assert [sim.get_firmware().total_steps for sim in sims] == [300, 120, 0]
+    assert move.get_start_times()[2] is None
+
+
+def test_planned_moves_run_one_after_the_other(simulate, connect):
+    sims = [simulate() for i in range(2)]
+    motors = [connect(sim.get_port()) for sim in sims]
+    moves = plan_moves(motors, [[50, 20], [-30, 0], [0, 40]], [1000, 500])
+    for move in moves:
+        assert move.run(time_out=2)
+    assert moves[1].get_step_counts() == [30, 0]
+    assert [sim.get_firmware().total_steps for sim in sims] == [80, 60]
@@ -0,0 +1,62 @@
+import multiprocessing
+import struct
+import time
+
+from motor.process_interface import SharedRing, ProcessMotorInterface
+
+
+def test_ring_refuses_records_while_full_and_wraps_around():
+    ring = SharedRing(SharedRing.allocate(multiprocessing.get_context(), 64))
+    records = [bytes([i]) * 10 for i in range(10)]
+    # each record takes its 4 byte length and 10 bytes of data, so only 4 of them fit
+    assert [ring.put(record) for record in records[0:5]] == [True, True, True, True, False]
+    assert ring.take() == records[0:4]
+    assert ring.take() == []
+    # the next records wrap around the end of the ring, and are read back whole
+    assert [ring.put(record) for record in records[4:8]] == [True, True, True, True]
+    assert ring.take() == records[4:8]
+
+
+# puts numbered records of varying lengths into a ring, from another process
+def _produce(memory, count):
+    ring = SharedRing(memory)
+    for i in range(count):
+        record = struct.pack('<I', i) * (i % 7 + 1)
+        while not ring.put(record):
+            time.sleep(0.0001)
+
+
+def test_records_cross_between_processes_whole_and_in_order():
+    context = multiprocessing.get_context()
+    memory = SharedRing.allocate(context, 256)
+    ring = SharedRing(memory)
+    producer = context.Process(target=_produce, args=(memory, 5000))
+    producer.start()
+    try:
+        received = []
+        deadline = time.time() + 20
+        while len(received) < 5000 and time.time() < deadline:
+            received.extend(ring.take())
+        assert received == [struct.pack('<I', i) * (i % 7 + 1) for i in range(5000)]
+    finally:
+        producer.join(5)
+
+
+def test_replies_make_the_round_trip_through_the_worker(simulate, connect):
+    mc = connect(simulate().get_port(), interface_factory=ProcessMotorInterface)
+    assert mc.mi.process.is_alive()
+    mc.set_step_delay(7)
+    assert mc.get_delay() == 7
+    assert mc.wait_for_replies([mc.query_delay(), mc.query_step_count(), mc.query_backwards()]) == [7, 0, 0]
+    assert mc.do_steps_and_wait_finish(50) == 50
+
+
+def test_worker_exit_stops_the_interface(simulate, connect, messages):
+    mc = connect(simulate().get_port(), time_out=0.5, interface_factory=ProcessMotorInterface)
+    mc.mi.process.terminate()
+    mc.mi.process.join(1)
+    deadline = time.time() + 2
+    while mc.mi.is_running() and time.time() < deadline:
+        time.sleep(0.01)
+    assert not mc.mi.is_running()
+    assert any('has exited' in message for message in messages)
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from motor import scan as scans
+from motor.scan import Scan
+
+
+@pytest.mark.parametrize('pipelined', [True, False])
+def test_scan_measures_at_every_position(simulate, connect, pipelined):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(2)
+    results = []
+    scan = Scan(mc, [10, 10, 30, 5], lambda position: position * 2, results.append, pipelined=pipelined)
+    log = scan.run()
+    assert scan.get_state() == scans.DONE
+    assert [result[0:2] + result[5:] for result in log] == [(10, 10, 20), (10, 0, 20), (30, 20, 60), (5, 25, 10)]
+    assert results == log.get_results()
+    for position, step_count, move_start, move_end, measure_time, value in log:
+        assert move_start <= move_end <= measure_time
+    assert sim.get_firmware().total_steps == 55
+    # the log is closed once the scan has ended
+    assert list(log.stream(history=True)) == log.get_results()
+
+
+def test_next_move_is_armed_during_the_measurement(simulate, connect):
+    mc = connect(simulate().get_port())
+    mc.set_step_delay(2)
+    positions = [5, 10, 10, 20]
+    armed = []
+
+    # the arming is sent right before the measurement, and confirmed during it, there is nothing to arm before a
+    # measurement at the same position, or after the last one
+    def measure(position):
+        expected = len(armed) + 1 < len(positions) and positions[len(armed) + 1] != position
+        deadline = time.time() + 1
+        while expected and not mc.is_armed() and time.time() < deadline:
+            time.sleep(0.001)
+        armed.append(mc.is_armed())
+    Scan(mc, positions, measure, pipelined=True).run()
+    assert armed == [True, False, True, False]
+
+
+def test_paused_scan_resumes_where_it_left_off(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(2)
+    paused = threading.Event()
+
+    # pauses the scan after its first measurement
+    def pause(result):
+        if len(scan.get_log()) == 1:
+            scan.pause()
+            paused.set()
+    scan = Scan(mc, [10, 20, 30], lambda position: position, pause)
+    scan.start()
+    assert paused.wait(2)
+    time.sleep(0.2)
+    # the next move has been armed, but not started
+    assert scan.get_state() == scans.PAUSED
+    assert len(scan.get_log()) == 1
+    assert sim.get_firmware().total_steps == 10
+    scan.resume()
+    assert scan.wait(2)
+    assert scan.get_state() == scans.DONE
+    assert [result[0] for result in scan.get_log()] == [10, 20, 30]
+    assert sim.get_firmware().total_steps == 30
+
+
+def test_aborted_scan_stops_the_motor(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(2)
+    scan = Scan(mc, [10, 1000, 2000], lambda position: position)
+    scan.start()
+    deadline = time.time() + 2
+    while sim.get_firmware().total_steps <= 20 and time.time() < deadline:
+        time.sleep(0.01)
+    scan.abort()
+    assert scan.wait(2)
+    assert scan.get_state() == scans.ABORTED
+    # the scan ends without measuring where it stopped
+    assert [result[0] for result in scan.get_log()] == [10]
+    assert mc.wait_finish(1)
+    assert not mc.is_armed()
+    assert 20 < sim.get_firmware().total_steps < 1010
+
+
+@pytest.mark.parametrize('pipelined', [True, False])
+def test_failed_measurement_ends_the_scan(simulate, connect, pipelined):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(2)
+
+    # fails the second measurement, while the move after it is armed in a pipelined scan
+    def measure(position):
+        if position == 20:
+            raise IOError('Detector not responding')
+        return position
+    scan = Scan(mc, [10, 20, 30], measure, pipelined=pipelined)
+    with pytest.raises(IOError):
+        scan.run()
+    assert scan.get_state() == scans.FAILED
+    assert scan.wait(0)
+    assert [result[0] for result in scan.get_log()] == [10]
+    assert mc.wait_finish(1)
+    assert not mc.is_armed()
+    time.sleep(0.05)
+    assert sim.get_firmware().total_steps == 20
+
+
+def test_aborted_scan_does_not_run(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    scan = Scan(mc, [10, 20], lambda position: position)
+    scan.abort()
+    assert len(scan.run()) == 0
+    assert scan.get_state() == scans.ABORTED
+    assert sim.get_firmware().total_steps == 0
@@ -0,0 +1,90 @@
+import time
+
+
+# records the names of the commands the firmware runs
+def _record_commands(firmware):
+    run_command = firmware.run_command
+    commands = []
+
+    def record():
+        commands.append(firmware.cmd_name)
+        run_command()
+    firmware.run_command = record
+    return commands
+
+
+def test_mirrored_values_are_answered_without_a_query(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(7)
+    assert mc.do_steps_and_wait_finish(-10) == 10
+    commands = _record_commands(sim.get_firmware())
+    assert (mc.get_delay(), mc.is_forwards(), mc.is_backwards(), mc.get_step_target()) == (7, 0, 1, 0)
+    assert commands == []
+    # the step target is known once the controller confirms it
+    mc.do_steps(1000)
+    time.sleep(0.2)
+    del commands[:]
+    assert mc.get_step_target() == 1000
+    assert commands == []
+    mc.stop_stepping()
+
+
+def test_refresh_always_queries_the_motor(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(7)
+    commands = _record_commands(sim.get_firmware())
+    assert mc.get_delay(refresh=True) == 7
+    assert mc.get_delay(refresh=True) == 7
+    assert commands.count('getDelay') == 2
+
+
+def test_values_are_learned_from_the_replies(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    commands = _record_commands(sim.get_firmware())
+    assert mc.get_delay() == 5
+    assert mc.get_delay() == 5
+    assert commands.count('getDelay') == 1
+
+
+def test_mirror_is_only_set_by_commands_the_controller_takes(simulate, connect, monkeypatch):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(7)
+    # a command dropped for lack of room in the command queue never reaches the controller
+    monkeypatch.setattr(mc.mi, 'make_room', lambda: False)
+    mc.set_step_delay(9)
+    monkeypatch.undo()
+    assert mc.get_delay() == 7
+    assert mc.get_delay(refresh=True) == 7
+    # the controller is asked for a delay which is not a whole number, rather than taking it from the mirror
+    commands = _record_commands(sim.get_firmware())
+    mc.set_step_delay(8.5)
+    assert mc.get_delay() == sim.get_firmware().step_delay
+    assert commands == ['delay', 'getDelay']
+
+
+def test_mirror_is_dropped_with_the_connection(simulate, connect):
+    mc = connect(simulate().get_port())
+    mc.set_step_delay(7)
+    assert mc.get_delay(refresh=True) == 7
+    mc.stop_connection()
+    # the controller may be changed or reset before the next connection
+    assert mc.mirror == {}
+
+
+def test_mirror_is_dropped_when_the_controller_disagrees(simulate, connect, messages):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    mc.set_step_delay(7)
+    assert mc.is_forwards(refresh=True) == 1
+    # the controller changes state behind the back of the host
+    sim.get_firmware().step_delay = 9
+    assert mc.get_delay(refresh=True) == 9
+    assert any('State mirror out of date' in message for message in messages)
+    commands = _record_commands(sim.get_firmware())
+    assert mc.get_delay() == 9
+    assert mc.is_forwards() == 1
+    assert commands == ['isForward']
@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+import stepper_control
+
+
+def test_controllers_are_discovered_in_parallel(simulate):
+    ports = [simulate(boot_time=0.5).get_port() for i in range(8)]
+    start = time.time()
+    assert stepper_control.discover_controllers(ports, time_out=1) == ports
+    # about one boot time, rather than one per port
+    assert time.time() - start < 1.5
+
+
+# the connections to the silent ports time out on their clock threads while the probes close them as well
+@pytest.mark.filterwarnings('error::pytest.PytestUnhandledThreadExceptionWarning')
+@pytest.mark.parametrize('silent_ports', [1, 4])
+def test_ports_without_controller_take_the_boot_time_and_the_time_out(simulate, silent_ports):
+    silent = [simulate() for i in range(silent_ports)]
+    for controller in silent:
+        controller.get_firmware().stop_running()
+    found = [simulate(boot_time=0.5).get_port() for i in range(2)]
+    ports = [found[0]] + [controller.get_port() for controller in silent] + [found[1]]
+    start = time.time()
+    assert stepper_control.discover_controllers(ports, time_out=0.5, boot_time=1) == found
+    elapsed = time.time() - start
+    assert 1.5 <= elapsed < 2.5
+
+
+def test_discovered_controllers_are_connected(simulate):
+    ports = [simulate(boot_time=0.3).get_port() for i in range(3)]
+    controllers = stepper_control.discover_controllers(ports, time_out=1, connect=True, tagged=True)
+    try:
+        assert sorted(controllers) == sorted(ports)
+        for mc in controllers.values():
+            assert mc.is_valid() and mc.tagged_mode
+            assert mc.do_steps_and_wait_finish(10) == 10
+    finally:
+        for mc in controllers.values():
+            mc.stop_connection()
@@ -0,0 +1,83 @@
+import threading
+
+from motor.telemetry import TelemetryBuffer
+
+
+def test_ring_keeps_the_latest_samples():
+    buffer = TelemetryBuffer(4)
+    assert buffer.get_latest() is None
+    for i in range(3):
+        buffer.append(i * 0.5, i)
+    assert len(buffer) == 3
+    assert buffer.get_samples() == [(0.0, 0), (0.5, 1), (1.0, 2)]
+    # the ring wraps around, overwriting the oldest samples
+    for i in range(3, 10):
+        buffer.append(i * 0.5, i)
+    assert len(buffer) == 4
+    assert buffer.get_samples() == [(3.0, 6), (3.5, 7), (4.0, 8), (4.5, 9)]
+    assert list(buffer) == buffer.get_samples()
+    assert buffer.get_latest() == (4.5, 9)
+    buffer.clear()
+    assert len(buffer) == 0 and buffer.get_latest() is None
+
+
+def test_stream_skips_the_overwritten_samples():
+    buffer = TelemetryBuffer(4)
+    buffer.append(0.0, 0)
+    stream = buffer.stream(time_out=0.1, history=True)
+    assert next(stream) == (0.0, 0)
+    # the stream falls behind by more than the size of the ring
+    for i in range(1, 10):
+        buffer.append(float(i), i)
+    assert list(stream) == [(6.0, 6), (7.0, 7), (8.0, 8), (9.0, 9)]
+
+
+def test_stream_ends_when_the_buffer_is_closed():
+    buffer = TelemetryBuffer(4)
+    stream = buffer.stream()
+    closer = threading.Timer(0.1, buffer.close)
+    closer.start()
+    assert list(stream) == []
+    closer.join()
+
+
+def test_samples_are_read_while_another_thread_writes():
+    buffer = TelemetryBuffer(64)
+    count = 20000
+
+    def write():
+        for i in range(count):
+            buffer.append(float(i), i)
+        buffer.close()
+    writer = threading.Thread(target=write)
+    writer.start()
+    streamed = []
+    for sample in buffer.stream(history=True):
+        streamed.append(sample)
+        if len(streamed) % 100 == 0:
+            # the samples read in between are consistent: consecutive, and with matching time stamps
+            samples = buffer.get_samples()
+            assert [int(timestamp) for timestamp, step_count in samples] == \
+                [step_count for timestamp, step_count in samples]
+            assert [step_count for timestamp, step_count in samples] == \
+                list(range(samples[0][1], samples[0][1] + len(samples)))
+    writer.join()
+    # samples are only lost by overwriting: the stream yields them in order, and ends with the last one
+    assert all(timestamp == step_count for timestamp, step_count in streamed)
+    assert all(a[1] < b[1] for a, b in zip(streamed, streamed[1:]))
+    assert streamed[-1] == (float(count - 1), count - 1)
+
+
+def test_step_counts_are_pushed_while_stepping(simulate, connect):
+    sim = simulate()
+    mc = connect(sim.get_port())
+    telemetry = mc.subscribe_step_count(interval=20)
+    mc.set_step_delay(5)
+    assert mc.do_steps_and_wait_finish(60) == 60
+    mc.unsubscribe_step_count()
+    samples = telemetry.get_samples()
+    # a sample every 20 ms of the 600 ms of stepping
+    assert len(samples) >= 10
+    assert all(0 <= step_count <= 60 for timestamp, step_count in samples)
+    assert [step_count for timestamp, step_count in samples] == sorted(step_count for timestamp, step_count in samples)
+    assert list(telemetry.stream()) == []